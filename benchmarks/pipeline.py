@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+# BSEC-Conduit Pipeline Benchmarks - (C) 2018 TimothyBrown
+Measures throughput (samples per second) and per-sample latency of each stage
+of the sample pipeline on its own, and writes the results as JSON so runs can
+be compared across commits and machines.
+MIT License
+
+Usage: python3 benchmarks/pipeline.py [--samples N] [--repeat N] [--stages a,b] [--fields a,b] [--output FILE] [--compare FILE]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import platform
+import argparse
+import threading
+import subprocess
+from types import SimpleNamespace
+from statistics import mean
+from collections import deque
+
+# Run against the bseclib in this checkout, not an installed copy.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import BSECLibrary, Sample, encode_record, OUTPUT_KEYS, DEFAULT_FIELDS
+from bseclib.simulate import SyntheticBackend, synthetic, encode_json
+from bseclib.window import WindowAggregator, summarize
+
+RESULTS_VERSION = 1
+# Sample attributes carried through the pipeline (see --fields).
+FIELDS = ('iaq_accuracy',) + DEFAULT_FIELDS
+
+# Returns <count> synthetic readings as dicts of numbers, with the outputs in FIELDS.
+def readings(count):
+    stream = synthetic(3, seed=1)
+    keep = set(['Status', 'IAQ_Accuracy'] + [OUTPUT_KEYS[field] for field in FIELDS if field in OUTPUT_KEYS])
+    return [{key: value for key, value in next(stream)[1].items() if key in keep} for i in range(count)]
+
+# Returns a BSECLibrary reading from an in-memory copy of the process output.
+def library(output_format, data):
+    lib = BSECLibrary(0x77, 0.0, 3, 3.3, 4, logger='benchmark', base_dir=os.getcwd(), output_format=output_format, backend=SyntheticBackend(),
+                      fields=[field for field in FIELDS if field in OUTPUT_KEYS])
+    lib.proc = SimpleNamespace(stdout=io.BytesIO(data))
+    return lib
+
+### Stages
+# Each stage takes the sample count and returns (step, items); step(item) processes one sample.
+
+## Line decoding in BSECLibrary.output(), 'json' mode.
+def stage_decode_json(count):
+    output = library('json', b''.join(encode_json(i) for i in readings(count))).output()
+    return lambda item: next(output), range(count)
+
+## Record decoding in BSECLibrary.output(), 'binary' mode.
+def stage_decode_binary(count):
+    output = library('binary', b''.join(encode_record(i) for i in readings(count))).output()
+    return lambda item: next(output), range(count)
+
+## Field conversion of a 'json' mode dict (strings) into a Sample.
+def stage_convert_json(count):
+    items = [dict(json.loads(encode_json(i).decode('UTF-8'))) for i in readings(count)]
+    return lambda item: Sample.from_dict(item, 0.0, 0), items
+
+## Field conversion of a 'binary' mode dict (numbers) into a Sample.
+def stage_convert_binary(count):
+    return lambda item: Sample.from_dict(item, 0.0, 0), readings(count)
+
+## Window aggregation with the default [Cache] settings (60 sample window, publish every 20), including the means of each publish.
+def stage_aggregate(count, size=60, interval=20):
+    aggregator = WindowAggregator(FIELDS, size, interval)
+    stats = [aggregator[field] for field in FIELDS]
+    def step(sample):
+        if aggregator.add(sample):
+            return [i.mean for i in stats]
+    return step, [Sample.from_dict(i, 0.0, n) for n, i in enumerate(readings(count))]
+
+## The same, as BSEC-Conduit did it before bseclib.window: a deque per field and statistics.mean() on each publish.
+def stage_aggregate_baseline(count, size=60, interval=20):
+    caches = [deque(maxlen=size) for field in FIELDS]
+    pending = [0]
+    def step(sample):
+        for cache, field in zip(caches, FIELDS):
+            cache.append(getattr(sample, field))
+        pending[0] += 1
+        if pending[0] >= interval:
+            pending[0] = 0
+            return [mean(cache) for cache in caches]
+    return step, [Sample.from_dict(i, 0.0, n) for n, i in enumerate(readings(count))]
+
+## A large cache: an hour of samples, published every hour at a 3 second sample rate.
+def stage_aggregate_large(count):
+    return stage_aggregate(count, 3600, 1200)
+
+def stage_aggregate_large_baseline(count):
+    return stage_aggregate_baseline(count, 3600, 1200)
+
+## Unit conversion and rounding of a full window (convert_to_f and iaq_as_percent enabled).
+def stage_units(count):
+    aggregator = WindowAggregator(FIELDS, 60, 20)
+    for n, i in enumerate(readings(60)):
+        aggregator.add(Sample.from_dict(i, 0.0, n))
+    return lambda item: summarize(aggregator, True, True), range(count)
+
+## paho publish to a local broker stand-in, from publish() to the broker's acknowledgement.
+def stage_mqtt(count, qos):
+    import paho.mqtt.client as mqtt
+    broker = BrokerStandIn()
+    try:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    except AttributeError:
+        client = mqtt.Client()
+    done = threading.Event()
+    pending = set()
+    def on_publish(client, userdata, mid):
+        pending.discard(mid)
+        if not pending:
+            done.set()
+    client.on_publish = on_publish
+    client.connect('127.0.0.1', broker.port)
+    client.loop_start()
+    # One value per message, as when not bundling state.
+    payloads = [str(round(i[OUTPUT_KEYS[FIELDS[1]]], 2)) for i in readings(count)]
+    def step(payload):
+        done.clear()
+        info = client.publish('benchmark/temperature', payload=payload, qos=qos, retain=True)
+        pending.add(info.mid)
+        done.wait(5)
+    def close():
+        client.loop_stop()
+        client.disconnect()
+        broker.close()
+    return step, payloads, close
+
+def stage_mqtt_qos0(count):
+    return stage_mqtt(count, 0)
+
+def stage_mqtt_qos1(count):
+    return stage_mqtt(count, 1)
+
+STAGES = {
+    'decode_json': stage_decode_json,
+    'decode_binary': stage_decode_binary,
+    'convert_json': stage_convert_json,
+    'convert_binary': stage_convert_binary,
+    'aggregate': stage_aggregate,
+    'aggregate_baseline': stage_aggregate_baseline,
+    'aggregate_large': stage_aggregate_large,
+    'aggregate_large_baseline': stage_aggregate_large_baseline,
+    'units': stage_units,
+    'mqtt_qos0': stage_mqtt_qos0,
+    'mqtt_qos1': stage_mqtt_qos1
+}
+
+class BrokerStandIn:
+    """Just enough of an MQTT 3.1.1 broker to accept a connection and acknowledge publishes."""
+
+    def __init__(self):
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.received = 0
+        self._thread = threading.Thread(target=self._serve, name='broker', daemon=True)
+        self._thread.start()
+
+    # Private function run on a thread to answer the client.
+    def _serve(self):
+        try:
+            conn, address = self.server.accept()
+        except OSError:
+            return
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = conn.makefile('rb')
+        with conn, stream:
+            while True:
+                header = stream.read(1)
+                if not header:
+                    return
+                length, multiplier = 0, 1
+                while True:
+                    byte = stream.read(1)[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = stream.read(length)
+                kind = header[0] >> 4
+                if kind == 1:  # CONNECT -> CONNACK
+                    conn.sendall(b'\x20\x02\x00\x00')
+                elif kind == 3:  # PUBLISH -> PUBACK / PUBREC
+                    self.received += 1
+                    qos = (header[0] >> 1) & 3
+                    if qos:
+                        topic_length = int.from_bytes(body[:2], 'big')
+                        packet_id = body[2 + topic_length:4 + topic_length]
+                        conn.sendall((b'\x40\x02' if qos == 1 else b'\x50\x02') + packet_id)
+                elif kind == 6:  # PUBREL -> PUBCOMP
+                    conn.sendall(b'\x70\x02' + body[:2])
+                elif kind == 12:  # PINGREQ -> PINGRESP
+                    conn.sendall(b'\xd0\x00')
+                elif kind == 14:  # DISCONNECT
+                    return
+
+    def close(self):
+        self.server.close()
+
+### Harness
+# Runs one stage. Returns its results, or None if it can't run here.
+def run_stage(name, count, repeat):
+    best = None
+    latencies = None
+    for i in range(repeat + 1):
+        try:
+            setup = STAGES[name](count)
+        except ImportError as e:
+            logging.warning("Skipping {}: {}".format(name, e))
+            return None
+        step, items = setup[0], setup[1]
+        try:
+            if i < repeat:
+                # Throughput pass; nothing but the stage itself in the loop.
+                start = time.perf_counter()
+                for item in items:
+                    step(item)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            else:
+                # Latency pass; times every sample on its own.
+                clock = time.perf_counter_ns
+                latencies = []
+                for item in items:
+                    start = clock()
+                    step(item)
+                    latencies.append(clock() - start)
+        finally:
+            if len(setup) > 2:
+                setup[2]()
+    latencies.sort()
+    return {
+        'samples': count,
+        'seconds': best,
+        'samples_per_second': count / best if best else None,
+        'latency_us': {
+            'mean': sum(latencies) / len(latencies) / 1000,
+            'p50': percentile(latencies, 50) / 1000,
+            'p90': percentile(latencies, 90) / 1000,
+            'p99': percentile(latencies, 99) / 1000,
+            'max': latencies[-1] / 1000
+        }
+    }
+
+# Returns the <percent>th percentile of a sorted list.
+def percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+# Returns a description of the machine and checkout the benchmarks ran on.
+def environment():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip() or None
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.strip())
+    except FileNotFoundError:
+        commit, dirty = None, None
+    cpu = None
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith(('model name', 'Hardware', 'Model')):
+                    cpu = line.split(':', 1)[1].strip()
+    except FileNotFoundError:
+        pass
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': '{} {}'.format(platform.python_implementation(), platform.python_version()),
+        'machine': platform.machine(),
+        'cpu': cpu or platform.processor(),
+        'cpu_count': os.cpu_count()
+    }
+
+# Prints the results as a table, with the change from <baseline> if given.
+def report(results, baseline=None, stream=sys.stderr):
+    print('{:<26}{:>14}{:>10}{:>10}{:>10}{:>10}'.format('stage', 'samples/s', 'p50 us', 'p99 us', 'max us', 'change'), file=stream)
+    for name, result in results['stages'].items():
+        if result is None:
+            print('{:<26}{:>14}'.format(name, 'skipped'), file=stream)
+            continue
+        change = ''
+        old = (baseline or {}).get('stages', {}).get(name)
+        if old and old.get('samples_per_second'):
+            change = '{:+.1f}%'.format((result['samples_per_second'] / old['samples_per_second'] - 1) * 100)
+        latency = result['latency_us']
+        print('{:<26}{:>14.0f}{:>10.2f}{:>10.2f}{:>10.1f}{:>10}'.format(
+            name, result['samples_per_second'], latency['p50'], latency['p99'], latency['max'], change), file=stream)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    parser = argparse.ArgumentParser(prog='pipeline.py', description='Benchmark each stage of the sample pipeline.')
+    parser.add_argument('--samples', type=int, default=20000, help='Samples per stage. (Default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='Throughput runs per stage; the fastest is kept. (Default: %(default)s)')
+    parser.add_argument('--stages', default=','.join(STAGES), help='Comma separated stages to run. (Default: all)')
+    parser.add_argument('--fields', default=','.join(FIELDS[1:]), help='Comma separated BSEC outputs to carry. (Default: %(default)s)')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout.')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against.')
+    args = parser.parse_args()
+
+    stages = [i.strip() for i in args.stages.split(',') if i.strip()]
+    for name in stages:
+        if name not in STAGES:
+            parser.error('Unknown stage: {} (Choose from: {})'.format(name, ', '.join(STAGES)))
+    if args.samples < 1 or args.repeat < 1:
+        parser.error('--samples and --repeat must be at least 1.')
+    fields = tuple(i.strip() for i in args.fields.split(',') if i.strip())
+    for field in fields:
+        if field not in OUTPUT_KEYS:
+            parser.error('Unknown field: {} (Choose from: {})'.format(field, ', '.join(OUTPUT_KEYS)))
+    FIELDS = ('iaq_accuracy',) + fields
+    # The MQTT stages wait for every acknowledgement, so keep them to a sensible size.
+    results = {'version': RESULTS_VERSION, 'environment': environment(), 'fields': list(fields), 'stages': {}}
+    for name in stages:
+        count = min(args.samples, 2000) if name.startswith('mqtt') else args.samples
+        results['stages'][name] = run_stage(name, count, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
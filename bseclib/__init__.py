@@ -10,23 +10,221 @@ __date__ = '2018.11.16'
 __author__ = 'Timothy S. Brown'
 
 import os
+import signal
 import subprocess
+import threading
 import logging
 import platform
 import time
-from shutil import copy
-from hashlib import md5
+from shutil import copy, copy2
+from hashlib import sha256
 import json
+import struct
+import collections
 
 class BSECLibraryError(Exception):
     """Base class for exceptions."""
     # Todo: Expand this into real exception handling sub-classes.
     pass
 
+# Outputs the bsec-library process can hand over, as (Sample attribute, output key), in the
+# order they're sent. Bit n of a field mask selects OUTPUT_FIELDS[n]; the status, IAQ accuracy,
+# sensor timestamp and sequence number are always sent.
+OUTPUT_FIELDS = (
+    ('iaq', 'IAQ'),
+    ('temperature', 'Temperature'),
+    ('humidity', 'Humidity'),
+    ('pressure', 'Pressure'),
+    ('gas', 'Gas'),
+    ('static_iaq', 'Static_IAQ'),
+    ('co2_equivalent', 'CO2_Equivalent'),
+    ('breath_voc_equivalent', 'Breath_VOC_Equivalent'),
+    ('raw_temperature', 'Raw_Temperature'),
+    ('raw_humidity', 'Raw_Humidity')
+)
+OUTPUT_KEYS = dict(OUTPUT_FIELDS)
+# The outputs sent unless told otherwise.
+DEFAULT_FIELDS = ('iaq', 'temperature', 'humidity', 'pressure', 'gas')
+
+# Returns the field mask for a list of Sample attribute names.
+def field_mask(fields):
+    names = [field for field, key in OUTPUT_FIELDS]
+    mask = 0
+    for field in fields:
+        if field not in OUTPUT_KEYS:
+            raise BSECLibraryError("Unknown field: {} (Choose from: {})".format(field, ', '.join(names)))
+        mask |= 1 << names.index(field)
+    return mask
+
+# Returns the Sample attribute names selected by a field mask, in output order.
+def mask_fields(mask):
+    return tuple(field for i, (field, key) in enumerate(OUTPUT_FIELDS) if mask >> i & 1)
+
+# Binary record layout written by the bsec-library process in 'binary' mode.
+# All values are little-endian. Keep in sync with `write_record()` in bsec_library_c.
+# Header: magic (uint16), version (uint8), record length in bytes (uint8).
+RECORD_MAGIC = 0xB5EC
+RECORD_VERSION = 3
+RECORD_HEADER = struct.Struct('<HBB')
+# Body: status (int16), IAQ accuracy (uint8), pad, field mask (uint16), sensor timestamp
+# (int64, CLOCK_MONOTONIC nanoseconds) and output sequence number (uint32), followed by
+# one float32 for each output in the field mask (pressure in hPa).
+RECORD_BODY = struct.Struct('<hBxHqI')
+RECORD_MASK = struct.Struct('<H')
+RECORD_MASK_OFFSET = 4
+RECORD_FIELDS = ('Status', 'IAQ_Accuracy', 'Timestamp', 'Sequence')
+_record_formats = {}
+
+# Returns the struct of a record body (skipping the mask) and the keys it unpacks into, for a field mask.
+def record_format(mask):
+    record = _record_formats.get(mask)
+    if record is None:
+        keys = tuple(OUTPUT_KEYS[field] for field in mask_fields(mask))
+        record = _record_formats[mask] = (struct.Struct('<hB3xqI' + 'f' * len(keys)), RECORD_FIELDS + keys)
+    return record
+
+# Returns the size in bytes of a record carrying the outputs in a field mask.
+def record_size(mask):
+    return RECORD_HEADER.size + record_format(mask)[0].size
+
+# Private function to check a record header and return the struct and keys of its body.
+def _record_body(magic, version, length, mask):
+    if magic != RECORD_MAGIC or version != RECORD_VERSION:
+        raise BSECLibraryError("Invalid record header (magic: {:#06x}, version: {}, length: {}).".format(magic, version, length))
+    body, keys = record_format(mask)
+    if length != RECORD_HEADER.size + body.size:
+        raise BSECLibraryError("Invalid record length {} for field mask {:#x}.".format(length, mask))
+    return body, keys
+
+# Decodes binary records from a file-like object, yielding a dict of numbers per record.
+def decode_records(stream):
+    header_size = RECORD_HEADER.size
+    unpack_header = RECORD_HEADER.unpack
+    unpack_mask = RECORD_MASK.unpack_from
+    read = stream.read
+    while True:
+        header = read(header_size)
+        if len(header) < header_size:
+            return
+        magic, version, length = unpack_header(header)
+        if length < header_size + RECORD_BODY.size:
+            raise BSECLibraryError("Invalid record header (magic: {:#06x}, version: {}, length: {}).".format(magic, version, length))
+        body = read(length - header_size)
+        if len(body) < length - header_size:
+            return
+        unpack_body, keys = _record_body(magic, version, length, unpack_mask(body, RECORD_MASK_OFFSET)[0])
+        yield dict(zip(keys, unpack_body.unpack(body)))
+
+# Decodes all complete binary records in a buffer. Returns a list of dicts and the number of bytes consumed.
+def decode_record_buffer(buffer):
+    header_size = RECORD_HEADER.size
+    minimum = header_size + RECORD_BODY.size
+    unpack_header = RECORD_HEADER.unpack_from
+    unpack_mask = RECORD_MASK.unpack_from
+    records = []
+    offset = 0
+    end = len(buffer)
+    while end - offset >= minimum:
+        magic, version, length = unpack_header(buffer, offset)
+        if length < minimum:
+            raise BSECLibraryError("Invalid record header (magic: {:#06x}, version: {}, length: {}).".format(magic, version, length))
+        if end - offset < length:
+            break
+        unpack_body, keys = _record_body(magic, version, length, unpack_mask(buffer, offset + header_size + RECORD_MASK_OFFSET)[0])
+        records.append(dict(zip(keys, unpack_body.unpack_from(buffer, offset + header_size))))
+        offset += length
+    return records, offset
+
+# Decodes a buffer holding exactly one binary record. Returns a dict.
+def decode_record(record):
+    records, consumed = decode_record_buffer(record)
+    if len(records) != 1 or consumed != len(record):
+        raise BSECLibraryError("Invalid record length {}.".format(len(record)))
+    return records[0]
+
+# Encodes a dict of numbers (as yielded in 'binary' mode) into a binary record.
+# Carries the outputs in <mask>, or every output in the dict if <mask> is None.
+def encode_record(data, mask=None):
+    if mask is None:
+        mask = field_mask(field for field, key in OUTPUT_FIELDS if key in data)
+    body, keys = record_format(mask)
+    return RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, RECORD_HEADER.size + body.size) + RECORD_BODY.pack(
+        data['Status'], data['IAQ_Accuracy'], mask, data.get('Timestamp', 0), data.get('Sequence', 0)) + struct.pack(
+        '<' + 'f' * (len(keys) - len(RECORD_FIELDS)), *[data[key] for key in keys[len(RECORD_FIELDS):]])
+
+# Returns the path of the first 'BSEC_*' source directory under base_dir, or None if there isn't one.
+def find_src_dir(base_dir):
+    for i in sorted(os.listdir(base_dir)):
+        path = os.path.join(base_dir, i)
+        if 'BSEC_' in i and os.path.isdir(path):
+            return os.path.abspath(path)
+    return None
+
+class Sample:
+    """A single numeric reading from the BSEC-Library process."""
+    __slots__ = ('timestamp', 'sequence', 'status', 'iaq_accuracy', 'iaq', 'temperature', 'humidity', 'pressure', 'gas',
+                 'sensor_time', 'sensor_sequence', 'static_iaq', 'co2_equivalent', 'breath_voc_equivalent', 'raw_temperature', 'raw_humidity')
+
+    # sensor_time: CLOCK_MONOTONIC time (seconds) the BSEC-Library process took the reading, the same
+    #              clock as time.monotonic(). sensor_sequence: Output counter of the process.
+    #              Both are None if the source doesn't provide them.
+    # Outputs that weren't selected (see OUTPUT_FIELDS) are None.
+    def __init__(self, timestamp, sequence, status, iaq_accuracy, iaq, temperature, humidity, pressure, gas, sensor_time=None, sensor_sequence=None,
+                 static_iaq=None, co2_equivalent=None, breath_voc_equivalent=None, raw_temperature=None, raw_humidity=None):
+        self.timestamp = timestamp
+        self.sequence = sequence
+        self.status = status
+        self.iaq_accuracy = iaq_accuracy
+        self.iaq = iaq
+        self.temperature = temperature
+        self.humidity = humidity
+        self.pressure = pressure
+        self.gas = gas
+        self.sensor_time = sensor_time
+        self.sensor_sequence = sensor_sequence
+        self.static_iaq = static_iaq
+        self.co2_equivalent = co2_equivalent
+        self.breath_voc_equivalent = breath_voc_equivalent
+        self.raw_temperature = raw_temperature
+        self.raw_humidity = raw_humidity
+
+    # Alternate constructor taking a dict as yielded by BSECLibrary.output() (strings or numbers).
+    @classmethod
+    def from_dict(cls, data, timestamp, sequence):
+        sensor_time = data.get('Timestamp')
+        sensor_sequence = data.get('Sequence')
+        iaq, temperature, humidity, pressure, gas, static_iaq, co2_equivalent, breath_voc_equivalent, raw_temperature, raw_humidity = [
+            float(data[key]) if key in data else None for field, key in OUTPUT_FIELDS]
+        return cls(timestamp, sequence,
+                   int(data['Status']),
+                   int(data['IAQ_Accuracy']),
+                   iaq, temperature, humidity, pressure, gas,
+                   None if sensor_time is None else int(sensor_time) / 1000000000,
+                   None if sensor_sequence is None else int(sensor_sequence),
+                   static_iaq, co2_equivalent, breath_voc_equivalent, raw_temperature, raw_humidity)
+
+    # Returns the reading as a dict using the same keys as BSECLibrary.output().
+    def as_dict(self):
+        data = {'IAQ_Accuracy': self.iaq_accuracy}
+        for field, key in OUTPUT_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                data[key] = value
+        data['Status'] = self.status
+        if self.sensor_time is not None:
+            data['Timestamp'] = int(round(self.sensor_time * 1000000000))
+        if self.sensor_sequence is not None:
+            data['Sequence'] = self.sensor_sequence
+        return data
+
+    def __repr__(self):
+        return 'Sample({})'.format(', '.join('{}={}'.format(name, getattr(self, name)) for name in self.__slots__
+                                             if name in ('timestamp', 'sequence', 'status', 'iaq_accuracy') or getattr(self, name) is not None))
+
 class BSECLibrary:
     """Handles communication with a BME680 using the Bosch BSEC fusion library."""
 
-    def __init__(self, i2c_address, temp_offset, sample_rate, voltage, retain_state, logger=None, base_dir=None):
+    def __init__(self, i2c_address, temp_offset, sample_rate, voltage, retain_state, logger=None, base_dir=None, output_format='json', i2c_bus=1, src_dir=None, cache_dir=None, full_check=False, backend=None, metrics=None, fields=None, state_interval=3600, state_fsync=True, read_queue=0):
         # If the user doesn't pass a logger object, create one.
         if logger is None:
             logger = __name__
@@ -39,6 +237,12 @@ class BSECLibrary:
         else:
             self.i2c_address = i2c_address
 
+        if not isinstance(i2c_bus, int) or i2c_bus < 0:
+            self.log.error("Error: <i2c_bus> must be a positive integer.")
+            raise BSECLibraryError()
+        else:
+            self.i2c_bus = i2c_bus
+
         if 10.0 > temp_offset < -10.0:
             self.log.error("Error: <temp_offset> must be in the range of 10.0 and -10.0.")
             raise BSECLibraryError()
@@ -63,31 +267,141 @@ class BSECLibrary:
         else:
             self.retain_state = retain_state
 
+        if output_format != 'json' and output_format != 'binary':
+            self.log.error("Error: <output_format> must be one of 'json' or 'binary'.")
+            raise BSECLibraryError()
+        else:
+            self.output_format = output_format
+
+        if fields is None:
+            fields = DEFAULT_FIELDS
+        try:
+            self.field_mask = field_mask(fields)
+        except BSECLibraryError as e:
+            self.log.error("Error: <fields> {}".format(e))
+            raise
+        if self.field_mask == 0:
+            self.log.error("Error: <fields> must select at least one output.")
+            raise BSECLibraryError()
+        # The selected outputs, in output order.
+        self.fields = mask_fields(self.field_mask)
+
+        if not isinstance(state_interval, int) or not 0 <= state_interval <= 31536000:
+            self.log.error("Error: <state_interval> must be a number of seconds between 0 and 31536000.")
+            raise BSECLibraryError()
+        else:
+            self.state_interval = state_interval
+        self.state_fsync = bool(state_fsync)
+
+        if not isinstance(read_queue, int) or read_queue < 0:
+            self.log.error("Error: <read_queue> must be 0 or a positive integer.")
+            raise BSECLibraryError()
+        else:
+            self.read_queue = read_queue
+
         if base_dir is None:
             self.base_dir = os.getcwd()
         elif os.path.isdir(base_dir):
             self.base_dir = os.path.abspath(base_dir)
         else:
             self.log.error("Error: <base_dir> value of ({}) is not a valid directory.".format(base_dir))
+            raise BSECLibraryError()
+
+        # Optional instrumentation (see bseclib.metrics).
+        if metrics is not None:
+            self._parse_time = metrics.histogram('bsec_parse_seconds', 'Time to decode and convert one sample.')
+            self._status_errors = metrics.counter('bsec_status_errors_total', 'Samples with a non-zero BSEC status.')
+            self._state_write_time = metrics.histogram('bsec_state_write_seconds', 'Time to write the BSEC state file.')
+            self._state_writes = metrics.counter('bsec_state_writes_total', 'BSEC state file writes.')
+            self._state_unchanged = metrics.counter('bsec_state_unchanged_total', 'BSEC state saves skipped because the state was unchanged.')
+            if read_queue:
+                self._read_depth = metrics.gauge('bsec_read_queue_depth', 'Samples waiting in the read queue.')
+                self._read_overflows = metrics.counter('bsec_read_overflows_total', 'Times the read queue filled up and started dropping samples.')
+                self._read_dropped = metrics.counter('bsec_read_dropped_total', 'Samples dropped because the read queue was full.')
+            else:
+                self._read_depth = self._read_overflows = self._read_dropped = None
+        else:
+            self._parse_time = None
+            self._status_errors = None
+            self._state_write_time = self._state_writes = self._state_unchanged = None
+            self._read_depth = self._read_overflows = self._read_dropped = None
+        # perf_counter() when the raw bytes of the current sample were read.
+        self._read_done = 0.0
+
+        # A simulated backend (see bseclib.simulate) stands in for the bsec-library process,
+        # so none of the files below are needed.
+        self.backend = backend
+        self.startup_timings = {}
+        if backend is not None:
+            self.src_dir = self.cache_dir = self.exec_path = self.config_path = self.state_path = None
+            self.log.info("Using the {} backend.".format(backend))
+        else:
+            self._get_files(src_dir, cache_dir, full_check)
+
+        # Set the process, sample sequence and read buffer variables.
+        self.proc = None
+        self.sequence = 0
+        self._buffer = b''
+        # State saves reported by the process: writes, skipped unchanged saves, and the last write time.
+        self.state_writes = 0
+        self.state_unchanged = 0
+        self.state_write_seconds = None
+        # The read queue (see read_queue): samples read but not yet taken, the reader thread,
+        # whether the output has ended, and the wakeup pipe behind fileno().
+        self._read_buffer = collections.deque()
+        self._read_ready = threading.Condition()
+        self._reader = None
+        self._read_ended = False
+        self._read_overflowing = False
+        self._wakeup = None
+        # Times the read queue filled up, and the samples it dropped.
+        self.read_overflows = 0
+        self.read_dropped = 0
+
+    # Private function to locate the BSEC source and get the executable, config and state files ready.
+    def _get_files(self, src_dir, cache_dir, full_check):
+        # The startup manifest lets us validate the files below with stat() instead of reading them.
+        from bseclib.manifest import StartupManifest
+        self.manifest = StartupManifest('{}/bsec-library.manifest'.format(self.base_dir), full_check=full_check, logger=self.log.name)
+        started = time.monotonic()
 
         # Make sure the BSEC source directory exsists.
-        src_dirs = [i for i in os.listdir(self.base_dir) if os.path.isdir(i) and 'BSEC_' in i]
-        if len(src_dirs) == 0:
+        if src_dir is None:
+            # Reuse the last directory found as long as it's still there.
+            src_dir = self.manifest.value('src_dir', [], lambda: find_src_dir(self.base_dir),
+                                          check=lambda path: path is not None and os.path.isdir(path))
+        if src_dir is None or not os.path.isdir(src_dir):
             self.log.error('The BSEC source directory could not be located!')
             self.log.error("Expected a directory name starting with 'BSEC_' under '{}' containing the the Bosch BSEC source files.".format(self.base_dir))
             self.log.error("Please download and unzip them from the URL below:")
             self.log.error("https://www.bosch-sensortec.com/bst/products/all_products/bsec")
             raise BSECLibraryError()
         else:
-            self.src_dir = os.path.abspath(src_dirs[0])
+            self.src_dir = os.path.abspath(src_dir)
+
+        # Where finished builds are kept, so other base directories can reuse them.
+        if cache_dir is None:
+            from bseclib.build import default_cache_dir
+            self.cache_dir = default_cache_dir(self.base_dir)
+        else:
+            self.cache_dir = os.path.abspath(cache_dir)
 
         # Get executable, config and state file paths.
+        self.startup_timings['src_dir'] = time.monotonic() - started
+        started = time.monotonic()
         self.exec_path = self._get_exec(self.src_dir, self.base_dir)
+        self.startup_timings['exec'] = time.monotonic() - started
+        started = time.monotonic()
         self.config_path = self._get_config(self.src_dir, self.base_dir, self.config_string)
+        self.startup_timings['config'] = time.monotonic() - started
+        started = time.monotonic()
         self.state_path = self._get_state(self.base_dir)
-
-        # Set the process variable.
-        self.proc = None
+        self.startup_timings['state'] = time.monotonic() - started
+        self.manifest.save()
+        self.log.info("Startup checks took {:.3f}s ({}) with {} cached and {} full checks.".format(
+            sum(self.startup_timings.values()),
+            ', '.join('{} {:.3f}s'.format(k, v) for k, v in self.startup_timings.items()),
+            self.manifest.hits, self.manifest.misses))
 
     # Property function to generate the config_string variable.
     @property
@@ -99,53 +413,373 @@ class BSECLibrary:
     def sample_rate_string(self):
         return {3: 'LP', 300: 'ULP'}[self.sample_rate]
 
+    # Property function to generate the output_format_string variable.
+    @property
+    def output_format_string(self):
+        return {'json': 'JSON', 'binary': 'BIN'}[self.output_format]
+
+    # Property function to generate the sample_period variable: the expected seconds
+    # between samples, or 0 if a simulated backend is running as fast as it can.
+    @property
+    def sample_period(self):
+        if self.backend is None:
+            return self.sample_rate
+        return self.sample_rate / self.backend.speed if self.backend.speed > 0 else 0
+
+    # Property function to generate the i2c_device variable.
+    @property
+    def i2c_device(self):
+        return '/dev/i2c-{}'.format(self.i2c_bus)
+
     # Function to start the bsec-library process.
     def open(self):
         if self.proc is not None:
             self.log.warning("BSEC-Library is already running!")
         else:
-            new_env = os.environ.copy()
-            if 'TZ' not in new_env:
-                tz = int((time.timezone if (time.localtime().tm_isdst == 0) else time.altzone) / 60 / 60 * -1)
-                new_env['TZ'] = 'Etc/GMT{}'.format(tz)
-            run_command = [self.exec_path, str(self.i2c_address), str(self.temp_offset), self.sample_rate_string]
+            run_command = self._run_command()
             self.log.warning(run_command)
-            self.proc = subprocess.Popen(run_command, stdout=subprocess.PIPE, env=new_env)
+            # The process looks for its config and state files in the working directory.
+            self.proc = subprocess.Popen(run_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self._run_env(), cwd=self.base_dir)
+            self.sequence = 0
+            self._buffer = b''
+            threading.Thread(target=self._read_errors, args=(self.proc.stderr,), name='bsec-stderr', daemon=True).start()
+            if self.read_queue:
+                self._read_buffer.clear()
+                self._read_ended = False
+                self._read_overflowing = False
+                # Made before the reader starts, so every batch has a byte in the pipe and the reader owns the write end.
+                # A full pipe already wakes the consumer, so writes to it don't block (the reader holds _read_ready).
+                self._wakeup = os.pipe()
+                os.set_blocking(self._wakeup[1], False)
+                self._reader = threading.Thread(target=self._read_output, args=(self.proc, self._wakeup), name='bsec-reader', daemon=True)
+                self._reader.start()
             if self.proc.returncode is not None:
                 self.log.error('BSEC-Library encountered an error ({}) during startup.'.format(self.proc.returncode))
                 raise BSECLibraryError()
             else:
                 self.log.info('BSEC-Library started.')
 
-    # Function to stop the bsec-library process.
-    def close(self):
+    # Function to stop the bsec-library process. It saves the BSEC state before exiting;
+    # waits up to <timeout> seconds for that before killing it.
+    def close(self, timeout=5):
         if self.proc is None:
             self.log.warning("BSEC-Library is not running!")
         else:
-            self.proc.send_signal(15)
-            time.sleep(1)
-            self.log.info("BSEC-Library stopped.")
+            proc = self.proc
             self.proc = None
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+                self._wait(proc, timeout)
+            # The reader gets the end of the output once the process has exited; let it finish before closing the pipe.
+            if self._reader is not None:
+                self._reader.join(timeout)
+                self._reader = None
+                if self._wakeup is not None:
+                    os.close(self._wakeup[0])
+                    self._wakeup = None
+            proc.stdout.close()
+            self.log.info("BSEC-Library stopped.")
+
+    # Function to ask the bsec-library process to save its state and exit, without waiting.
+    # For use from a signal handler or another thread while output() is being read: the
+    # output ends once the process has exited. Killed if it's still running after <timeout> seconds.
+    def terminate(self, timeout=5):
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+            threading.Thread(target=self._wait, args=(proc, timeout), name='bsec-terminate', daemon=True).start()
+
+    # Private function to wait for the process to exit, killing it after <timeout> seconds.
+    def _wait(self, proc, timeout):
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.log.warning("BSEC-Library didn't exit after {}s, killing it.".format(timeout))
+            proc.kill()
+            proc.wait()
 
     # Function to allow the user to iterate over the output.
+    # In 'json' mode each value is a string, in 'binary' mode (or with a read queue) each value is a number.
     def output(self):
         if self.proc is not None:
-            for line in iter(self.proc.stdout.readline, b''):
-                data = dict(json.loads(line.decode('UTF-8')))
-                if data['Status'] != '0':
-                    # If there's a problem, yo we'll log it...
-                    self.log.error("BSEC-Library returned error {}.".format(data['Status']))
-                    # ...kill the process and hope that resolves it! (Ice, ice, baby.)
-                    raise BSECLibraryError()
-                else:
-                    yield data
+            if self.read_queue:
+                for sample in self._queued_samples():
+                    yield sample.as_dict()
+                return
+            if self.output_format == 'binary':
+                records = self._decode_binary()
+            else:
+                records = self._decode_json()
+            for data in records:
+                self._check_status(data['Status'])
+                yield data
             self.log.warning("BSEC-Library ran out of data to yield!")
         else:
             self.log.warning("No data to to parse! Have you started the BSEC-Library process?")
             return None
 
+    # Function to iterate over the output as Sample objects.
+    # Each sample is stamped with time.monotonic() and a sequence number that starts at 0 on open().
+    def samples(self):
+        if self.read_queue and self.proc is not None:
+            # Already stamped when they were read.
+            yield from self._queued_samples()
+            return
+        from_dict = Sample.from_dict
+        monotonic = time.monotonic
+        parse_time = self._parse_time
+        for data in self.output():
+            sample = from_dict(data, monotonic(), self.sequence)
+            if parse_time is not None:
+                parse_time.observe(time.perf_counter() - self._read_done)
+            self.sequence += 1
+            yield sample
+
+    # Private function to generate the bsec-library command line.
+    def _run_command(self):
+        if self.backend is not None:
+            return self.backend.command(self)
+        return [self.exec_path, str(self.i2c_address), str(self.temp_offset), self.sample_rate_string, self.output_format_string, self.i2c_device, str(self.field_mask),
+                str(self.state_interval), str(int(self.state_fsync))]
+
+    # Private function to generate the bsec-library environment.
+    def _run_env(self):
+        new_env = os.environ.copy()
+        if 'TZ' not in new_env:
+            tz = int((time.timezone if (time.localtime().tm_isdst == 0) else time.altzone) / 60 / 60 * -1)
+            new_env['TZ'] = 'Etc/GMT{}'.format(tz)
+        if self.backend is not None:
+            new_env = self.backend.env(new_env)
+        return new_env
+
+    # Function to return the file descriptor of the process output, for use with the selectors module.
+    # With a read queue, it's a pipe that's readable when samples are waiting in the queue instead; open() creates it.
+    def fileno(self):
+        if self.read_queue:
+            return self._wakeup[0]
+        return self.proc.stdout.fileno()
+
+    # Function to read whatever output is waiting without blocking for a full sample.
+    # Meant to be called when fileno() is readable. Returns a (possibly empty) list
+    # of Sample objects, or None once the process has closed its output.
+    def read_available(self):
+        if self.read_queue:
+            os.read(self._wakeup[0], 65536)
+            return self.read_batch(self.read_queue, 0)
+        data = os.read(self.proc.stdout.fileno(), 65536)
+        if not data:
+            self.log.warning("BSEC-Library ran out of data to yield!")
+            return None
+        read_done = time.perf_counter()
+        samples = []
+        monotonic = time.monotonic()
+        for data in self._decode_buffer(data):
+            self._check_status(data['Status'])
+            samples.append(Sample.from_dict(data, monotonic, self.sequence))
+            self.sequence += 1
+        if self._parse_time is not None and samples:
+            # Everything in the buffer was decoded at once, so share the time out evenly.
+            parse_time = (time.perf_counter() - read_done) / len(samples)
+            for i in range(len(samples)):
+                self._parse_time.observe(parse_time)
+        return samples
+
+    # Function to take up to <count> samples from the read queue. Waits until <count> are waiting
+    # or <timeout> seconds have passed (forever if None), then returns what's there as a list.
+    # Returns None once the process has closed its output and the queue is empty. Needs <read_queue>.
+    def read_batch(self, count=100, timeout=None):
+        return self._take(count, count, timeout)
+
+    # Private function to take up to <count> samples from the read queue once at least <wanted> are waiting.
+    def _take(self, count, wanted, timeout):
+        if not self.read_queue:
+            self.log.error("read_batch() needs a read queue. Create BSECLibrary with read_queue > 0.")
+            raise BSECLibraryError()
+        queue = self._read_buffer
+        with self._read_ready:
+            if timeout is None:
+                while len(queue) < wanted and not self._read_ended:
+                    self._read_ready.wait()
+            elif timeout > 0:
+                deadline = time.monotonic() + timeout
+                while len(queue) < wanted and not self._read_ended:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._read_ready.wait(remaining)
+            if not queue and self._read_ended:
+                self.log.warning("BSEC-Library ran out of data to yield!")
+                return None
+            batch = []
+            status = 0
+            while queue and len(batch) < count:
+                if queue[0].status != 0 and queue[0].status != '0':
+                    # Stop at a sample with an error status. The samples ahead of it are handed over first,
+                    # then it's taken (and raised) on its own; the samples behind it stay queued.
+                    if not batch:
+                        status = queue.popleft().status
+                    break
+                batch.append(queue.popleft())
+            if self._read_depth is not None:
+                self._read_depth.set(len(queue))
+        self._check_status(status)
+        for sample in batch:
+            sample.sequence = self.sequence
+            self.sequence += 1
+        return batch
+
+    # Private generator to yield the samples from the read queue as they arrive.
+    def _queued_samples(self):
+        while True:
+            batch = self._take(self.read_queue, 1, None)
+            if batch is None:
+                return
+            yield from batch
+
+    # Private function to read the process output on its own thread, as soon as it arrives, into the
+    # read queue. Keeps the pipe empty so the process never blocks writing a sample, however slow the
+    # consumer is. When the queue is full the oldest samples are dropped and counted.
+    # Closes the write end of <wakeup> when it's done.
+    def _read_output(self, proc, wakeup):
+        fd = proc.stdout.fileno()
+        perf_counter = time.perf_counter
+        queue = self._read_buffer
+        try:
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                read_done = perf_counter()
+                monotonic = time.monotonic()
+                # Status and sequence are checked and set as the samples are taken.
+                samples = [Sample.from_dict(data, monotonic, 0) for data in self._decode_buffer(data)]
+                if not samples:
+                    continue
+                if self._parse_time is not None:
+                    parse_time = (perf_counter() - read_done) / len(samples)
+                    for i in range(len(samples)):
+                        self._parse_time.observe(parse_time)
+                with self._read_ready:
+                    dropped = len(queue) + len(samples) - self.read_queue
+                    if dropped > 0:
+                        if not self._read_overflowing:
+                            self._read_overflowing = True
+                            self.read_overflows += 1
+                            if self._read_overflows is not None:
+                                self._read_overflows.inc()
+                            self.log.warning("The read queue is full ({} samples), dropping the oldest.".format(self.read_queue))
+                        self.read_dropped += dropped
+                        if self._read_dropped is not None:
+                            self._read_dropped.inc(dropped)
+                        for i in range(min(dropped, len(queue))):
+                            queue.popleft()
+                        # A single read can hold more than the queue does.
+                        del samples[:-self.read_queue]
+                    else:
+                        self._read_overflowing = False
+                    queue.extend(samples)
+                    if self._read_depth is not None:
+                        self._read_depth.set(len(queue))
+                    self._read_ready.notify_all()
+                    try:
+                        os.write(wakeup[1], b'\0')
+                    except BlockingIOError:
+                        pass
+        except (OSError, ValueError, BSECLibraryError):
+            # The output was closed under us, or couldn't be decoded (already logged).
+            pass
+        finally:
+            with self._read_ready:
+                self._read_ended = True
+                self._read_ready.notify_all()
+            os.close(wakeup[1])
+
+    # Private function to decode the records completed by a chunk of output. Keeps the rest in the read buffer.
+    def _decode_buffer(self, data):
+        buffer = self._buffer + data
+        if self.output_format == 'binary':
+            try:
+                records, consumed = decode_record_buffer(buffer)
+            except BSECLibraryError as e:
+                self.log.error("BSEC-Library output could not be decoded: {}".format(e))
+                raise
+            self._buffer = buffer[consumed:]
+        else:
+            lines = buffer.split(b'\n')
+            self._buffer = lines.pop()
+            records = [dict(json.loads(line.decode('UTF-8'))) for line in lines if line.strip()]
+        return records
+
+    # Private function to read the process' stderr on its own thread until it exits.
+    def _read_errors(self, stderr):
+        with stderr:
+            for line in iter(stderr.readline, b''):
+                self._error_line(line)
+
+    # Private function to handle a line of the process' stderr.
+    # State save reports are counted; anything else is logged.
+    def _error_line(self, line):
+        line = line.decode('UTF-8', 'replace').rstrip()
+        if line.startswith('state saved '):
+            self._state_saved(int(line.split()[2]), float(line.split()[3]))
+        elif line == 'state unchanged':
+            self._state_saved(0, 0.0)
+        elif line:
+            self.log.warning("BSEC-Library: {}".format(line))
+
+    # Private function to count a state save. <length> is 0 if it was skipped because the state was unchanged.
+    def _state_saved(self, length, seconds):
+        if length == 0:
+            self.state_unchanged += 1
+            if self._state_unchanged is not None:
+                self._state_unchanged.inc()
+        else:
+            self.state_writes += 1
+            self.state_write_seconds = seconds
+            if self._state_write_time is not None:
+                self._state_write_time.observe(seconds)
+                self._state_writes.inc()
+            self.log.debug("BSEC-Library saved its state in {:.3f}s.".format(seconds))
+
+    # Private function to check the status of a sample.
+    def _check_status(self, status):
+        if status != 0 and status != '0':
+            if self._status_errors is not None:
+                self._status_errors.inc()
+            # If there's a problem, yo we'll log it...
+            self.log.error("BSEC-Library returned error {}.".format(status))
+            # ...kill the process and hope that resolves it! (Ice, ice, baby.)
+            raise BSECLibraryError()
+
+    # Private generator to decode the line based JSON output.
+    def _decode_json(self):
+        perf_counter = time.perf_counter
+        for line in iter(self.proc.stdout.readline, b''):
+            self._read_done = perf_counter()
+            yield dict(json.loads(line.decode('UTF-8')))
+
+    # Private generator to decode the binary records. Each record's length is in its header.
+    def _decode_binary(self):
+        perf_counter = time.perf_counter
+        read = self.proc.stdout.read
+        header_size = RECORD_HEADER.size
+        while True:
+            header = read(header_size)
+            if len(header) < header_size:
+                return
+            body = read(max(0, header[3] - header_size))
+            if len(body) < header[3] - header_size:
+                return
+            self._read_done = perf_counter()
+            try:
+                data = decode_record(header + body)
+            except BSECLibraryError as e:
+                self.log.error("BSEC-Library output could not be decoded: {}".format(e))
+                raise
+            yield data
+
     # Private function to build the executable. Returns the executable path.
-    def _get_exec(self, src_dir, base_dir):
+    def _get_exec(self, src_dir, base_dir, shared=False):
         def arch():
             # Make sure we're running under Linux.
             system = platform.system()
@@ -200,66 +834,44 @@ class BSECLibrary:
             self.log.error("Encountered an unknown error trying to determine system architecture.")
             raise BSECLibraryError()
 
-        # Build the executable if needed.
-        exec_dst = '{}/bsec-library'.format(base_dir)
-        build_flag = True
-        if os.path.isfile(exec_dst) and os.path.isfile('{}.md5'.format(exec_dst)):
-            with open(exec_dst, 'rb') as f:
-                source_hash = md5(f.read()).hexdigest().strip()
-            with open('{}.md5'.format(exec_dst), 'rt') as f:
-                target_hash = f.read().strip()
-            if target_hash == source_hash:
-                build_flag = False
-                self.log.info('Found existing BSEC-Library executable, skipping build.')
-            else:
-                self.log.warning("BSEC-Library executable and hash file don't match, rebuilding.")
+        # Build the executable (or with <shared>, the shared library) if needed.
+        from bseclib.build import BuildCache, build_key
+        exec_dst = '{}/bsec-library{}'.format(base_dir, '.so' if shared else '')
+        exec_src = '{}/bsec-library.c'.format(src_dir)
+        # If the embedded source has changed, write it out.
+        source_current = self.manifest.file_digest(exec_src, 'sha256') == sha256(bsec_library_c.encode('UTF-8')).hexdigest()
+        if not source_current:
+            self.log.warning("BSEC-Library source file missing or outdated, writing file: {}".format(exec_src))
+            with open(exec_src, 'wb') as f:
+                f.write(bsec_library_c.encode('UTF-8'))
+
+        # The build key covers the C source, the BSEC source tree, the architecture,
+        # the compiler flags and the compiler version.
+        lib_arch = arch()
+        cache = BuildCache(self.cache_dir, logger=self.log.name)
+        inputs = cache.inputs(src_dir, lib_arch, bsec_library_c, manifest=self.manifest, shared=shared)
+        key = build_key(inputs)
+        # The installed executable must still be the one the manifest recorded for this key: same size, mtime and digest.
+        installed = self.manifest.verify_file(exec_dst)
+        if installed is not None and installed.get('key') == key:
+            self.log.info('Found existing BSEC-Library executable, skipping build.')
+            return exec_dst
+        if installed is None and os.path.isfile(exec_dst):
+            self.log.info('BSEC-Library executable changed or not in the startup manifest, reinstalling it.')
+
+        # Try the build cache before compiling.
+        cached = cache.get(key, verify=True)
+        if cached is not None:
+            self.log.info('Found BSEC-Library build [{}] in the build cache.'.format(key[:12]))
         else:
-            self.log.warning('BSEC-Library executable or hash file not found, starting build process.')
-        if build_flag:
-            # See if we need to write the source file.
-            if not os.path.isfile('{}/bsec-library.c'.format(src_dir)):
-                self.log.warning("BSEC-Library source file not found, writing file: {}/bsec-library.c".format(src_dir))
-                with open('{}/bsec-library.c'.format(src_dir), 'wb') as f:
-                    f.write(bsec_library_c.encode('UTF-8'))
-
-            lib_arch = arch()
-            # Generate the build command.
-            build_command = [
-                'cc',
-                '-Wall',
-                '-Wno-unused-but-set-variable',
-                '-Wno-unused-variable',
-                '-static',
-                '-iquote{}/API'.format(src_dir),
-                '-iquote{}/algo/{}'.format(src_dir, lib_arch),
-                '-iquote{}/examples'.format(src_dir),
-                '{}/API/bme680.c'.format(src_dir),
-                '{}/examples/bsec_integration.c'.format(src_dir),
-                '{}/bsec-library.c'.format(src_dir),
-                '-L{}/algo/{}'.format(src_dir, lib_arch),
-                '-lalgobsec',
-                '-lm',
-                '-lrt',
-                '-o',
-                exec_dst
-            ]
-            # Run the build process.
-            build_process = subprocess.run(build_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-            # Check for errors.
-            if build_process.returncode != 0:
-                build_error = build_process.stdout.decode()
-                self.log.error('Encountered an error during the build process!')
-                self.log.error(build_error)
-                raise BSECLibraryError()
-            else:
-                self.log.info("Build process complete.")
+            self.log.warning('BSEC-Library build [{}] not found, starting build process.'.format(key[:12]))
+            cached = cache.build(key, inputs, src_dir, exec_src, lib_arch, shared=shared)
+            self.log.info("Build process complete.")
 
-            # Write an MD5SUM of the executable.
-            with open(exec_dst, 'rb') as f:
-                exec_md5 = md5(f.read()).hexdigest()
-            with open('{}.md5'.format(exec_dst), 'wt') as f:
-                f.write(exec_md5)
+        # Copy the executable into place and record it, with its key, in the startup manifest.
+        copy2(cached, '{}.tmp'.format(exec_dst))
+        os.replace('{}.tmp'.format(exec_dst), exec_dst)
+        self.manifest.record_file(exec_dst, key=key)
 
         return exec_dst
 
@@ -277,11 +889,7 @@ class BSECLibrary:
             'a401d7712179350a7b6ff6fc035d49c2': {'string': 'generic_33v_3s_28d', 'voltage': 3.3, 'sample rate': 3, 'retain state': 28},
             '1107f7ce9fcb414de64e899babc1a1ee': {'string': 'generic_33v_3s_4d', 'voltage': 3.3, 'sample rate': 3, 'retain state': 4}
         }
-        try:
-            with open(config_dst, 'rb') as f:
-                hash = md5(f.read()).hexdigest().lower()
-        except FileNotFoundError:
-            hash = None
+        hash = self.manifest.file_digest(config_dst, 'md5')
 
         if hash in config_hash_table and config_hash_table[hash]['string'] == config:
             self.log.info("Using existing BSEC-Library configuration [{}].".format(config))
@@ -343,6 +951,8 @@ bsec_library_c = """/* Copyright (C) 2017 alexh.name */
 #include <string.h>
 #include <unistd.h>
 #include <inttypes.h>
+#include <signal.h>
+#include <setjmp.h>
 #include <sys/ioctl.h>
 #include <sys/types.h>
 #include <sys/stat.h>
@@ -355,16 +965,60 @@ int g_i2cFid; // I2C Linux device handle
 int i2c_address; // Changed from #define to argv[1].
 float temp_offset; // Changed from #define to argv[2].
 float sample_rate_mode; // Changed from #define to argv[3].
+int output_binary = 0; // Optional argv[4], JSON lines (default) or binary records.
+uint32_t output_sequence = 0; // Counts every output, so the reader can spot dropped samples.
+char *i2c_device = "/dev/i2c-1"; // Optional argv[5].
+uint16_t output_fields = 0x1F; // Optional argv[6], mask of the outputs to send (see OUTPUT_FIELDS in bseclib).
 char *filename_state = "bsec-library.state";
+char *filename_state_tmp = "bsec-library.state.tmp";
+uint32_t state_interval = 3600; // Optional argv[7], seconds between state saves (0 only saves on exit).
+int state_fsync = 1; // Optional argv[8], fsync the state file and its directory when saving.
+uint8_t last_state[BSEC_MAX_STATE_BLOB_SIZE]; // The state as last loaded or saved, so unchanged states aren't written.
+uint32_t last_state_length = 0;
+int64_t last_state_check = 0; // get_timestamp_us() of the last save (or skipped save).
+char *state_dir = "."; // Directory holding the state file, to fsync after renaming it.
+#ifdef BSEC_SHARED
+/* Built as a shared library (see bseclib.shared): samples and state saves
+ * are handed to callbacks instead of being written to stdout and stderr. */
+typedef void (*sample_callback_fct)(int64_t timestamp, uint32_t sequence, uint8_t iaq_accuracy,
+                                    const float *values, int32_t bsec_status);
+typedef void (*state_callback_fct)(uint32_t length, double seconds);
+sample_callback_fct sample_callback = NULL;
+state_callback_fct state_callback = NULL;
+jmp_buf stop_jump; // Where finish() returns to, as exit() would take the host process with it.
+int stop_status = 0;
+#endif
 char *filename_config = "bsec-library.config";
+volatile sig_atomic_t stop_requested = 0; // Set by SIGTERM/SIGINT, acted on at the next sleep.
+int state_ready = 0; // Set once BSEC is initialized, so there's a state worth saving.
 /* functions */
+/*
+ * Stop with the given status: exit() as a program, return from bsec_run()
+ * as a shared library.
+ *
+ * param[in]       status          exit status
+ *
+ * return          none
+ */
+void finish(int status)
+{
+#ifdef BSEC_SHARED
+  stop_status = status;
+  longjmp(stop_jump, 1);
+#else
+  exit(status);
+#endif
+}
+int64_t get_timestamp_us();
+void save_state();
+void save_state_and_exit();
 // open the Linux device
 void i2cOpen()
 {
-  g_i2cFid = open("/dev/i2c-1", O_RDWR);
+  g_i2cFid = open(i2c_device, O_RDWR);
   if (g_i2cFid < 0) {
     perror("i2cOpen");
-    exit(1);
+    finish(1);
   }
 }
 // close the Linux device
@@ -377,7 +1031,7 @@ void i2cSetAddress(int address)
 {
   if (ioctl(g_i2cFid, I2C_SLAVE, address) < 0) {
     perror("i2cSetAddress");
-    exit(1);
+    finish(1);
   }
 }
 /*
@@ -401,7 +1055,7 @@ int8_t bus_write(uint8_t dev_addr, uint8_t reg_addr, uint8_t *reg_data_ptr,
   if (write(g_i2cFid, reg, data_len+1) != data_len+1) {
     perror("user_i2c_write");
     rslt = 1;
-    exit(1);
+    finish(1);
   }
   return rslt;
 }
@@ -442,10 +1096,18 @@ int8_t bus_read(uint8_t dev_addr, uint8_t reg_addr, uint8_t *reg_data_ptr,
 void _sleep(uint32_t t_ms)
 {
   struct timespec ts;
+  if (stop_requested) save_state_and_exit();
+  /* Between steps is the only safe time to fetch the state. */
+  if (state_ready && state_interval > 0 && get_timestamp_us() - last_state_check >= (int64_t)state_interval * 1000000)
+    {
+      save_state();
+    }
   ts.tv_sec = 0;
   /* mod because nsec must be in the range 0 to 999999999 */
   ts.tv_nsec = (t_ms % 1000) * 1000000L;
+  /* A signal cuts the sleep short, so we stop right away. */
   nanosleep(&ts, NULL);
+  if (stop_requested) save_state_and_exit();
 }
 /*
  * Capture the system time in microseconds
@@ -463,10 +1125,89 @@ int64_t get_timestamp_us()
   int64_t system_current_time_us = system_current_time_ns / 1000;
   return system_current_time_us;
 }
+/*
+ * Little-endian encoding helpers for the binary record format
+ */
+#define RECORD_MAGIC 0xB5EC
+#define RECORD_VERSION 3
+#define RECORD_FIXED_SIZE 22
+/*
+ * Outputs that can be sent, in the order of OUTPUT_FIELDS in bseclib. Bit n of
+ * output_fields selects output n.
+ */
+#define OUTPUT_COUNT 10
+static const char *output_names[OUTPUT_COUNT] = {
+  "IAQ", "Temperature", "Humidity", "Pressure", "Gas", "Static_IAQ",
+  "CO2_Equivalent", "Breath_VOC_Equivalent", "Raw_Temperature", "Raw_Humidity"
+};
+static const int output_decimals[OUTPUT_COUNT] = {2, 2, 2, 2, 0, 2, 2, 3, 2, 2};
+static uint8_t *put_u16(uint8_t *p, uint16_t v)
+{
+  p[0] = v & 0xFF;
+  p[1] = (v >> 8) & 0xFF;
+  return p + 2;
+}
+static uint8_t *put_u32(uint8_t *p, uint32_t v)
+{
+  p[0] = v & 0xFF;
+  p[1] = (v >> 8) & 0xFF;
+  p[2] = (v >> 16) & 0xFF;
+  p[3] = (v >> 24) & 0xFF;
+  return p + 4;
+}
+static uint8_t *put_u64(uint8_t *p, uint64_t v)
+{
+  p = put_u32(p, (uint32_t)(v & 0xFFFFFFFF));
+  return put_u32(p, (uint32_t)(v >> 32));
+}
+static uint8_t *put_f32(uint8_t *p, float f)
+{
+  uint32_t v;
+  memcpy(&v, &f, sizeof(v));
+  return put_u32(p, v);
+}
+/*
+ * Write one binary record to stdout with a single write() call
+ *
+ * Layout (little-endian): magic u16, version u8, length u8, status i16,
+ * iaq_accuracy u8, pad u8, output_fields u16, timestamp i64 (CLOCK_MONOTONIC
+ * ns), sequence u32, then one f32 per output selected by output_fields.
+ * Keep in sync with RECORD_* in bseclib.
+ *
+ * param[in]       values          every output, in output_names order
+ *
+ * return          none
+ */
+void write_record(int64_t timestamp, uint32_t sequence, uint8_t iaq_accuracy,
+                  const float *values, bsec_library_return_t bsec_status)
+{
+  uint8_t record[RECORD_FIXED_SIZE + 4 * OUTPUT_COUNT];
+  uint8_t *p = record + 4;
+  int i;
+  p = put_u16(p, (uint16_t)(int16_t)bsec_status);
+  *p++ = iaq_accuracy;
+  *p++ = 0;
+  p = put_u16(p, output_fields);
+  p = put_u64(p, (uint64_t)timestamp);
+  p = put_u32(p, sequence);
+  for (i = 0; i < OUTPUT_COUNT; i++) {
+    if (output_fields & (1 << i)) {
+      p = put_f32(p, values[i]);
+    }
+  }
+  size_t length = p - record;
+  p = put_u16(record, RECORD_MAGIC);
+  *p++ = RECORD_VERSION;
+  *p++ = (uint8_t)length;
+  if (write(STDOUT_FILENO, record, length) != (ssize_t)length) {
+    perror("write_record");
+    finish(1);
+  }
+}
 /*
  * Handling of the ready outputs
  *
- * param[in]       timestamp       time in microseconds
+ * param[in]       timestamp       CLOCK_MONOTONIC time in nanoseconds
  * param[in]       iaq             IAQ signal
  * param[in]       iaq_accuracy    accuracy of IAQ signal
  * param[in]       temperature     temperature signal
@@ -476,6 +1217,9 @@ int64_t get_timestamp_us()
  * param[in]       raw_humidity    raw humidity signal
  * param[in]       gas             raw gas sensor signal
  * param[in]       bsec_status     value returned by the bsec_do_steps() call
+ * param[in]       static_iaq      unscaled IAQ signal
+ * param[in]       co2_equivalent  CO2 equivalent estimate [ppm]
+ * param[in]       breath_voc_equivalent breath VOC concentration estimate [ppm]
  *
  * return          none
  */
@@ -486,21 +1230,30 @@ void output_ready(int64_t timestamp, float iaq, uint8_t iaq_accuracy,
                   float static_iaq, float co2_equivalent,
                   float breath_voc_equivalent)
 {
-  //int64_t timestamp_s = timestamp / 1000000000;
-  ////int64_t timestamp_ms = timestamp / 1000;
-  //time_t t = timestamp_s;
-  /*
-   * timestamp for localtime only makes sense if get_timestamp_us() uses
-   * CLOCK_REALTIME
-   */
-  time_t t = time(NULL);
-  struct tm tm = *localtime(&t);
+  uint32_t sequence = output_sequence++;
+  float values[OUTPUT_COUNT] = {iaq, temperature, humidity, pressure / 100, gas,
+                                static_iaq, co2_equivalent,
+                                breath_voc_equivalent, raw_temperature,
+                                raw_humidity};
+  int i;
+#ifdef BSEC_SHARED
+  if (sample_callback != NULL) {
+    sample_callback(timestamp, sequence, iaq_accuracy, values, bsec_status);
+    return;
+  }
+#endif
+  if (output_binary) {
+    write_record(timestamp, sequence, iaq_accuracy, values, bsec_status);
+    return;
+  }
   printf("{\\"IAQ_Accuracy\\": \\"%d\\"", iaq_accuracy);
-  printf(", \\"IAQ\\": \\"%.2f\\"", iaq);
-  printf(", \\"Temperature\\": \\"%.2f\\"", temperature);
-  printf(", \\"Humidity\\": \\"%.2f\\"", humidity);
-  printf(", \\"Pressure\\": \\"%.2f\\"", pressure / 100);
-  printf(", \\"Gas\\": \\"%.0f\\"", gas);
+  for (i = 0; i < OUTPUT_COUNT; i++) {
+    if (output_fields & (1 << i)) {
+      printf(", \\"%s\\": \\"%.*f\\"", output_names[i], output_decimals[i], values[i]);
+    }
+  }
+  printf(", \\"Timestamp\\": \\"%" PRId64 "\\"", timestamp);
+  printf(", \\"Sequence\\": \\"%" PRIu32 "\\"", sequence);
   printf(", \\"Status\\": \\"%d\\"}", bsec_status);
   printf("\\r\\n");
   fflush(stdout);
@@ -560,11 +1313,47 @@ uint32_t state_load(uint8_t *state_buffer, uint32_t n_buffer)
 {
   int32_t rslt = 0;
   rslt = binary_load(state_buffer, n_buffer, filename_state, 0);
+  if (rslt > 0 && rslt <= (int32_t)sizeof(last_state))
+    {
+      memcpy(last_state, state_buffer, rslt);
+      last_state_length = rslt;
+    }
   return rslt;
 }
+/*
+ * Report a state save: on stderr as "state saved <bytes> <seconds>" or
+ * "state unchanged", or to the state callback as a shared library.
+ *
+ * param[in]       length          bytes written, or zero if the state was unchanged
+ * param[in]       seconds         time taken to write it
+ *
+ * return          none
+ */
+void report_state(uint32_t length, double seconds)
+{
+#ifdef BSEC_SHARED
+  if (state_callback != NULL)
+    {
+      state_callback(length, seconds);
+      return;
+    }
+#endif
+  if (length == 0)
+    {
+      fprintf(stderr, "state unchanged\\n");
+    }
+  else
+    {
+      fprintf(stderr, "state saved %" PRIu32 " %.6f\\n", length, seconds);
+    }
+}
 /*
  * Save library state to non-volatile memory
  *
+ * The state is written to a temporary file which is renamed over the old
+ * one, so a power cut leaves either the old or the new state, never half
+ * of one. Each save is reported with report_state().
+ *
  * param[in]       state_buffer    buffer holding the state to be stored
  * param[in]       length          length of the state string to be stored
  *
@@ -572,10 +1361,99 @@ uint32_t state_load(uint8_t *state_buffer, uint32_t n_buffer)
  */
 void state_save(const uint8_t *state_buffer, uint32_t length)
 {
-  FILE *state_w_ptr;
-  state_w_ptr = fopen(filename_state,"wb");
-  fwrite(state_buffer,length,1,state_w_ptr);
-  fclose(state_w_ptr);
+  int fd;
+  int64_t started = get_timestamp_us();
+  fd = open(filename_state_tmp, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+  if (fd < 0)
+    {
+      perror("state_save");
+      return;
+    }
+  if (write(fd, state_buffer, length) != (ssize_t)length || (state_fsync && fsync(fd) != 0))
+    {
+      perror("state_save");
+      close(fd);
+      unlink(filename_state_tmp);
+      return;
+    }
+  if (close(fd) != 0 || rename(filename_state_tmp, filename_state) != 0)
+    {
+      perror("state_save");
+      unlink(filename_state_tmp);
+      return;
+    }
+  if (state_fsync)
+    {
+      /* Make the rename itself durable. */
+      fd = open(state_dir, O_RDONLY);
+      if (fd >= 0)
+        {
+          fsync(fd);
+          close(fd);
+        }
+    }
+  if (length <= sizeof(last_state))
+    {
+      memcpy(last_state, state_buffer, length);
+      last_state_length = length;
+    }
+  report_state(length, (get_timestamp_us() - started) / 1e6);
+}
+/*
+ * Fetch the current library state and save it if it changed since it was
+ * last loaded or saved. Only called between steps, so the state is
+ * consistent. Skipped saves are reported too.
+ *
+ * return          none
+ */
+void save_state()
+{
+  uint8_t state[BSEC_MAX_STATE_BLOB_SIZE];
+  uint8_t work_buffer[BSEC_MAX_PROPERTY_BLOB_SIZE];
+  uint32_t n_state = 0;
+  bsec_library_return_t status;
+  last_state_check = get_timestamp_us();
+  status = bsec_get_state(0, state, sizeof(state), work_buffer, sizeof(work_buffer), &n_state);
+  if (status != BSEC_OK || n_state == 0)
+    {
+      fprintf(stderr, "Error: bsec_get_state() returned %d, state not saved.\\n", (int)status);
+    }
+  else if (n_state == last_state_length && memcmp(state, last_state, n_state) == 0)
+    {
+      report_state(0, 0);
+    }
+  else
+    {
+      state_save(state, n_state);
+    }
+}
+/*
+ * Signal handler for SIGTERM and SIGINT. BSEC may be in the middle of a
+ * step, so only set a flag; the next call to _sleep() does the rest.
+ *
+ * param[in]       signum          signal number
+ *
+ * return          none
+ */
+void request_stop(int signum)
+{
+  stop_requested = 1;
+}
+/*
+ * Save the current library state and exit. Only called from _sleep(), which
+ * runs between steps, so the state is consistent.
+ *
+ * return          none
+ */
+void save_state_and_exit()
+{
+  if (state_ready)
+    {
+      save_state();
+    }
+  fflush(stdout);
+  i2cClose();
+  finish(0);
 }
 /*
  * Load library config from non-volatile memory
@@ -599,14 +1477,18 @@ uint32_t config_load(uint8_t *config_buffer, uint32_t n_buffer)
 /* main */
 /*
  * Main function which configures BSEC library and then reads and processes
- * the data from sensor based on timer ticks
+ * the data from sensor based on timer ticks. Called by main(), or by
+ * bsec_run() as a shared library.
  *
  * return      result of the processing
  */
-int main(int argc, char *argv[])
+int run(int argc, char *argv[])
 {
   //putenv(DESTZONE); // Now taken care of in the Python controller.
-  if (argc == 4)
+  output_sequence = 0;
+  state_ready = 0;
+  last_state_length = 0;
+  if (argc >= 4 && argc <= 9)
     {
       i2c_address = atoi (argv[1]);
       if (i2c_address < 118 || i2c_address > 119)
@@ -633,14 +1515,66 @@ int main(int argc, char *argv[])
           printf("Error: '%s' isn't a valid option for argument <sample_rate_mode>.\\nValid Options: LP|ULP\\n", argv[3]);
           return 1;
         }
+      if (argc >= 5 && strcmp(argv[4], "BIN") == 0)
+        {
+          output_binary = 1;
+        }
+      else if (argc >= 5 && strcmp(argv[4], "JSON") != 0)
+        {
+          printf("Error: '%s' isn't a valid option for argument <output_format>.\\nValid Options: JSON|BIN\\n", argv[4]);
+          return 1;
+        }
+      if (argc >= 6)
+        {
+          i2c_device = argv[5];
+        }
+      if (argc >= 7)
+        {
+          long fields = strtol(argv[6], NULL, 0);
+          if (fields < 1 || fields >= (1 << OUTPUT_COUNT))
+            {
+              printf("Error: '%s' isn't a valid mask for argument <output_fields>.\\nValid Range: 1 to %d\\n", argv[6], (1 << OUTPUT_COUNT) - 1);
+              return 1;
+            }
+          output_fields = (uint16_t)fields;
+        }
+      if (argc >= 8)
+        {
+          long interval = strtol(argv[7], NULL, 10);
+          if (interval < 0 || interval > 31536000)
+            {
+              printf("Error: '%s' is outside of the valid range for argument <state_interval>.\\nValid Range: 0 to 31536000\\n", argv[7]);
+              return 1;
+            }
+          state_interval = (uint32_t)interval;
+        }
+      if (argc == 9)
+        {
+          state_fsync = atoi(argv[8]) != 0;
+        }
     }
   else
     {
       printf("Usage:\\n");
-      printf("  %s <i2c_address> <temp_offset> <sample_rate_mode>\\n", argv[0]);
-      printf("       i2c_address: 118|119\\n       temp_offset: 10.0 to -10.0\\n  sample_rate_mode: LP|ULP\\n");
+      printf("  %s <i2c_address> <temp_offset> <sample_rate_mode> [output_format] [i2c_device] [output_fields] [state_interval] [state_fsync]\\n", argv[0]);
+      printf("       i2c_address: 118|119\\n       temp_offset: 10.0 to -10.0\\n  sample_rate_mode: LP|ULP\\n     output_format: JSON|BIN\\n        i2c_device: /dev/i2c-1 (default)\\n     output_fields: 31 (default, IAQ to Gas)\\n    state_interval: 3600 (default, seconds, 0 only saves on exit)\\n       state_fsync: 1 (default)|0\\n");
       return 1;
     }
+#ifdef BSEC_SHARED
+  /* finish() jumps back here. The host process owns the signals; it stops us with bsec_stop(). */
+  if (setjmp(stop_jump))
+    {
+      return stop_status;
+    }
+#else
+  /* Stop cleanly (saving the state) on SIGTERM and SIGINT. */
+  struct sigaction action;
+  memset(&action, 0, sizeof(action));
+  action.sa_handler = request_stop;
+  sigemptyset(&action.sa_mask);
+  sigaction(SIGTERM, &action, NULL);
+  sigaction(SIGINT, &action, NULL);
+#endif
   i2cOpen();
   i2cSetAddress(i2c_address);
   return_values_init ret;
@@ -653,16 +1587,72 @@ int main(int argc, char *argv[])
     /* Could not intialize BSEC library */
     return (int)ret.bsec_status;
   }
+  state_ready = 1;
   /* Call to endless loop function which reads and processes data based on
    * sensor settings.
-   * State is saved every 10.000 samples, which means every 10.000 * 3 secs
-   * = 500 minutes (depending on the config).
+   * The loop's own sample-counted saves are switched off; _sleep() saves the
+   * state every <state_interval> seconds instead, and when we're stopped.
    *
    */
-  bsec_iot_loop(_sleep, get_timestamp_us, output_ready, state_save, 10000);
+  last_state_check = get_timestamp_us();
+  bsec_iot_loop(_sleep, get_timestamp_us, output_ready, state_save, UINT32_MAX);
   i2cClose();
   return 0;
 }
+#ifdef BSEC_SHARED
+/*
+ * Shared library entry point. Runs the sensor loop on the calling thread
+ * until bsec_stop() is called or an error stops it.
+ *
+ * param[in]       argc, argv      the same arguments as the program takes
+ * param[in]       dir             directory holding the config and state files
+ * param[in]       on_sample       called with every output (all OUTPUT_COUNT values)
+ * param[in]       on_state        called with every state save
+ *
+ * return          result of the processing
+ */
+int bsec_run(int argc, char *argv[], const char *dir, sample_callback_fct on_sample, state_callback_fct on_state)
+{
+  static char path_state[4096], path_state_tmp[4096], path_config[4096], path_dir[4096];
+  snprintf(path_state, sizeof(path_state), "%s/bsec-library.state", dir);
+  snprintf(path_state_tmp, sizeof(path_state_tmp), "%s/bsec-library.state.tmp", dir);
+  snprintf(path_config, sizeof(path_config), "%s/bsec-library.config", dir);
+  snprintf(path_dir, sizeof(path_dir), "%s", dir);
+  filename_state = path_state;
+  filename_state_tmp = path_state_tmp;
+  filename_config = path_config;
+  state_dir = path_dir;
+  sample_callback = on_sample;
+  state_callback = on_state;
+  return run(argc, argv);
+}
+/*
+ * Ask bsec_run() to save the state and return. Safe to call from any
+ * thread; takes effect at the next sleep.
+ *
+ * return          none
+ */
+void bsec_stop()
+{
+  stop_requested = 1;
+}
+/*
+ * Clear the stop requested by bsec_stop() before the next bsec_run(). The
+ * host calls this before starting the thread, not bsec_run() itself, so a
+ * bsec_stop() made while the thread is starting isn't lost.
+ *
+ * return          none
+ */
+void bsec_reset()
+{
+  stop_requested = 0;
+}
+#else
+int main(int argc, char *argv[])
+{
+  return run(argc, argv);
+}
+#endif
 """
 if __name__ == "__main__":
     logging.critical("This module cannot not run standalone.")
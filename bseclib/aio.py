@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+# AsyncBSECLibrary - (C) 2018 TimothyBrown
+asyncio variant of BSECLibrary, for running the sensor stream inside an event loop.
+MIT License
+"""
+
+import asyncio
+import json
+import signal
+import time
+from bseclib import BSECLibrary, BSECLibraryError, Sample, RECORD_HEADER, decode_record
+
+class AsyncBSECLibrary(BSECLibrary):
+    """Handles communication with a BME680 from asyncio, using asyncio.create_subprocess_exec()."""
+
+    # Takes the same arguments as BSECLibrary, except <read_queue>: the event loop already reads the pipe
+    # as data arrives. Use as `async with AsyncBSECLibrary(...) as bsec_lib:`.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.read_queue:
+            self.log.info("AsyncBSECLibrary reads its output from the event loop; ignoring read_queue.")
+            self.read_queue = 0
+        self._errors = None
+        self._terminating = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.proc is not None:
+            await self.close()
+
+    # Coroutine to start the bsec-library process.
+    async def open(self):
+        if self.proc is not None:
+            self.log.warning("BSEC-Library is already running!")
+        else:
+            run_command = self._run_command()
+            self.log.warning(run_command)
+            # The process looks for its config and state files in the working directory.
+            self.proc = await asyncio.create_subprocess_exec(*run_command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                             env=self._run_env(), cwd=self.base_dir)
+            self.sequence = 0
+            self._errors = asyncio.ensure_future(self._aread_errors(self.proc.stderr))
+            if self.proc.returncode is not None:
+                self.log.error('BSEC-Library encountered an error ({}) during startup.'.format(self.proc.returncode))
+                raise BSECLibraryError()
+            else:
+                self.log.info('BSEC-Library started.')
+
+    # Coroutine to stop the bsec-library process.
+    # Waits up to <timeout> seconds for it to exit before killing it.
+    async def close(self, timeout=5):
+        if self.proc is None:
+            self.log.warning("BSEC-Library is not running!")
+        else:
+            proc = self.proc
+            self.proc = None
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
+                await self._await_exit(proc, timeout)
+            # The state save report is the last thing on stderr; let the reader count it.
+            if self._errors is not None:
+                try:
+                    await asyncio.wait_for(self._errors, timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._errors = None
+            self.log.info("BSEC-Library stopped.")
+
+    # Function to ask the bsec-library process to save its state and exit, without waiting.
+    # Call it from the event loop (i.e. from loop.add_signal_handler()) while aoutput() is being read:
+    # the output ends once the process has exited. Killed if it's still running after <timeout> seconds.
+    def terminate(self, timeout=5):
+        proc = self.proc
+        if proc is not None and proc.returncode is None:
+            proc.send_signal(signal.SIGTERM)
+            self._terminating = asyncio.ensure_future(self._await_exit(proc, timeout))
+
+    # Private coroutine to wait for the process to exit, killing it after <timeout> seconds.
+    async def _await_exit(self, proc, timeout):
+        try:
+            await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.log.warning("BSEC-Library didn't exit after {}s, killing it.".format(timeout))
+            proc.kill()
+            await proc.wait()
+
+    # The blocking readers of BSECLibrary can't read an asyncio process; use aoutput() and asamples() instead.
+    def output(self):
+        self._not_async('output()', 'aoutput()')
+
+    def samples(self):
+        self._not_async('samples()', 'asamples()')
+
+    def fileno(self):
+        self._not_async('fileno()', 'asamples()')
+
+    def read_available(self):
+        self._not_async('read_available()', 'asamples()')
+
+    def read_batch(self, count=100, timeout=None):
+        self._not_async('read_batch()', 'asamples()')
+
+    # Private function to report a BSECLibrary method that AsyncBSECLibrary doesn't support.
+    def _not_async(self, method, instead):
+        self.log.error("AsyncBSECLibrary doesn't support {}; use {} instead.".format(method, instead))
+        raise BSECLibraryError()
+
+    # Private coroutine to read the process' stderr until it exits, like BSECLibrary._read_errors().
+    async def _aread_errors(self, stderr):
+        while True:
+            line = await stderr.readline()
+            if not line:
+                break
+            self._error_line(line)
+
+    # Async generator to iterate over the output.
+    # In 'json' mode each value is a string, in 'binary' mode each value is a number.
+    async def aoutput(self):
+        if self.proc is None:
+            self.log.warning("No data to to parse! Have you started the BSEC-Library process?")
+            return
+        stdout = self.proc.stdout
+        while True:
+            if self.output_format == 'binary':
+                try:
+                    header = await stdout.readexactly(RECORD_HEADER.size)
+                    body = await stdout.readexactly(max(0, header[3] - RECORD_HEADER.size))
+                except asyncio.IncompleteReadError:
+                    break
+                self._read_done = time.perf_counter()
+                try:
+                    data = decode_record(header + body)
+                except BSECLibraryError as e:
+                    self.log.error("BSEC-Library output could not be decoded: {}".format(e))
+                    raise
+            else:
+                line = await stdout.readline()
+                if not line:
+                    break
+                self._read_done = time.perf_counter()
+                data = dict(json.loads(line.decode('UTF-8')))
+            self._check_status(data['Status'])
+            yield data
+        self.log.warning("BSEC-Library ran out of data to yield!")
+
+    # Async generator to iterate over the output as Sample objects.
+    async def asamples(self):
+        from_dict = Sample.from_dict
+        monotonic = time.monotonic
+        parse_time = self._parse_time
+        async for data in self.aoutput():
+            sample = from_dict(data, monotonic(), self.sequence)
+            if parse_time is not None:
+                parse_time.observe(time.perf_counter() - self._read_done)
+            self.sequence += 1
+            yield sample
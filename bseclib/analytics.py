@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+# BSECLibrary Window Analytics - (C) 2018 TimothyBrown
+Percentiles, median, standard deviation, EMA, trend slope and rate of change
+over the samples of a window. Uses preallocated NumPy ring arrays when NumPy
+is installed, and plain Python otherwise.
+MIT License
+"""
+
+import logging
+from math import fsum, sqrt
+from collections import deque
+from bseclib import BSECLibraryError, OUTPUT_KEYS
+from bseclib.window import publish_value
+
+# NumPy is optional.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Statistics that can be asked for, besides percentiles written as p<0-100> (i.e. p95).
+# median, p<n>, ema: In the field's units.
+# stdev: Sample standard deviation, in the field's units.
+# slope: Least squares trend, in the field's units per minute.
+# rate: Change from the first to the last value, in percent of the first value per minute.
+ANALYTICS_STATS = ('median', 'stdev', 'ema', 'slope', 'rate')
+
+class WindowAnalytics:
+    """Extra statistics over the last samples of a window, for a set of fields."""
+
+    # stats: Dict of Sample attribute name to the statistics wanted for it, i.e. {'iaq': ('median', 'slope')}.
+    # capacity: Most samples kept, in a ring.
+    # window: If set, only samples from the last <window> seconds of sensor time are used.
+    # ema_alpha: Smoothing factor of the exponential moving average (0 < ema_alpha <= 1).
+    # backend: 'numpy', 'python', or None to use NumPy if it's installed.
+    def __init__(self, stats, capacity, window=None, ema_alpha=0.1, backend=None, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+
+        if backend is None:
+            backend = 'numpy' if numpy is not None else 'python'
+        if backend != 'numpy' and backend != 'python':
+            self.log.error("Error: <backend> must be one of 'numpy' or 'python'.")
+            raise BSECLibraryError()
+        if backend == 'numpy' and numpy is None:
+            self.log.error("Error: The numpy backend needs NumPy, which isn't installed.")
+            raise BSECLibraryError()
+        if capacity < 2:
+            self.log.error("Error: <capacity> must be at least 2.")
+            raise BSECLibraryError()
+        if not 0 < ema_alpha <= 1:
+            self.log.error("Error: <ema_alpha> must be more than 0 and at most 1.")
+            raise BSECLibraryError()
+        for field, names in stats.items():
+            if field not in OUTPUT_KEYS:
+                self.log.error("Error: <stats> has an unknown field: {}".format(field))
+                raise BSECLibraryError()
+            for name in names:
+                if not is_stat(name):
+                    self.log.error("Error: <stats> has an unknown statistic for {}: {} (Choose from: {}, or p0 to p100)".format(field, name, ', '.join(ANALYTICS_STATS)))
+                    raise BSECLibraryError()
+        self.stats = {field: tuple(names) for field, names in stats.items() if names}
+        self.fields = tuple(self.stats)
+        self.capacity = capacity
+        self.window = window
+        self.ema_alpha = ema_alpha
+        self.backend = backend
+        self.reset()
+
+    # Function to clear the samples.
+    def reset(self):
+        self.count = 0
+        if self.backend == 'numpy':
+            # One row per sample, one column per field, plus the sample times.
+            self._values = numpy.empty((self.capacity, len(self.fields)))
+            self._times = numpy.empty(self.capacity)
+            self._next = 0
+        else:
+            self._values = [deque(maxlen=self.capacity) for field in self.fields]
+            self._times = deque(maxlen=self.capacity)
+
+    # Function to add a Sample. Its time is the sensor time, or the timestamp if there isn't one.
+    def add(self, sample):
+        now = sample.sensor_time if sample.sensor_time is not None else sample.timestamp
+        if self.backend == 'numpy':
+            index = self._next
+            self._values[index] = [getattr(sample, field) for field in self.fields]
+            self._times[index] = now
+            self._next = (index + 1) % self.capacity
+        else:
+            for values, field in zip(self._values, self.fields):
+                values.append(getattr(sample, field))
+            self._times.append(now)
+        if self.count < self.capacity:
+            self.count += 1
+
+    # Function to compute the statistics. Returns {field: {stat: value}}, in the sensor's units.
+    # A statistic that needs more samples (or time) than the window has is None.
+    def compute(self):
+        if self.count == 0:
+            return {}
+        if self.backend == 'numpy':
+            return self._compute_numpy()
+        return self._compute_python()
+
+    # Private function to compute every statistic for all the fields at once.
+    def _compute_numpy(self):
+        # The samples in order, oldest first.
+        if self.count < self.capacity:
+            values, times = self._values[:self.count], self._times[:self.count]
+        else:
+            values = numpy.concatenate((self._values[self._next:], self._values[:self._next]))
+            times = numpy.concatenate((self._times[self._next:], self._times[:self._next]))
+        if self.window is not None:
+            recent = times > times[-1] - self.window
+            values, times = values[recent], times[recent]
+        count = len(times)
+        wanted = set(name for names in self.stats.values() for name in names)
+        results = {}
+
+        percentiles = sorted(set(_percentile(name) for name in wanted if _percentile(name) is not None))
+        if percentiles:
+            for q, row in zip(percentiles, numpy.percentile(values, percentiles, axis=0)):
+                results[q] = row
+        if 'stdev' in wanted and count > 1:
+            results['stdev'] = values.std(axis=0, ddof=1)
+        if 'ema' in wanted:
+            # The EMA started at the first value, as a weighted sum: the newest value has weight
+            # alpha, each older one (1 - alpha) times less, and the first one the rest.
+            alpha = self.ema_alpha
+            weights = alpha * (1 - alpha) ** numpy.arange(count - 1, -1, -1)
+            weights[0] = (1 - alpha) ** (count - 1)
+            results['ema'] = weights @ values
+        elapsed = times[-1] - times[0]
+        if 'slope' in wanted and count > 1 and elapsed > 0:
+            offsets = times - times.mean()
+            results['slope'] = offsets @ (values - values.mean(axis=0)) / (offsets @ offsets) * 60
+        if 'rate' in wanted and count > 1 and elapsed > 0:
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                rate = (values[-1] - values[0]) / numpy.abs(values[0]) * 100 / (elapsed / 60)
+            results['rate'] = numpy.where(values[0] != 0, rate, numpy.nan)
+
+        output = {}
+        for column, field in enumerate(self.fields):
+            output[field] = {}
+            for name in self.stats[field]:
+                key = _percentile(name) if name.startswith('p') or name == 'median' else name
+                row = results.get(key)
+                value = None if row is None else float(row[column])
+                output[field][name] = None if value is None or value != value else value
+        return output
+
+    # Private function to compute the statistics one field at a time, without NumPy.
+    def _compute_python(self):
+        times = list(self._times)
+        first = 0
+        if self.window is not None:
+            cutoff = times[-1] - self.window
+            while times[first] <= cutoff:
+                first += 1
+            times = times[first:]
+        count = len(times)
+        elapsed = times[-1] - times[0]
+        mean_time = fsum(times) / count
+        output = {}
+        for values, field in zip(self._values, self.fields):
+            values = list(values)[first:]
+            mean = fsum(values) / count
+            ordered = None
+            output[field] = {}
+            for name in self.stats[field]:
+                q = _percentile(name)
+                value = None
+                if q is not None:
+                    if ordered is None:
+                        ordered = sorted(values)
+                    value = _interpolate(ordered, q)
+                elif name == 'stdev':
+                    if count > 1:
+                        value = sqrt(fsum((v - mean) * (v - mean) for v in values) / (count - 1))
+                elif name == 'ema':
+                    value = values[0]
+                    for v in values[1:]:
+                        value += self.ema_alpha * (v - value)
+                elif name == 'slope':
+                    if count > 1 and elapsed > 0:
+                        value = fsum((t - mean_time) * (v - mean) for t, v in zip(times, values)) / fsum((t - mean_time) * (t - mean_time) for t in times) * 60
+                elif name == 'rate':
+                    if count > 1 and elapsed > 0 and values[0] != 0:
+                        value = (values[-1] - values[0]) / abs(values[0]) * 100 / (elapsed / 60)
+                output[field][name] = value
+        return output
+
+# Returns True if <name> is a statistic WindowAnalytics can compute.
+def is_stat(name):
+    return name in ANALYTICS_STATS or _percentile(name) is not None
+
+# Returns the published values for the results of WindowAnalytics.compute(), as {<field>_<stat>: value},
+# converted like the window values. Statistics are computed in the sensor's units and converted afterwards.
+# Statistics the window doesn't have enough samples for yet are left out.
+def summarize_analytics(results, convert_to_f=False, iaq_as_percent=False):
+    values = {}
+    for field, stats in results.items():
+        for name, value in stats.items():
+            key = '{}_{}'.format(field, name)
+            if value is None:
+                continue
+            if name in ('stdev', 'slope'):
+                # Differences: scale them, without the offset.
+                if iaq_as_percent and (field == 'iaq' or field == 'static_iaq'):
+                    value = value / 5 if name == 'stdev' else -value / 5
+                elif convert_to_f and (field == 'temperature' or field == 'raw_temperature'):
+                    value = value * 9 / 5
+                values[key] = round(value, 3)
+            elif name == 'rate':
+                values[key] = round(value, 3)
+            else:
+                values[key] = publish_value(field, value, convert_to_f, iaq_as_percent)
+    return values
+
+# Returns the percentile of a statistic name (50 for 'median', 95 for 'p95'), or None if it isn't one.
+def _percentile(name):
+    if name == 'median':
+        return 50.0
+    if name.startswith('p'):
+        try:
+            q = float(name[1:])
+        except ValueError:
+            return None
+        if 0 <= q <= 100:
+            return q
+    return None
+
+# Returns the <q>th percentile of sorted values, interpolating linearly between the closest ranks (as NumPy does).
+def _interpolate(ordered, q):
+    position = q / 100 * (len(ordered) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
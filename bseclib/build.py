@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+# BSECLibrary Build Cache - (C) 2018 TimothyBrown
+Content-addressed cache for the bsec-library executable. Builds are keyed on
+everything that goes into them, compiled in parallel and can be shared between
+base directories or machines as prebuilt bundles.
+MIT License
+
+Usage: python3 -m bseclib.build [--base-dir DIR | --cache DIR] list|export KEY BUNDLE|import BUNDLE
+"""
+
+import os
+import json
+import shutil
+import logging
+import tarfile
+import argparse
+import subprocess
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+from bseclib import BSECLibraryError
+
+# Compiler and linker flags. Changing these changes the build key.
+CFLAGS = ['-Wall', '-Wno-unused-but-set-variable', '-Wno-unused-variable']
+LDFLAGS = ['-static']
+LDLIBS = ['-lalgobsec', '-lm', '-lrt']
+# Flags for the shared library used by bseclib.shared, in place of CFLAGS and LDFLAGS.
+SHARED_CFLAGS = CFLAGS + ['-fPIC', '-DBSEC_SHARED']
+SHARED_LDFLAGS = ['-shared']
+
+# Directories of the BSEC source tree that go into the build.
+BSEC_TREE = ['API', 'examples']
+
+class BuildCache:
+    """Content-addressed store of bsec-library executables."""
+
+    def __init__(self, cache_dir, logger=None, compiler='cc'):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.compiler = compiler
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # Function to return the build inputs for a source tree and architecture.
+    # With a StartupManifest, the tree digest and compiler version are only
+    # recomputed when the files behind them changed. <shared> builds the shared library instead.
+    def inputs(self, src_dir, lib_arch, source, manifest=None, shared=False):
+        sub_dirs = BSEC_TREE + ['algo/{}'.format(lib_arch)]
+        if manifest is None:
+            bsec = tree_digest(src_dir, sub_dirs)
+            compiler = self.compiler_version()
+        else:
+            bsec = manifest.tree_digest(src_dir, sub_dirs)
+            compiler = manifest.compiler_version(self.compiler, self.compiler_version)
+        return {
+            'source': sha256(source.encode('UTF-8')).hexdigest(),
+            'bsec': bsec,
+            'arch': lib_arch,
+            'flags': ' '.join(SHARED_CFLAGS + SHARED_LDFLAGS + LDLIBS if shared else CFLAGS + LDFLAGS + LDLIBS),
+            'compiler': compiler
+        }
+
+    # Function to return the compiler's version string.
+    def compiler_version(self):
+        try:
+            version = subprocess.run([self.compiler, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except FileNotFoundError:
+            self.log.error("Compiler [{}] not found!".format(self.compiler))
+            raise BSECLibraryError()
+        return version.stdout.decode().splitlines()[0].strip() if version.stdout else ''
+
+    # Function to return the path of a cached executable (or shared library), or None.
+    # With <verify>, the executable is checked against the digest in its build manifest, and a
+    # build that doesn't match is removed from the cache (so it's built again) and None returned.
+    def get(self, key, verify=False):
+        key_dir = os.path.join(self.cache_dir, key)
+        path = os.path.join(key_dir, 'bsec-library')
+        if not os.path.isfile(path):
+            return None
+        if verify:
+            try:
+                with open(os.path.join(key_dir, 'manifest.json'), 'rt') as f:
+                    expected = json.load(f).get('sha256')
+            except (FileNotFoundError, ValueError):
+                expected = None
+            with open(path, 'rb') as f:
+                digest = sha256(f.read()).hexdigest()
+            if digest != expected:
+                self.log.warning("Cached build [{}] failed verification, removing it.".format(key[:12]))
+                shutil.rmtree(key_dir, ignore_errors=True)
+                return None
+        return path
+
+    # Function to build the executable into the cache. Returns the executable path.
+    # Each source file is compiled to an object file in parallel, then linked.
+    # <shared> builds the shared library instead; it's cached under the same name.
+    def build(self, key, inputs, src_dir, source_path, lib_arch, shared=False):
+        cflags = SHARED_CFLAGS if shared else CFLAGS
+        ldflags = SHARED_LDFLAGS if shared else LDFLAGS
+        work_dir = os.path.join(self.cache_dir, '{}.tmp-{}'.format(key, os.getpid()))
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        includes = [
+            '-iquote{}/API'.format(src_dir),
+            '-iquote{}/algo/{}'.format(src_dir, lib_arch),
+            '-iquote{}/examples'.format(src_dir)
+        ]
+        sources = [
+            '{}/API/bme680.c'.format(src_dir),
+            '{}/examples/bsec_integration.c'.format(src_dir),
+            source_path
+        ]
+        objects = [os.path.join(work_dir, os.path.basename(i)[:-2] + '.o') for i in sources]
+        compile_commands = [[self.compiler] + cflags + includes + ['-c', i, '-o', o] for i, o in zip(sources, objects)]
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            results = list(pool.map(lambda command: subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT), compile_commands))
+        exec_path = os.path.join(work_dir, 'bsec-library')
+        link_command = [self.compiler] + ldflags + objects + ['-L{}/algo/{}'.format(src_dir, lib_arch)] + LDLIBS + ['-o', exec_path]
+        if all(i.returncode == 0 for i in results):
+            results.append(subprocess.run(link_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+
+        # Check for errors.
+        for result in results:
+            if result.returncode != 0:
+                shutil.rmtree(work_dir, ignore_errors=True)
+                self.log.error('Encountered an error during the build process!')
+                self.log.error(result.stdout.decode())
+                raise BSECLibraryError()
+
+        # Record what went into the build and move it into place.
+        self._write_manifest(work_dir, key, inputs)
+        return self._commit(work_dir, key)
+
+    # Function to write a bundle (tar.gz) containing a cached build.
+    def export_bundle(self, key, path):
+        key_dir = os.path.join(self.cache_dir, key)
+        if self.get(key) is None:
+            self.log.error("No cached build with key [{}].".format(key))
+            raise BSECLibraryError()
+        with tarfile.open(path, 'w:gz') as bundle:
+            bundle.add(os.path.join(key_dir, 'manifest.json'), arcname='manifest.json')
+            bundle.add(os.path.join(key_dir, 'bsec-library'), arcname='bsec-library')
+        self.log.info("Exported build [{}] to {}.".format(key, path))
+
+    # Function to add a bundle to the cache. Returns its key.
+    def import_bundle(self, path):
+        with tarfile.open(path, 'r:gz') as bundle:
+            manifest = json.load(bundle.extractfile('manifest.json'))
+            executable = bundle.extractfile('bsec-library').read()
+        key = manifest.get('key')
+        if key != build_key(manifest.get('inputs', {})) or sha256(executable).hexdigest() != manifest.get('sha256'):
+            self.log.error("Bundle {} failed verification.".format(path))
+            raise BSECLibraryError()
+        work_dir = os.path.join(self.cache_dir, '{}.tmp-{}'.format(key, os.getpid()))
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        with open(os.path.join(work_dir, 'bsec-library'), 'wb') as f:
+            f.write(executable)
+        os.chmod(os.path.join(work_dir, 'bsec-library'), 0o755)
+        self._write_manifest(work_dir, key, manifest['inputs'])
+        self._commit(work_dir, key)
+        self.log.info("Imported build [{}] from {}.".format(key, path))
+        return key
+
+    # Function to list the keys and inputs of every cached build.
+    def list(self):
+        builds = {}
+        for key in sorted(os.listdir(self.cache_dir)):
+            try:
+                with open(os.path.join(self.cache_dir, key, 'manifest.json'), 'rt') as f:
+                    builds[key] = json.load(f)['inputs']
+            except (FileNotFoundError, NotADirectoryError, ValueError, KeyError):
+                pass
+        return builds
+
+    # Private function to write the manifest of a build directory.
+    def _write_manifest(self, work_dir, key, inputs):
+        with open(os.path.join(work_dir, 'bsec-library'), 'rb') as f:
+            digest = sha256(f.read()).hexdigest()
+        with open(os.path.join(work_dir, 'manifest.json'), 'wt') as f:
+            json.dump({'key': key, 'inputs': inputs, 'sha256': digest}, f, indent=2, sort_keys=True)
+
+    # Private function to atomically move a finished build directory to its key.
+    def _commit(self, work_dir, key):
+        key_dir = os.path.join(self.cache_dir, key)
+        try:
+            os.rename(work_dir, key_dir)
+        except OSError:
+            # Someone else finished the same build first; theirs is just as good.
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return os.path.join(key_dir, 'bsec-library')
+
+# Returns the build key (a SHA256 hex digest) for a dict of build inputs.
+def build_key(inputs):
+    return sha256(json.dumps(inputs, sort_keys=True).encode('UTF-8')).hexdigest()
+
+# Returns a SHA256 hex digest of every file (path and contents) under the given sub-directories.
+def tree_digest(base_dir, sub_dirs):
+    digest = sha256()
+    for sub_dir in sub_dirs:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(base_dir, sub_dir)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(path, base_dir).encode('UTF-8') + b'\0')
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        digest.update(chunk)
+    return digest.hexdigest()
+
+# Default cache location of a base directory (the current directory if None), as used by BSECLibrary and bsec-conduit.
+def default_cache_dir(base_dir=None):
+    if base_dir is None:
+        base_dir = os.getcwd()
+    return os.path.join(os.path.abspath(base_dir), 'bsec-cache')
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(prog='python3 -m bseclib.build', description='Manage the bsec-library build cache.')
+    parser.add_argument('--base-dir', default=None, help='Base directory whose cache is used. (Default: The current directory)')
+    parser.add_argument('--cache', default=None, help='Cache directory, if not the one under the base directory. (Default: <base-dir>/bsec-cache)')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='List cached builds.')
+    export_parser = commands.add_parser('export', help='Write a cached build to a bundle.')
+    export_parser.add_argument('key')
+    export_parser.add_argument('bundle')
+    import_parser = commands.add_parser('import', help='Add a prebuilt bundle to the cache.')
+    import_parser.add_argument('bundle')
+    args = parser.parse_args()
+
+    cache = BuildCache(args.cache if args.cache is not None else default_cache_dir(args.base_dir))
+    if args.command == 'list':
+        for key, inputs in cache.list().items():
+            print('{} {} ({})'.format(key, inputs.get('arch'), inputs.get('compiler')))
+    elif args.command == 'export':
+        cache.export_bundle(args.key, args.bundle)
+    elif args.command == 'import':
+        print(cache.import_bundle(args.bundle))
+    else:
+        parser.print_help()
+        exit(1)
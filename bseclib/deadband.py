@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+# BSEC-Conduit Deadband - (C) 2018 TimothyBrown
+Report-by-exception for published values: a value is only sent again once it
+moves outside its deadband, or when it hasn't been sent for a heartbeat interval.
+MIT License
+"""
+
+import time
+import logging
+from bseclib import BSECLibraryError
+
+class Deadband:
+    """Decides which published values changed enough to be worth sending again."""
+
+    # thresholds: Dict of field name to threshold, as parsed by parse_threshold() (or a string it accepts).
+    #             Fields that aren't listed are sent whenever their published (rounded) value changes.
+    # heartbeat: Seconds after which a value is sent even if it hasn't moved. 0 to only send changes.
+    # metrics: Optional bseclib.metrics registry to count sent and suppressed values in.
+    def __init__(self, thresholds=None, heartbeat=600, metrics=None, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+
+        if heartbeat < 0:
+            self.log.error("Error: <heartbeat> must be 0 or more seconds.")
+            raise BSECLibraryError()
+        self.heartbeat = heartbeat
+        self.thresholds = {}
+        for field, threshold in (thresholds or {}).items():
+            try:
+                self.thresholds[field] = parse_threshold(threshold) if isinstance(threshold, str) else threshold
+            except ValueError as e:
+                self.log.error("Error: <thresholds> {}: {}".format(field, e))
+                raise BSECLibraryError()
+        # Values sent and held back.
+        self.sent = 0
+        self.suppressed = 0
+        # The last value sent for each key and field, and when, as {key: {field: (value, time)}}.
+        self._last = {}
+        if metrics is not None:
+            self._sent = metrics.counter('deadband_sent_total', 'Values sent because they changed or their heartbeat was due.')
+            self._suppressed = metrics.counter('deadband_suppressed_total', 'Values held back because they stayed inside their deadband.')
+        else:
+            self._sent = self._suppressed = None
+
+    # Function to return the part of <values> (a dict of field to value) that should be sent for <key>,
+    # i.e. a sensor or topic, and remember it as sent. <now> is a time.monotonic() time.
+    # With <bundle>, every value is returned as soon as any one of them is due, since they're sent together.
+    def filter(self, key, values, now=None, bundle=False):
+        if now is None:
+            now = time.monotonic()
+        last = self._last.setdefault(key, {})
+        heartbeat = self.heartbeat
+        send = {}
+        for field, value in values.items():
+            previous = last.get(field)
+            if previous is None or (heartbeat and now - previous[1] >= heartbeat) or self._moved(field, previous[0], value):
+                send[field] = value
+        if bundle and send:
+            send = dict(values)
+        for field, value in send.items():
+            last[field] = (value, now)
+        suppressed = len(values) - len(send)
+        self.sent += len(send)
+        self.suppressed += suppressed
+        if self._sent is not None:
+            self._sent.inc(len(send))
+            self._suppressed.inc(suppressed)
+        return send
+
+    # Function to forget what was sent, so everything is sent again. Pass <key> to only reset that one.
+    def reset(self, key=None):
+        if key is None:
+            self._last.clear()
+        else:
+            self._last.pop(key, None)
+
+    # Private function to check whether a value moved outside its deadband since it was last sent.
+    def _moved(self, field, previous, value):
+        # Text values (i.e. the IAQ accuracy) are sent whenever they change.
+        if isinstance(value, str) or isinstance(previous, str):
+            return value != previous
+        threshold, relative = self.thresholds.get(field, (0, False))
+        if relative:
+            threshold *= abs(previous)
+        if threshold > 0:
+            return abs(value - previous) > threshold
+        return value != previous
+
+# Returns a threshold string as (amount, relative): '0.5' is an absolute change of 0.5
+# in the published units, '2%' is a change of 2% of the last value sent.
+def parse_threshold(value):
+    value = str(value).strip()
+    relative = value.endswith('%')
+    amount = float(value[:-1] if relative else value)
+    if amount < 0:
+        raise ValueError("Threshold must not be negative: {}".format(value))
+    return (amount / 100 if relative else amount, relative)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+# BSECLibrary Sample History - (C) 2018 TimothyBrown
+Persistent, fixed size ring file of raw samples, written through mmap.
+MIT License
+"""
+
+import os
+import mmap
+import time
+import struct
+import logging
+from bseclib import BSECLibraryError, Sample, OUTPUT_FIELDS
+
+# File layout (little-endian):
+# Header: magic (8 bytes), version (uint32), record size (uint32), capacity (uint32), pad, written (uint64).
+# Followed by <capacity> records. Keep HISTORY_HEADER_SIZE a multiple of 8 so the counters stay aligned.
+HISTORY_MAGIC = b'BSECHIST'
+HISTORY_VERSION = 2
+HISTORY_HEADER = struct.Struct('<8sIII4xQ')
+HISTORY_HEADER_SIZE = 64
+HISTORY_WRITTEN = struct.Struct('<Q')
+HISTORY_WRITTEN_OFFSET = 24
+# Record: slot sequence + 1 (uint64, 0 = empty), timestamp (float64, see SampleHistory.append()),
+# sensor time (float64, NaN if unknown), sensor sequence (int64, -1 if unknown), status (int16),
+# IAQ accuracy (uint8), pad, the BSEC outputs in OUTPUT_FIELDS order (float32), pad to 80 bytes.
+# Outputs that weren't selected (None) are stored as NaN.
+HISTORY_RECORD = struct.Struct('<QddqhBx' + 'f' * len(OUTPUT_FIELDS) + '4x')
+
+class SampleHistory:
+    """Ring file of the last <capacity> samples, with time range queries."""
+
+    # path: The ring file. Created (or recreated if the capacity changed) as needed.
+    # capacity: Number of samples to keep, i.e. 7200 is six hours at 3 seconds per sample.
+    def __init__(self, path, capacity, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+
+        if capacity < 1:
+            self.log.error("Error: <capacity> must be at least 1.")
+            raise BSECLibraryError()
+        self.path = path
+        self.capacity = capacity
+        self.record_size = HISTORY_RECORD.size
+        size = HISTORY_HEADER_SIZE + capacity * self.record_size
+
+        # Check the existing file, if any.
+        create = True
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(HISTORY_HEADER.size)
+            if len(header) == HISTORY_HEADER.size and os.path.getsize(path) == size:
+                magic, version, record_size, file_capacity, written = HISTORY_HEADER.unpack(header)
+                if magic == HISTORY_MAGIC and version == HISTORY_VERSION and record_size == self.record_size and file_capacity == capacity:
+                    create = False
+            if create:
+                self.log.warning("History file [{}] doesn't match the current settings, starting a new one.".format(path))
+        except FileNotFoundError:
+            self.log.info("Created new history file [{}].".format(path))
+
+        if create:
+            with open(path, 'wb') as f:
+                f.write(HISTORY_HEADER.pack(HISTORY_MAGIC, HISTORY_VERSION, self.record_size, capacity, 0).ljust(HISTORY_HEADER_SIZE, b'\0'))
+                f.truncate(size)
+
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self.written = self._recover()
+        # Timestamps run on the monotonic clock, anchored to the wall clock once here, and never go
+        # below the last one stored: a clock step (i.e. from NTP) can't put the records out of order.
+        self._last_timestamp = self._timestamp(self.written - 1) if self.written else 0.0
+        self._anchor = (max(time.time(), self._last_timestamp), time.monotonic())
+
+    # Private function to find the number of records written.
+    # The header counter is only a hint: a crash between writing a record and
+    # updating the header is detected from the sequence stored in each slot.
+    def _recover(self):
+        written = HISTORY_WRITTEN.unpack_from(self._mmap, HISTORY_WRITTEN_OFFSET)[0]
+        if self._slot_sequence(written - 1) == written and self._slot_sequence(written) != written + 1:
+            return written
+        # Fall back to scanning every slot for the highest sequence.
+        highest = 0
+        for index in range(self.capacity):
+            highest = max(highest, self._slot_sequence(index))
+        if highest != written:
+            self.log.warning("History file [{}] index was inconsistent, recovered {} records.".format(self.path, min(highest, self.capacity)))
+            HISTORY_WRITTEN.pack_into(self._mmap, HISTORY_WRITTEN_OFFSET, highest)
+        return highest
+
+    # Private function to return the stored sequence (+1) of a logical record index, or 0.
+    def _slot_sequence(self, index):
+        if index < 0:
+            return 0
+        offset = HISTORY_HEADER_SIZE + (index % self.capacity) * self.record_size
+        return HISTORY_WRITTEN.unpack_from(self._mmap, offset)[0]
+
+    # Function to append a sample. Its timestamp is the wall clock time the history was opened plus the
+    # monotonic time since then (the sample's sensor time, if it has one), or <timestamp> if given.
+    # Either way it's raised to the last stored timestamp if it's earlier, so the records stay in order.
+    def append(self, sample, timestamp=None):
+        if timestamp is None:
+            wall, monotonic = self._anchor
+            timestamp = wall + ((sample.sensor_time if sample.sensor_time is not None else time.monotonic()) - monotonic)
+        timestamp = max(timestamp, self._last_timestamp)
+        written = self.written
+        HISTORY_RECORD.pack_into(self._mmap, HISTORY_HEADER_SIZE + (written % self.capacity) * self.record_size,
+                                 written + 1, timestamp, _nan(sample.sensor_time),
+                                 -1 if sample.sensor_sequence is None else sample.sensor_sequence,
+                                 sample.status, sample.iaq_accuracy, *[_nan(getattr(sample, field)) for field, key in OUTPUT_FIELDS])
+        self._last_timestamp = timestamp
+        self.written = written + 1
+        HISTORY_WRITTEN.pack_into(self._mmap, HISTORY_WRITTEN_OFFSET, self.written)
+
+    # Number of records currently stored.
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    # Private function to return the timestamp of a logical record index.
+    def _timestamp(self, index):
+        offset = HISTORY_HEADER_SIZE + (index % self.capacity) * self.record_size
+        return struct.unpack_from('<d', self._mmap, offset + 8)[0]
+
+    # Private function to binary search for the first logical index with a timestamp >= <timestamp>.
+    def _bisect(self, timestamp):
+        low = self.written - len(self)
+        high = self.written
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Function to return the raw records between <start> and <end> (timestamps, end exclusive)
+    # as up to two memoryview segments (the range may wrap around the end of the ring).
+    # Use HISTORY_RECORD.iter_unpack() on each segment to read the values.
+    def query_raw(self, start=None, end=None):
+        first = self.written - len(self) if start is None else self._bisect(start)
+        last = self.written if end is None else self._bisect(end)
+        if first >= last:
+            return []
+        view = memoryview(self._mmap)
+        size = self.record_size
+        head = first % self.capacity
+        count = last - first
+        segments = []
+        while count > 0:
+            length = min(count, self.capacity - head)
+            offset = HISTORY_HEADER_SIZE + head * size
+            segments.append(view[offset:offset + length * size])
+            count -= length
+            head = 0
+        return segments
+
+    # Function to return the samples between <start> and <end> as a list of Sample objects.
+    # Each sample's timestamp is its stored timestamp (see append()), and its sequence the record number.
+    def query(self, start=None, end=None):
+        samples = []
+        for segment in self.query_raw(start, end):
+            samples.extend(record_sample(record) for record in HISTORY_RECORD.iter_unpack(segment))
+            segment.release()
+        return samples
+
+    # Function to write dirty pages out to disk.
+    def flush(self):
+        self._mmap.flush()
+
+    # Function to flush and close the file.
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+
+# Returns an unpacked HISTORY_RECORD as a Sample.
+def record_sample(record):
+    sequence, timestamp, sensor_time, sensor_sequence, status, iaq_accuracy, *values = record
+    # NaN is the only value that isn't equal to itself.
+    values = [value if value == value else None for value in values]
+    return Sample(timestamp, sequence - 1, status, iaq_accuracy, *values[:5],
+                  sensor_time if sensor_time == sensor_time else None, None if sensor_sequence < 0 else sensor_sequence, *values[5:])
+
+# Returns <value>, or NaN for None.
+def _nan(value):
+    return float('nan') if value is None else value
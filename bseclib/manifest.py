@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+# BSECLibrary Startup Manifest - (C) 2018 TimothyBrown
+Remembers file digests and other startup checks, and validates them with stat()
+so a normal restart doesn't have to read every file again.
+MIT License
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+MANIFEST_VERSION = 2
+
+class StartupManifest:
+    """Cache of startup checks, each keyed on the stat() signature of the files it depends on."""
+
+    # path: The manifest file.
+    # full_check: If True, ignore the saved manifest and recompute everything.
+    def __init__(self, path, full_check=False, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._changed = False
+        self._data = {'version': MANIFEST_VERSION, 'files': {}, 'trees': {}, 'values': {}, 'installed': {}}
+        if not full_check:
+            try:
+                with open(path, 'rt') as f:
+                    data = json.load(f)
+                if data.get('version') == MANIFEST_VERSION:
+                    self._data = data
+            except (FileNotFoundError, ValueError):
+                pass
+
+    # Function to return the hex digest of a file, or None if it doesn't exist.
+    # Only reads the file if its size, mtime or inode changed since the last time.
+    def file_digest(self, path, algorithm='md5'):
+        try:
+            signature = _signature(os.stat(path))
+        except FileNotFoundError:
+            return None
+        entry = self._data['files'].get(path)
+        if entry is not None and entry['signature'] == signature and algorithm in entry['digests']:
+            self.hits += 1
+            return entry['digests'][algorithm]
+        self.misses += 1
+        digest = hashlib.new(algorithm)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        if entry is None or entry['signature'] != signature:
+            entry = self._data['files'][path] = {'signature': signature, 'digests': {}}
+        entry['digests'][algorithm] = digest.hexdigest()
+        self._changed = True
+        return entry['digests'][algorithm]
+
+    # Function to return bseclib.build.tree_digest() of a source tree.
+    # Only reads the files if any file in the tree was added, removed or changed.
+    def tree_digest(self, base_dir, sub_dirs):
+        from bseclib.build import tree_digest
+        signature = hashlib.sha256()
+        for sub_dir in sub_dirs:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(base_dir, sub_dir)):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    path = os.path.join(dirpath, filename)
+                    signature.update('{}\0{}\0'.format(os.path.relpath(path, base_dir), _signature(os.stat(path))).encode('UTF-8'))
+        signature = signature.hexdigest()
+        name = '{}:{}'.format(base_dir, ','.join(sub_dirs))
+        entry = self._data['trees'].get(name)
+        if entry is not None and entry['signature'] == signature:
+            self.hits += 1
+            return entry['digest']
+        self.misses += 1
+        digest = tree_digest(base_dir, sub_dirs)
+        self._data['trees'][name] = {'signature': signature, 'digest': digest}
+        self._changed = True
+        return digest
+
+    # Function to return a value computed by <function>, cached until the files in <paths> change.
+    # If given, <check> must return True for a cached value to be used.
+    def value(self, name, paths, function, check=None):
+        signature = []
+        for path in paths:
+            try:
+                signature.append(_signature(os.stat(path)))
+            except (FileNotFoundError, TypeError):
+                signature.append(None)
+        entry = self._data['values'].get(name)
+        if entry is not None and entry['signature'] == signature and (check is None or check(entry['value'])):
+            self.hits += 1
+            return entry['value']
+        self.misses += 1
+        result = function()
+        self._data['values'][name] = {'signature': signature, 'value': result}
+        self._changed = True
+        return result
+
+    # Function to remember a file we installed (i.e. the executable): its size, mtime and digest,
+    # plus any <extra> values to return from verify_file() (i.e. its build key).
+    def record_file(self, path, algorithm='sha256', **extra):
+        stat = os.stat(path)
+        entry = dict(extra, size=stat.st_size, mtime_ns=stat.st_mtime_ns, algorithm=algorithm, digest=self.file_digest(path, algorithm))
+        self._data['installed'][path] = entry
+        self._changed = True
+
+    # Function to check an installed file against record_file(). Returns its extra values if the size, mtime
+    # and digest still match, or None if it's missing, changed or wasn't recorded. The digest is only
+    # recomputed if the file's stat() signature changed (or with full_check, where nothing is recorded).
+    def verify_file(self, path):
+        entry = self._data['installed'].get(path)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']:
+            return None
+        if self.file_digest(path, entry['algorithm']) != entry['digest']:
+            return None
+        return {name: value for name, value in entry.items() if name not in ('size', 'mtime_ns', 'algorithm', 'digest')}
+
+    # Function to return the version string of a compiler, cached until the compiler binary changes.
+    def compiler_version(self, compiler, function):
+        path = shutil.which(compiler)
+        return self.value('compiler:{}'.format(compiler), [os.path.realpath(path) if path else None], function)
+
+    # Function to write the manifest if anything changed.
+    def save(self):
+        if not self._changed:
+            return
+        try:
+            with open('{}.tmp'.format(self.path), 'wt') as f:
+                json.dump(self._data, f)
+            os.replace('{}.tmp'.format(self.path), self.path)
+            self._changed = False
+        except OSError as e:
+            self.log.warning("Could not write startup manifest [{}]: {}".format(self.path, e))
+
+# Returns the parts of a stat() result that change when a file is modified or replaced.
+def _signature(stat):
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+# BSECLibrary Metrics - (C) 2018 TimothyBrown
+Low overhead counters, gauges and histograms, exposed in the Prometheus text
+format over HTTP on a TCP port or a Unix socket.
+MIT License
+"""
+
+import os
+import logging
+import threading
+import socketserver
+from bisect import bisect_left
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds in seconds, from 5us (decoding a sample) to 10s (a stalled read).
+DEFAULT_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    """A value that only goes up. Optionally read from a function at collection time instead."""
+    __slots__ = ('value', 'function', '_lock')
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def get(self):
+        return self.value if self.function is None else self.function()
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+class Histogram:
+    """Counts of observed values in fixed buckets, plus their sum and count."""
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    # Function to record a value. O(log buckets), no allocation.
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    # Function to return a consistent copy of the bucket counts, sum and count.
+    def values(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    # Function to estimate a quantile (0.0 to 1.0) as the upper bound of the bucket it falls in.
+    def quantile(self, q):
+        counts, total_sum, count = self.values()
+        if count == 0:
+            return None
+        target = q * count
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            if total >= target:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """Registry of named metrics. Each metric is created once and then updated directly."""
+
+    # Each metric has its own lock, as some are updated from several threads (i.e. the MQTT
+    # publish latency, from the main, spool replay and paho threads). The registry lock
+    # only covers creating metrics and listing them.
+
+    # labels: Labels added to every metric created through this registry (see child()).
+    def __init__(self, labels=None, _families=None, _lock=None):
+        self.labels = dict(labels or {})
+        self._families = OrderedDict() if _families is None else _families
+        self._lock = threading.Lock() if _lock is None else _lock
+
+    # Function to return a registry sharing the same metrics, that adds <labels> to everything it creates.
+    def child(self, **labels):
+        return Metrics(dict(self.labels, **labels), self._families, self._lock)
+
+    # Functions to return the metric with this name and labels, creating it if needed.
+    def counter(self, name, help, function=None, **labels):
+        return self._get('counter', name, help, lambda: Counter(function), labels)
+
+    def gauge(self, name, help, function=None, **labels):
+        return self._get('gauge', name, help, lambda: Gauge(function), labels)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get('histogram', name, help, lambda: Histogram(buckets), labels)
+
+    # Function to remove the metric with this name and labels, i.e. for a sensor that's gone. Returns True if it existed.
+    def remove(self, name, **labels):
+        labels = tuple(sorted(dict(self.labels, **labels).items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None or family['metrics'].pop(labels, None) is None:
+                return False
+            if not family['metrics']:
+                del self._families[name]
+            return True
+
+    # Private function to look up or create a metric.
+    def _get(self, kind, name, help, factory, labels):
+        labels = tuple(sorted(dict(self.labels, **labels).items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = {'type': kind, 'help': help, 'metrics': OrderedDict()}
+            elif family['type'] != kind:
+                raise ValueError("Metric {} is a {}, not a {}.".format(name, family['type'], kind))
+            metric = family['metrics'].get(labels)
+            if metric is None:
+                metric = family['metrics'][labels] = factory()
+            return metric
+
+    # Function to return every metric in the Prometheus text exposition format.
+    def render(self):
+        lines = []
+        with self._lock:
+            families = [(name, family['type'], family['help'], list(family['metrics'].items())) for name, family in self._families.items()]
+        for name, kind, help, metrics in families:
+            lines.append('# HELP {} {}'.format(name, help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, metric in metrics:
+                if kind == 'histogram':
+                    counts, total_sum, count = metric.values()
+                    total = 0
+                    for bound, bucket in zip(metric.buckets + (float('inf'),), counts):
+                        total += bucket
+                        lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', _number(bound)),)), total))
+                    lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(total_sum)))
+                    lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+                else:
+                    lines.append('{}{} {}'.format(name, _labels(labels), _number(metric.get())))
+        return '\n'.join(lines) + '\n'
+
+    # Function to return every metric as a dict, i.e. for publishing as JSON.
+    # Histograms are summarized as their count, mean and estimated p50/p99.
+    def snapshot(self):
+        snapshot = OrderedDict()
+        with self._lock:
+            families = [(name, list(family['metrics'].items())) for name, family in self._families.items()]
+        for name, metrics in families:
+            for labels, metric in metrics:
+                key = name + _labels(labels)
+                if isinstance(metric, Histogram):
+                    counts, total_sum, count = metric.values()
+                    snapshot[key] = {
+                        'count': count,
+                        'mean': total_sum / count if count else None,
+                        'p50': metric.quantile(0.5),
+                        'p99': metric.quantile(0.99)
+                    }
+                else:
+                    snapshot[key] = metric.get()
+        return snapshot
+
+class MetricsServer:
+    """Serves a Metrics registry at /metrics over HTTP, on a TCP port or a Unix socket."""
+
+    # address: 'host:port' (i.e. '127.0.0.1:9580'), or the path of a Unix socket.
+    def __init__(self, metrics, address, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+        self.address = address
+        if address.startswith('/') or address.startswith('.'):
+            # Remove a socket left over from a previous run.
+            try:
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+            self.server = _UnixHTTPServer(address, _MetricsHandler)
+        else:
+            host, port = address.rsplit(':', 1)
+            self.server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.metrics = metrics
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        self.log.info("Serving metrics on {}.".format(address))
+
+    # Function to stop serving.
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+        if isinstance(self.server, _UnixHTTPServer):
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    pass
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Unix socket clients have no address, and scrapes don't belong in the journal anyway.
+    def log_message(self, format, *args):
+        pass
+
+# Returns the Prometheus label set for a tuple of (name, value) pairs.
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels) + '}'
+
+# Returns a number formatted for the Prometheus text format.
+def _number(value):
+    if value is None or value != value:
+        return 'NaN'
+    if isinstance(value, bool):
+        return str(int(value))
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(value) if isinstance(value, float) else str(value)
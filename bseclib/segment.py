@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+# BSECLibrary Sample Segment - (C) 2018 TimothyBrown
+Shared memory segment with the latest samples and window values, for local
+readers that don't want to go through the MQTT broker. One writer, any number
+of lock-free readers, each slot guarded by a seqlock and a CRC.
+MIT License
+
+Usage: python3 -m bseclib.segment [--count N] PATH
+"""
+
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+import argparse
+from bseclib import BSECLibraryError, Sample, OUTPUT_FIELDS
+
+# Segment layout (little-endian), also readable from other languages:
+# Header: magic (8 bytes), version (uint32), record size (uint32), sample capacity (uint32),
+# window capacity (uint32), samples written (uint64), windows written (uint64), pad to 64 bytes.
+# Followed by <sample capacity> sample records, then <window capacity> window records.
+SEGMENT_MAGIC = b'BSECSHM\0'
+SEGMENT_VERSION = 2
+SEGMENT_HEADER = struct.Struct('<8sIIIIQQ')
+SEGMENT_HEADER_SIZE = 64
+SEGMENT_WRITTEN = struct.Struct('<Q')
+# Offsets of the samples and windows written counters.
+SEGMENT_WRITTEN_OFFSETS = (24, 32)
+# Record: seqlock (uint64), wall clock timestamp (float64), sensor time (float64, NaN if unknown),
+# status (int16), IAQ accuracy (uint8), pad, the BSEC outputs in OUTPUT_FIELDS order (float32,
+# NaN if not selected), the number of samples (uint32; 1 for a sample, the window size for a window),
+# a CRC-32 (uint32, zlib's) of the finished seqlock and the body (timestamp to number of samples), and pad to 80 bytes.
+# The seqlock of the slot holding record <n> is 2n + 1 while it's being written and 2n + 2 once it's done.
+# Python can't issue memory barriers, so on weakly ordered CPUs (i.e. ARM) a reader may see the
+# finished seqlock before the body: readers check the CRC as well, and retry until it matches.
+SEGMENT_SEQUENCE = struct.Struct('<Q')
+SEGMENT_RECORD = struct.Struct('<QddhBx' + 'f' * len(OUTPUT_FIELDS) + 'II4x')
+SEGMENT_BODY = struct.Struct('<ddhBx' + 'f' * len(OUTPUT_FIELDS) + 'I')
+SEGMENT_CRC = struct.Struct('<I')
+# Offset of the CRC in a record.
+SEGMENT_CRC_OFFSET = SEGMENT_SEQUENCE.size + SEGMENT_BODY.size
+# Record rings: raw samples and window values.
+SAMPLES = 0
+WINDOWS = 1
+# Times a reader retries a record that's being written before giving up on it.
+SEGMENT_RETRIES = 1000
+
+class SampleSegment:
+    """Writes samples and window values to a shared memory segment."""
+
+    # path: The segment file, normally under /dev/shm. Created (or recreated if the layout changed) as needed.
+    # capacity: Number of samples to keep.
+    # window_capacity: Number of window values to keep.
+    def __init__(self, path, capacity=1200, window_capacity=100, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+
+        if capacity < 1 or window_capacity < 1:
+            self.log.error("Error: <capacity> and <window_capacity> must be at least 1.")
+            raise BSECLibraryError()
+        self.path = path
+        self.capacities = (capacity, window_capacity)
+        size = SEGMENT_HEADER_SIZE + (capacity + window_capacity) * SEGMENT_RECORD.size
+
+        # Keep an existing segment if it has the same layout, so readers that have it open carry on.
+        create = True
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(SEGMENT_HEADER.size)
+            if len(header) == SEGMENT_HEADER.size and os.path.getsize(path) == size:
+                magic, version, record_size, file_capacity, file_window_capacity, samples, windows = SEGMENT_HEADER.unpack(header)
+                if magic == SEGMENT_MAGIC and version == SEGMENT_VERSION and record_size == SEGMENT_RECORD.size and (file_capacity, file_window_capacity) == self.capacities:
+                    create = False
+            if create:
+                self.log.warning("Shared memory segment [{}] doesn't match the current settings, starting a new one.".format(path))
+        except FileNotFoundError:
+            self.log.info("Created new shared memory segment [{}].".format(path))
+
+        if create:
+            # Build it next to the final path and rename it into place, so readers never see half a header.
+            with open('{}.tmp'.format(path), 'wb') as f:
+                f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, SEGMENT_RECORD.size, capacity, window_capacity, 0, 0).ljust(SEGMENT_HEADER_SIZE, b'\0'))
+                f.truncate(size)
+            os.replace('{}.tmp'.format(path), path)
+
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self.written = [SEGMENT_WRITTEN.unpack_from(self._mmap, offset)[0] for offset in SEGMENT_WRITTEN_OFFSETS]
+
+    # Function to add a sample. <timestamp> defaults to time.time().
+    def append(self, sample, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._write(SAMPLES, timestamp, sample.sensor_time, sample.status, sample.iaq_accuracy,
+                    [getattr(sample, field) for field, key in OUTPUT_FIELDS], 1)
+
+    # Function to add the values of a published window (a bseclib.window.WindowAggregator).
+    # Each output is the window mean, in the sensor's units; the IAQ accuracy is the mean rounded down.
+    def append_window(self, aggregator, timestamp=None, sensor_time=None):
+        if timestamp is None:
+            timestamp = time.time()
+        means = {field: aggregator[field].mean for field in aggregator.fields}
+        self._write(WINDOWS, timestamp, sensor_time, 0, int(means.get('iaq_accuracy', 0)),
+                    [means.get(field) for field, key in OUTPUT_FIELDS], aggregator.last_count)
+
+    # Private function to write a record into the next slot of a ring.
+    def _write(self, ring, timestamp, sensor_time, status, iaq_accuracy, values, count):
+        mm = self._mmap
+        written = self.written[ring]
+        offset = self._offset(ring, written)
+        body = SEGMENT_BODY.pack(timestamp, _nan(sensor_time), status, iaq_accuracy, *[_nan(value) for value in values], count)
+        # Odd: readers retry until the record is complete.
+        SEGMENT_SEQUENCE.pack_into(mm, offset, 2 * written + 1)
+        mm[offset + SEGMENT_SEQUENCE.size:offset + SEGMENT_CRC_OFFSET] = body
+        SEGMENT_CRC.pack_into(mm, offset + SEGMENT_CRC_OFFSET, _crc(2 * written + 2, body))
+        SEGMENT_SEQUENCE.pack_into(mm, offset, 2 * written + 2)
+        self.written[ring] = written + 1
+        SEGMENT_WRITTEN.pack_into(mm, SEGMENT_WRITTEN_OFFSETS[ring], written + 1)
+
+    # Private function to return the offset of the slot of record <index> in a ring.
+    def _offset(self, ring, index):
+        return _ring_offset(self.capacities, ring) + (index % self.capacities[ring]) * SEGMENT_RECORD.size
+
+    # Function to close the segment. The file stays, so readers keep the last values.
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+
+class SampleSegmentReader:
+    """Reads a segment written by SampleSegment without locking it."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, capacity, window_capacity, samples, windows = SEGMENT_HEADER.unpack_from(self._mmap)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or record_size != SEGMENT_RECORD.size:
+            self.close()
+            raise BSECLibraryError("{} isn't a version {} sample segment.".format(path, SEGMENT_VERSION))
+        self.capacities = (capacity, window_capacity)
+
+    # Function to return the latest sample as a Sample, or None if there isn't one yet.
+    def latest(self):
+        records = self._read(SAMPLES, 1)
+        return records[0] if records else None
+
+    # Function to return the latest window values as a Sample, or None. Its sequence is the number of samples in the window.
+    def latest_window(self):
+        records = self._read(WINDOWS, 1)
+        return records[0] if records else None
+
+    # Function to return up to <count> of the latest samples, oldest first.
+    def recent(self, count):
+        return self._read(SAMPLES, count)
+
+    # Function to return up to <count> of the latest window values, oldest first.
+    def recent_windows(self, count):
+        return self._read(WINDOWS, count)
+
+    # Private function to read the last <count> complete records of a ring.
+    # A record the writer is in the middle of (or whose CRC doesn't match yet) is retried; one it has
+    # already overwritten is skipped.
+    def _read(self, ring, count):
+        mm = self._mmap
+        capacity = self.capacities[ring]
+        first = _ring_offset(self.capacities, ring)
+        written = SEGMENT_WRITTEN.unpack_from(mm, SEGMENT_WRITTEN_OFFSETS[ring])[0]
+        records = []
+        for index in range(max(written - min(count, capacity), 0), written):
+            offset = first + (index % capacity) * SEGMENT_RECORD.size
+            for attempt in range(SEGMENT_RETRIES):
+                before = SEGMENT_SEQUENCE.unpack_from(mm, offset)[0]
+                body = mm[offset + SEGMENT_SEQUENCE.size:offset + SEGMENT_CRC_OFFSET]
+                crc = SEGMENT_CRC.unpack_from(mm, offset + SEGMENT_CRC_OFFSET)[0]
+                after = SEGMENT_SEQUENCE.unpack_from(mm, offset)[0]
+                if before == after and not before & 1 and crc == _crc(before, body):
+                    break
+            else:
+                # The writer died in the middle of this record, or it's corrupt.
+                continue
+            if before != 2 * index + 2:
+                # Overwritten by a newer record while we were reading.
+                continue
+            timestamp, sensor_time, status, iaq_accuracy, *values = SEGMENT_BODY.unpack(body)
+            samples = values.pop()
+            values = [value if value == value else None for value in values]
+            records.append(Sample(timestamp, index if ring == SAMPLES else samples, status, iaq_accuracy, *values[:5],
+                                  sensor_time if sensor_time == sensor_time else None, None, *values[5:]))
+        return records
+
+    # Function to close the segment.
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+
+# Returns the offset of the first slot of a ring, for the given (sample, window) capacities.
+def _ring_offset(capacities, ring):
+    return SEGMENT_HEADER_SIZE + (0 if ring == SAMPLES else capacities[SAMPLES] * SEGMENT_RECORD.size)
+
+# Returns the CRC of a record: its finished seqlock, then its body, so a body left over from an older record doesn't match.
+def _crc(sequence, body):
+    return zlib.crc32(body, zlib.crc32(SEGMENT_SEQUENCE.pack(sequence)))
+
+# Returns <value>, or NaN for None.
+def _nan(value):
+    return float('nan') if value is None else value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python3 -m bseclib.segment', description='Print the latest samples and window values in a shared memory segment.')
+    parser.add_argument('--count', type=int, default=1, help='Number of samples to print. (Default: %(default)s)')
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    reader = SampleSegmentReader(args.path)
+    for sample in reader.recent(args.count):
+        print(sample)
+    window = reader.latest_window()
+    if window is not None:
+        print('Window: {}'.format(window))
+    reader.close()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+# SharedBSECLibrary - (C) 2018 TimothyBrown
+Runs the BSEC integration code inside this process, built as a shared library
+and driven through ctypes on a dedicated thread, instead of as a separate
+process writing to a pipe.
+MIT License
+"""
+
+import os
+import time
+import queue
+import ctypes
+import functools
+import threading
+from bseclib import BSECLibrary, BSECLibraryError, Sample, OUTPUT_FIELDS
+
+# Callback types of bsec_run() in the embedded C source.
+SAMPLE_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_int64, ctypes.c_uint32, ctypes.c_uint8, ctypes.POINTER(ctypes.c_float), ctypes.c_int32)
+STATE_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_uint32, ctypes.c_double)
+
+class SharedBSECLibrary(BSECLibrary):
+    """Handles communication with a BME680 by running the BSEC library on a thread of this process."""
+
+    # Takes the same arguments as BSECLibrary, except <backend>: the simulated backends only run as a process,
+    # and <read_queue>: there's no pipe to drain.
+    # The shared library is copied to each base directory, and each copy holds one sensor's
+    # state, so only one instance per base directory can run at a time.
+
+    # Base directories with a running instance.
+    _running = set()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.backend is not None:
+            self.log.error("Error: The {} backend can't run in-process. Use BSECLibrary instead.".format(self.backend))
+            raise BSECLibraryError()
+        # There's no pipe to drain; samples are always queued as they're made.
+        if self.read_queue:
+            self.log.info("SharedBSECLibrary always queues its samples; ignoring read_queue.")
+            self.read_queue = 0
+        # Index into the C output array and output() key of each selected output.
+        self._outputs = tuple((index, key) for index, (field, key) in enumerate(OUTPUT_FIELDS) if self.field_mask & (1 << index))
+        self._lib = None
+        self._queue = None
+        self._wakeup = None
+        self.returncode = None
+
+    # Private function to build the shared library instead of the executable. Returns its path.
+    def _get_exec(self, src_dir, base_dir, shared=True):
+        return super()._get_exec(src_dir, base_dir, shared=True)
+
+    # Function to start the sensor loop thread. self.proc holds the thread while it's running.
+    def open(self):
+        if self.proc is not None:
+            self.log.warning("BSEC-Library is already running!")
+        elif self.base_dir in SharedBSECLibrary._running:
+            self.log.error("BSEC-Library is already running in {}.".format(self.base_dir))
+            raise BSECLibraryError()
+        else:
+            if self._lib is None:
+                try:
+                    self._lib = ctypes.CDLL(self.exec_path)
+                except OSError as e:
+                    self.log.error("BSEC-Library could not be loaded: {}".format(e))
+                    raise BSECLibraryError()
+                self._lib.bsec_run.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_char_p), ctypes.c_char_p, SAMPLE_CALLBACK, STATE_CALLBACK]
+                self._lib.bsec_run.restype = ctypes.c_int
+                self._lib.bsec_stop.argtypes = []
+                self._lib.bsec_stop.restype = None
+                self._lib.bsec_reset.argtypes = []
+                self._lib.bsec_reset.restype = None
+                # The C side keeps this pointer, so it must live as long as the library.
+                # The sample callback is made by each run (see _run()).
+                self._on_state = STATE_CALLBACK(self._state_saved)
+            run_command = self._run_command()
+            self.log.warning(run_command)
+            self.sequence = 0
+            self.returncode = None
+            self._queue = queue.Queue()
+            # Made before the thread starts, so every sample has a byte in the pipe and the thread owns the write end.
+            # A full pipe already wakes the reader, so writes to it don't block.
+            self._wakeup = os.pipe()
+            os.set_blocking(self._wakeup[1], False)
+            # A bsec_stop() from here on (even before bsec_run() is entered) stops this run.
+            self._lib.bsec_reset()
+            SharedBSECLibrary._running.add(self.base_dir)
+            self.proc = threading.Thread(target=self._run, args=(run_command, self._queue, self._wakeup), name='bsec-library', daemon=True)
+            self.proc.start()
+            self.log.info('BSEC-Library started.')
+
+    # Function to stop the sensor loop. It saves the BSEC state and returns within a sample;
+    # waits up to <timeout> seconds for that. A thread can't be killed, so if it's stuck
+    # (i.e. in an I2C transfer) it's left behind and this base directory can't be reopened.
+    def close(self, timeout=5):
+        if self.proc is None:
+            self.log.warning("BSEC-Library is not running!")
+        else:
+            thread = self.proc
+            self.proc = None
+            self._lib.bsec_stop()
+            thread.join(timeout)
+            if thread.is_alive():
+                self.log.warning("BSEC-Library didn't stop after {}s, leaving its thread behind.".format(timeout))
+            elif self._wakeup is not None:
+                os.close(self._wakeup[0])
+                self._wakeup = None
+            self.log.info("BSEC-Library stopped.")
+
+    # Function to ask the sensor loop to save its state and stop, without waiting.
+    # The output ends once it has. <timeout> is only there to match BSECLibrary.
+    def terminate(self, timeout=5):
+        if self.proc is not None:
+            self._lib.bsec_stop()
+
+    # Function to iterate over the output. Each value is a number, as in 'binary' mode.
+    def output(self):
+        if self.proc is None:
+            self.log.warning("No data to to parse! Have you started the BSEC-Library process?")
+            return None
+        get = self._queue.get
+        perf_counter = time.perf_counter
+        while True:
+            data = get()
+            if data is None:
+                break
+            self._read_done = perf_counter()
+            self._check_status(data['Status'])
+            yield data
+        self.log.warning("BSEC-Library ran out of data to yield!")
+
+    # Function to return a file descriptor that's readable when samples are waiting, for use with the selectors module.
+    # open() creates it.
+    def fileno(self):
+        return self._wakeup[0]
+
+    # Function to return the waiting samples without blocking. Meant to be called when
+    # fileno() is readable. Returns a (possibly empty) list of Sample objects, or None once the loop has stopped.
+    def read_available(self):
+        os.read(self._wakeup[0], 65536)
+        read_done = time.perf_counter()
+        samples = []
+        monotonic = time.monotonic()
+        while True:
+            try:
+                data = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if data is None:
+                if not samples:
+                    self.log.warning("BSEC-Library ran out of data to yield!")
+                    return None
+                # Hand these over first; the next call reports the end.
+                self._queue.put(None)
+                break
+            self._check_status(data['Status'])
+            samples.append(Sample.from_dict(data, monotonic, self.sequence))
+            self.sequence += 1
+        if self._parse_time is not None and samples:
+            parse_time = (time.perf_counter() - read_done) / len(samples)
+            for i in range(len(samples)):
+                self._parse_time.observe(parse_time)
+        return samples
+
+    # Private function to run the sensor loop. Runs on its own thread until bsec_stop() or an error.
+    # Hands its samples over through <samples> and <wakeup>, the ones open() made for this run, so a
+    # thread left behind by close() can't write into a later run's. Closes the write end of <wakeup> when it's done.
+    def _run(self, run_command, samples, wakeup):
+        args = [i.encode('UTF-8') for i in run_command]
+        argv = (ctypes.c_char_p * (len(args) + 1))(*args, None)
+        # Referenced here until bsec_run() returns, so the C side's pointer stays valid.
+        on_sample = SAMPLE_CALLBACK(functools.partial(self._sample_ready, samples, wakeup[1]))
+        try:
+            self.returncode = self._lib.bsec_run(len(args), argv, self.base_dir.encode('UTF-8'), on_sample, self._on_state)
+        finally:
+            SharedBSECLibrary._running.discard(self.base_dir)
+            samples.put(None)
+            os.close(wakeup[1])
+        if self.returncode != 0:
+            self.log.error('BSEC-Library stopped with an error ({}).'.format(self.returncode))
+
+    # Private callback for every BSEC output. Called on the sensor loop thread, with the
+    # queue and the write end of the wakeup pipe of its run.
+    def _sample_ready(self, samples, wakeup, timestamp, sequence, iaq_accuracy, values, status):
+        data = {'IAQ_Accuracy': iaq_accuracy}
+        for index, key in self._outputs:
+            data[key] = values[index]
+        data['Timestamp'] = timestamp
+        data['Sequence'] = sequence
+        data['Status'] = status
+        samples.put(data)
+        try:
+            os.write(wakeup, b'\0')
+        except BlockingIOError:
+            pass
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+# BSECLibrary Simulated Backends - (C) 2018 TimothyBrown
+Stand-ins for the bsec-library process that run anywhere Python does. The
+synthetic backend generates plausible readings (with optional error statuses)
+and the replay backend plays back a recorded stream, both through the same
+pipe and output() path as the real process.
+MIT License
+
+Usage: python3 -m bseclib.simulate [--format JSON|BIN] [--speed X] [--count N] [--fields MASK] synthetic|replay [options]
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+from bseclib import BSECLibraryError, Sample, decode_records, encode_record, mask_fields, OUTPUT_FIELDS, OUTPUT_KEYS, RECORD_HEADER, RECORD_MAGIC
+
+class SyntheticBackend:
+    """Generates readings that follow a daily cycle, with random noise and injectable error statuses."""
+
+    # speed: Multiple of real time to produce samples at, i.e. 10 for ten times faster. 0 = as fast as possible.
+    # seed: Random seed, for repeatable streams. None for a different stream every time.
+    # error_rate: Chance (0.0 to 1.0) of each sample carrying <error_status> instead of 0.
+    # error_status: BSEC status code to inject, i.e. -2 (BSEC_E_DOSTEPS_INVALIDINPUT).
+    # count: Number of samples to produce before exiting. None to run forever.
+    def __init__(self, speed=1.0, seed=None, error_rate=0.0, error_status=-2, count=None):
+        self.speed = speed
+        self.seed = seed
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.count = count
+
+    def __str__(self):
+        return 'synthetic'
+
+    # Function to return the command line that runs this backend for a BSECLibrary.
+    def command(self, library):
+        command = _base_command(library, self.speed, self.count) + ['synthetic']
+        command += ['--temp-offset', str(library.temp_offset), '--error-rate', str(self.error_rate), '--error-status', str(self.error_status)]
+        if self.seed is not None:
+            command += ['--seed', str(self.seed)]
+        return command
+
+    # Function to return the environment to run the backend with.
+    def env(self, env):
+        return _python_env(env)
+
+class ReplayBackend:
+    """Plays back a recorded stream: a SampleHistory file, binary records or JSON lines."""
+
+    # path: The recording. JSON lines and binary records are what the bsec-library process writes
+    #       in 'json' and 'binary' mode; a SampleHistory file also carries the time of each sample.
+    # speed: Multiple of real time to play back at. 0 = as fast as possible.
+    # loop: Start again from the beginning at the end of the recording.
+    # count: Number of samples to play before exiting. None to play the whole recording.
+    def __init__(self, path, speed=1.0, loop=False, count=None):
+        self.path = os.path.abspath(path)
+        self.speed = speed
+        self.loop = loop
+        self.count = count
+
+    def __str__(self):
+        return 'replay'
+
+    # Function to return the command line that runs this backend for a BSECLibrary.
+    def command(self, library):
+        command = _base_command(library, self.speed, self.count) + ['replay', self.path]
+        if self.loop:
+            command.append('--loop')
+        return command
+
+    # Function to return the environment to run the backend with.
+    def env(self, env):
+        return _python_env(env)
+
+# Returns the options shared by every backend command line.
+def _base_command(library, speed, count):
+    command = [sys.executable, '-m', 'bseclib.simulate',
+               '--format', library.output_format_string,
+               '--period', str(library.sample_rate),
+               '--speed', str(speed),
+               '--fields', str(library.field_mask)]
+    if count is not None:
+        command += ['--count', str(count)]
+    return command
+
+# Returns a copy of <env> that lets the child import this copy of bseclib.
+def _python_env(env):
+    env = dict(env)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(i for i in [package_dir, env.get('PYTHONPATH', '')] if i)
+    return env
+
+# Generator of synthetic readings as (None, dict of numbers). <period> is the simulated time between samples.
+def synthetic(period, temp_offset=0.0, seed=None, error_rate=0.0, error_status=-2):
+    rng = random.Random(seed)
+    day = 2 * math.pi / 86400
+    sequence = 0
+    while True:
+        t = sequence * period
+        phase = day * t
+        static_iaq = max(0.0, 50 + 40 * math.sin(phase + 1) + rng.gauss(0, 1))
+        temperature = 21 + 3 * math.sin(phase) + rng.gauss(0, 0.05) + temp_offset
+        humidity = min(100.0, max(0.0, 45 - 8 * math.sin(phase) + rng.gauss(0, 0.2)))
+        yield None, {
+            'Status': error_status if error_rate and rng.random() < error_rate else 0,
+            # BSEC needs a while to calibrate the gas sensor.
+            'IAQ_Accuracy': min(3, int(t // 600)),
+            'IAQ': max(0.0, static_iaq + rng.gauss(0, 2)),
+            'Temperature': temperature,
+            'Humidity': humidity,
+            'Pressure': 1013.25 + 4 * math.sin(phase / 3) + rng.gauss(0, 0.05),
+            'Gas': max(1000.0, 150000 * (1 - 0.2 * math.sin(phase + 1)) + rng.gauss(0, 1500)),
+            'Static_IAQ': static_iaq,
+            'CO2_Equivalent': 400 + 5 * static_iaq,
+            'Breath_VOC_Equivalent': 0.5 * math.exp((static_iaq - 25) / 50),
+            # The sensor reads warmer (and so drier) than the air, from its own heat.
+            'Raw_Temperature': temperature - temp_offset + 1.5,
+            'Raw_Humidity': humidity * 0.9
+        }
+        sequence += 1
+
+# Returns a recording as a list of (timestamp or None, dict of numbers). The timestamps
+# are the stored times of a SampleHistory file, or the sensor timestamps of
+# captured output; only the time between them is used.
+def read_recording(path):
+    from bseclib.history import HISTORY_MAGIC, HISTORY_VERSION, HISTORY_HEADER, HISTORY_HEADER_SIZE, HISTORY_RECORD, record_sample
+    with open(path, 'rb') as f:
+        head = f.read(len(HISTORY_MAGIC))
+        f.seek(0)
+        if head == HISTORY_MAGIC:
+            data = f.read()
+            magic, version, record_size, capacity, written = HISTORY_HEADER.unpack_from(data)
+            if version != HISTORY_VERSION or record_size != HISTORY_RECORD.size:
+                raise BSECLibraryError("{} is a version {} history file; this version reads version {}.".format(path, version, HISTORY_VERSION))
+            records = sorted(i for i in HISTORY_RECORD.iter_unpack(data[HISTORY_HEADER_SIZE:HISTORY_HEADER_SIZE + capacity * record_size]) if i[0])
+            samples = [record_sample(record) for record in records]
+            return [(sample.timestamp, sample.as_dict()) for sample in samples]
+        if len(head) >= RECORD_HEADER.size and RECORD_HEADER.unpack_from(head)[0] == RECORD_MAGIC:
+            records = list(decode_records(f))
+        else:
+            records = [Sample.from_dict(json.loads(line.decode('UTF-8')), None, None).as_dict() for line in f if line.strip()]
+        return [(data['Timestamp'] / 1000000000 if 'Timestamp' in data else None, data) for data in records]
+
+# Generator to play back a recording, optionally forever.
+def replay(recording, loop=False):
+    while True:
+        yield from recording
+        if not loop or not recording:
+            return
+
+# Decimal places the bsec-library process prints each output with, if not 2.
+JSON_DECIMALS = {'Gas': 0, 'Breath_VOC_Equivalent': 3}
+
+# Returns a line of JSON formatted the same way as the bsec-library process,
+# with the outputs that are in <data>.
+def encode_json(data):
+    line = '{{"IAQ_Accuracy": "{:d}"'.format(data['IAQ_Accuracy'])
+    for field, key in OUTPUT_FIELDS:
+        if key in data:
+            line += ', "{}": "{:.{}f}"'.format(key, data[key], JSON_DECIMALS.get(key, 2))
+    line += ', "Timestamp": "{:d}", "Sequence": "{:d}", "Status": "{:d}"}}\r\n'.format(data.get('Timestamp', 0), data.get('Sequence', 0), data['Status'])
+    return line.encode('UTF-8')
+
+# Writes <readings> to <stream>, paced at <period> / <speed> seconds per sample
+# (or by the recorded timestamps, where there are any). Like the real process, each
+# sample is stamped with CLOCK_MONOTONIC nanoseconds and an output sequence number, and
+# carries only the outputs selected by <mask> (those a recording doesn't have are left out).
+def run(readings, stream, output_format='JSON', period=3, speed=1.0, count=None, mask=0x1F):
+    encode = encode_record if output_format == 'BIN' else encode_json
+    dropped = set(OUTPUT_KEYS.values()) - set(OUTPUT_KEYS[field] for field in mask_fields(mask))
+    written = 0
+    next_time = time.monotonic()
+    last_timestamp = None
+    for timestamp, data in readings:
+        if count is not None and written >= count:
+            break
+        if speed > 0:
+            if timestamp is not None and last_timestamp is not None:
+                next_time += max(0.0, timestamp - last_timestamp) / speed
+            elif written:
+                next_time += period / speed
+            last_timestamp = timestamp
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        data = {key: value for key, value in data.items() if key not in dropped}
+        data['Timestamp'] = time.monotonic_ns()
+        data['Sequence'] = written & 0xFFFFFFFF
+        stream.write(encode(data))
+        if speed > 0:
+            stream.flush()
+        written += 1
+    stream.flush()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python3 -m bseclib.simulate', description='Stand-in for the bsec-library process.')
+    parser.add_argument('--format', default='JSON', choices=['JSON', 'BIN'], help='Output format. (Default: %(default)s)')
+    parser.add_argument('--period', type=float, default=3, help='Seconds between samples. (Default: %(default)s)')
+    parser.add_argument('--speed', type=float, default=1.0, help='Multiple of real time, 0 = as fast as possible. (Default: %(default)s)')
+    parser.add_argument('--count', type=int, default=None, help='Exit after this many samples.')
+    parser.add_argument('--fields', type=int, default=0x1F, help='Mask of the outputs to send, see OUTPUT_FIELDS. (Default: %(default)s)')
+    modes = parser.add_subparsers(dest='mode')
+    synthetic_parser = modes.add_parser('synthetic', help='Generate readings.')
+    synthetic_parser.add_argument('--temp-offset', type=float, default=0.0)
+    synthetic_parser.add_argument('--seed', type=int, default=None)
+    synthetic_parser.add_argument('--error-rate', type=float, default=0.0)
+    synthetic_parser.add_argument('--error-status', type=int, default=-2)
+    replay_parser = modes.add_parser('replay', help='Play back a recording.')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--loop', action='store_true')
+    args = parser.parse_args()
+
+    if args.mode == 'synthetic':
+        readings = synthetic(args.period, args.temp_offset, args.seed, args.error_rate, args.error_status)
+    elif args.mode == 'replay':
+        readings = replay(read_recording(args.path), args.loop)
+    else:
+        parser.print_help()
+        exit(1)
+    try:
+        run(readings, sys.stdout.buffer, args.format, args.period, args.speed, args.count, args.fields)
+    except (BrokenPipeError, KeyboardInterrupt):
+        # The reader went away; don't complain about it on the way out.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+# BSEC-Conduit Sinks - (C) 2018 TimothyBrown
+Fans published windows (and optionally raw samples) out to any number of
+destinations. Each sink has its own bounded queue and writer thread, so a
+slow or stuck destination never holds up reading the sensor.
+MIT License
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import logging
+import threading
+import importlib
+from collections import deque
+from bseclib import BSECLibraryError, OUTPUT_FIELDS
+from bseclib.window import ROLLUP_STATS
+
+# Columns written by FileSink in CSV format, followed by any others the windows carry (i.e. analytics).
+# Rollups take one row per statistic.
+CSV_COLUMNS = ('timestamp', 'sensor', 'kind', 'resolution', 'stat', 'status', 'iaq_accuracy') + tuple(field for field, key in OUTPUT_FIELDS)
+# Largest datagram InfluxSink sends over UDP; more lines are split over several.
+INFLUX_UDP_PAYLOAD = 1400
+
+class SinkRecord:
+    """One published window, rollup or raw sample, as handed to Sink.write()."""
+    __slots__ = ('kind', 'sensor', 'topic', 'timestamp', 'values', 'resolution', 'queued')
+
+    # kind: 'window' for published values, 'rollup' for a rollup, 'sample' for a raw sample.
+    # sensor: The [Sensor:<name>] name, or None for the single [Sensor].
+    # topic: The sensor's MQTT topic.
+    # timestamp: Wall clock time (time.time()) of the record.
+    # values: Dict of Sample attribute names to values. Windows carry the published values
+    #         (rounded, converted, and the IAQ accuracy as a name); samples carry the raw numbers and the status.
+    #         Rollups carry a dict of ROLLUP_STATS to values for each field.
+    # resolution: The name of a rollup's resolution, i.e. '15m'. None for the others.
+    def __init__(self, kind, sensor, topic, timestamp, values, resolution=None):
+        self.kind = kind
+        self.sensor = sensor
+        self.topic = topic
+        self.timestamp = timestamp
+        self.values = values
+        self.resolution = resolution
+        # When it was handed to the sinks, for their latency.
+        self.queued = time.perf_counter()
+
+    def __repr__(self):
+        return 'SinkRecord({})'.format(', '.join('{}={}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+class Sink:
+    """Base class for a destination. Subclasses implement write(), which runs on the sink's own thread."""
+
+    # name: Used in the thread name, log messages and the metric labels.
+    # queue_size: Records held while write() catches up.
+    # policy: What to do with a new record when the queue is full.
+    #         'drop_oldest': Drop the oldest queued record to make room.
+    #         'drop_newest': Drop the new record.
+    # samples: If True, the sink gets every raw sample as well as the published windows.
+    # batch_size: Most records handed to write() at once.
+    # metrics: Optional bseclib.metrics registry to record the queue depth, drops, errors and latency in.
+    def __init__(self, name, queue_size=1000, policy='drop_oldest', samples=False, batch_size=100, metrics=None, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+
+        if policy != 'drop_oldest' and policy != 'drop_newest':
+            self.log.error("Error: <policy> must be one of 'drop_oldest' or 'drop_newest'.")
+            raise BSECLibraryError()
+        if queue_size < 1 or batch_size < 1:
+            self.log.error("Error: <queue_size> and <batch_size> must be at least 1.")
+            raise BSECLibraryError()
+        self.name = name
+        self.queue_size = queue_size
+        self.policy = policy
+        self.samples = samples
+        self.batch_size = batch_size
+        # Records dropped because the queue was full, and write() calls that raised.
+        self.dropped = 0
+        self.errors = 0
+
+        self._queue = deque()
+        self._ready = threading.Condition()
+        self._closing = False
+        self._failing = False
+        self._thread = None
+        if metrics is not None:
+            metrics.gauge('sink_queue_depth', 'Records waiting for a sink.', function = lambda: len(self._queue), sink = name)
+            self._dropped = metrics.counter('sink_dropped_total', 'Records a sink dropped because its queue was full.', sink = name)
+            self._errors = metrics.counter('sink_errors_total', 'Sink writes that failed.', sink = name)
+            self._write_time = metrics.histogram('sink_write_seconds', 'Time for a sink to write one batch.', sink = name)
+            self._latency = metrics.histogram('sink_latency_seconds', 'Time from a record being queued to a sink writing it.', sink = name)
+        else:
+            self._dropped = self._errors = self._write_time = self._latency = None
+
+    # Function to start the writer thread.
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sink-{}'.format(self.name), daemon=True)
+            self._thread.start()
+
+    # Function to queue a record. Never blocks on the writer; returns False if the record was dropped.
+    def put(self, record):
+        with self._ready:
+            queue = self._queue
+            if len(queue) >= self.queue_size:
+                self.dropped += 1
+                if self._dropped is not None:
+                    self._dropped.inc()
+                if self.policy == 'drop_newest':
+                    return False
+                queue.popleft()
+            queue.append(record)
+            self._ready.notify()
+        return True
+
+    # Function to write a batch of SinkRecords. Runs on the sink's thread; exceptions are logged and counted.
+    def write(self, records):
+        raise NotImplementedError()
+
+    # Function to release anything write() holds open. Called once the writer thread is done.
+    def finish(self):
+        pass
+
+    # Function to tell the writer thread to stop once it has written what's queued, without waiting.
+    def stop(self):
+        with self._ready:
+            self._closing = True
+            self._ready.notify()
+
+    # Function to write what's still queued and stop the writer thread, waiting up to <timeout> seconds.
+    def close(self, timeout=5):
+        self.stop()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                self.log.warning("Sink {} didn't finish writing in time, leaving {} records behind.".format(self.name, len(self._queue)))
+                return
+        self.finish()
+
+    # Private function run on the writer thread until close().
+    def _run(self):
+        queue = self._queue
+        perf_counter = time.perf_counter
+        while True:
+            with self._ready:
+                while not queue and not self._closing:
+                    self._ready.wait()
+                if not queue:
+                    return
+                batch = [queue.popleft() for i in range(min(len(queue), self.batch_size))]
+            started = perf_counter()
+            try:
+                self.write(batch)
+            except Exception as e:
+                self.errors += 1
+                if self._errors is not None:
+                    self._errors.inc()
+                # Only log the first of a run of failures.
+                if not self._failing:
+                    self.log.warning("Sink {} failed to write {} records: {}".format(self.name, len(batch), e))
+                    self._failing = True
+                continue
+            done = perf_counter()
+            if self._failing:
+                self.log.info("Sink {} is writing again.".format(self.name))
+                self._failing = False
+            if self._write_time is not None:
+                self._write_time.observe(done - started)
+                for record in batch:
+                    self._latency.observe(done - record.queued)
+
+class SinkPipeline:
+    """Hands each published window and raw sample to every sink, without waiting for any of them."""
+
+    def __init__(self, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+        self.sinks = []
+        self._sample_sinks = []
+
+    # Function to add and start a sink.
+    def add(self, sink):
+        self.sinks.append(sink)
+        if sink.samples:
+            self._sample_sinks.append(sink)
+        sink.start()
+        self.log.info("Started sink {}.".format(sink.name))
+
+    # Function to dispatch the published values of a window.
+    def window(self, sensor, topic, values, timestamp=None):
+        record = SinkRecord('window', sensor, topic, time.time() if timestamp is None else timestamp, values)
+        for sink in self.sinks:
+            sink.put(record)
+
+    # Function to dispatch a rollup: {field: {stat: value}} for one resolution.
+    def rollup(self, sensor, topic, resolution, values, timestamp=None):
+        record = SinkRecord('rollup', sensor, topic, time.time() if timestamp is None else timestamp, values, resolution)
+        for sink in self.sinks:
+            sink.put(record)
+
+    # Function to dispatch a raw Sample to the sinks that asked for them.
+    def sample(self, sensor, topic, sample, timestamp=None):
+        if not self._sample_sinks:
+            return
+        values = {'status': sample.status, 'iaq_accuracy': sample.iaq_accuracy}
+        for field, key in OUTPUT_FIELDS:
+            value = getattr(sample, field)
+            if value is not None:
+                values[field] = value
+        record = SinkRecord('sample', sensor, topic, time.time() if timestamp is None else timestamp, values)
+        for sink in self._sample_sinks:
+            sink.put(record)
+
+    # Function to let every sink write what it has queued, then stop them. Waits up to <timeout> seconds in all.
+    def close(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        for sink in self.sinks:
+            sink.stop()
+        for sink in self.sinks:
+            sink.close(max(deadline - time.monotonic(), 0))
+        self.sinks = []
+        self._sample_sinks = []
+
+class MQTTSink(Sink):
+    """Publishes windows as retained topics under the sensor's topic, rollups under <topic>/<resolution>
+    with a JSON object of statistics per field, and raw samples as JSON to <topic>/sample."""
+
+    # publish: Callable(topic, payload, qos, retain), i.e. paho's Client.publish or a MessageSpool.
+    # qos: MQTT QoS of the messages.
+    # bundle_state: If True, publish each window as one JSON message to <topic>/state instead of a topic per value.
+    # deadband: Optional bseclib.deadband.Deadband; window values are only published once they've moved
+    #           outside it or their heartbeat is due. Raw samples are always published.
+    # All three can be changed while running.
+    def __init__(self, name, publish, qos=0, bundle_state=False, deadband=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self._publish = publish
+        self.qos = qos
+        self.bundle_state = bundle_state
+        self.deadband = deadband
+
+    def write(self, records):
+        publish = self._publish
+        for record in records:
+            if record.kind == 'sample':
+                publish('{}/sample'.format(record.topic), json.dumps(record.values), self.qos, False)
+                continue
+            if record.kind == 'rollup':
+                topic = '{}/{}'.format(record.topic, record.resolution)
+                if self.bundle_state:
+                    publish('{}/state'.format(topic), json.dumps(record.values), self.qos, True)
+                else:
+                    for field, stats in record.values.items():
+                        publish('{}/{}'.format(topic, field), json.dumps(stats), self.qos, True)
+                continue
+            values = record.values
+            deadband = self.deadband
+            if deadband is not None:
+                # Keyed by topic, so a new topic starts with everything published.
+                values = deadband.filter(record.topic, values, bundle=self.bundle_state)
+                if not values:
+                    continue
+            if self.bundle_state:
+                publish('{}/state'.format(record.topic), json.dumps(values), self.qos, True)
+            else:
+                for field, value in values.items():
+                    publish('{}/{}'.format(record.topic, field), value, self.qos, True)
+
+class InfluxSink(Sink):
+    """Writes InfluxDB line protocol, to a UDP listener or appended to a file."""
+
+    # target: 'udp://<host>:<port>', or the path of a file to append to.
+    # measurement: Measurement name prefix. Each kind of record goes to its own measurement, <measurement>_<kind>
+    #              (i.e. bsec_sample, bsec_window and bsec_rollup), as their fields don't have the same types:
+    #              a window's iaq_accuracy is a name, a sample's a number. Each line is tagged with the sensor
+    #              name (if any) and a rollup's resolution. Rollup fields are named <field>_<stat>.
+    def __init__(self, name, target, measurement='bsec', **kwargs):
+        super().__init__(name, **kwargs)
+        self.target = target
+        self.measurements = {kind: _influx_escape('{}_{}'.format(measurement, kind), ', ') for kind in ('sample', 'window', 'rollup')}
+        self._socket = None
+        self._file = None
+        if target.startswith('udp://'):
+            host, port = target[6:].rsplit(':', 1)
+            self._address = (host.strip('[]'), int(port))
+            self._socket = socket.socket(socket.AF_INET6 if ':' in self._address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self._file = open(target, 'a', encoding='UTF-8')
+
+    def write(self, records):
+        lines = [self._line(record) for record in records]
+        if self._file is not None:
+            self._file.write(''.join(lines))
+            self._file.flush()
+            return
+        # Pack as many lines as fit into each datagram.
+        payload = b''
+        for line in lines:
+            line = line.encode('UTF-8')
+            if payload and len(payload) + len(line) > INFLUX_UDP_PAYLOAD:
+                self._socket.sendto(payload, self._address)
+                payload = b''
+            payload += line
+        if payload:
+            self._socket.sendto(payload, self._address)
+
+    # Private function to format a record as one line, with a nanosecond timestamp.
+    def _line(self, record):
+        tags = ''
+        if record.sensor is not None:
+            tags += ',sensor={}'.format(_influx_escape(record.sensor, ',= '))
+        if record.resolution is not None:
+            tags += ',resolution={}'.format(_influx_escape(record.resolution, ',= '))
+        fields = []
+        for field, value in record.values.items():
+            if isinstance(value, dict):
+                fields.extend(_influx_field('{}_{}'.format(field, stat), stat_value) for stat, stat_value in value.items())
+            else:
+                fields.append(_influx_field(field, value))
+        fields = [field for field in fields if field is not None]
+        return '{}{} {} {}\n'.format(self.measurements[record.kind], tags, ','.join(fields), int(record.timestamp * 1000000000))
+
+    def finish(self):
+        if self._file is not None:
+            self._file.close()
+        if self._socket is not None:
+            self._socket.close()
+
+class FileSink(Sink):
+    """Appends records to a CSV or JSON Lines file."""
+
+    # path: File to append to. A CSV file gets a header row when it's created.
+    # format: 'csv' or 'jsonl'.
+    # columns: Extra CSV columns after CSV_COLUMNS, i.e. the analytics values (<field>_<stat>) windows will carry.
+    #          A window with values that have no column adds them: the file so far is moved aside to
+    #          <path>.<date>-<time> and a new one started with the wider header, so nothing is dropped.
+    def __init__(self, name, path, format='jsonl', columns=(), **kwargs):
+        super().__init__(name, **kwargs)
+        format = format.lower()
+        if format != 'csv' and format != 'jsonl':
+            self.log.error("Error: <format> must be one of 'csv' or 'jsonl'.")
+            raise BSECLibraryError()
+        self.path = path
+        self.format = format
+        if format == 'csv':
+            self._open_csv(CSV_COLUMNS + tuple(column for column in columns if column not in CSV_COLUMNS))
+        else:
+            self._file = open(path, 'a', encoding='UTF-8', newline='')
+
+    def write(self, records):
+        if self.format == 'csv':
+            new = [key for record in records if record.kind == 'window' for key in record.values if key not in self._known]
+            if new:
+                self._file.close()
+                self._open_csv(self.columns + tuple(dict.fromkeys(new)))
+            self._csv.writerows(row for record in records for row in _csv_rows(record, self.columns))
+        else:
+            self._file.write(''.join(_json_line(record) for record in records))
+        self._file.flush()
+
+    def finish(self):
+        self._file.close()
+
+    # Private function to open the CSV file for at least <columns>. An existing file is appended to if its
+    # header has all of them (in whatever order), and otherwise moved aside.
+    def _open_csv(self, columns):
+        try:
+            with open(self.path, 'rt', encoding='UTF-8', newline='') as f:
+                header = tuple(next(csv.reader(f), ()))
+        except FileNotFoundError:
+            header = ()
+        if header[:len(CSV_COLUMNS)] == CSV_COLUMNS and set(columns) <= set(header):
+            columns = header
+        elif header:
+            moved = '{}.{}'.format(self.path, time.strftime('%Y%m%d-%H%M%S'))
+            os.replace(self.path, moved)
+            self.log.warning("Sink {} has new CSV columns, moved the old file to {}.".format(self.name, moved))
+        self.columns = columns
+        self._known = set(columns)
+        self._file = open(self.path, 'a', encoding='UTF-8', newline='')
+        self._csv = csv.writer(self._file)
+        if self._file.tell() == 0:
+            self._csv.writerow(columns)
+            self._file.flush()
+
+class StdoutSink(Sink):
+    """Prints records to standard output as JSON Lines (under Systemd, that's the journal)."""
+
+    def write(self, records):
+        sys.stdout.write(''.join(_json_line(record) for record in records))
+        sys.stdout.flush()
+
+# Sink types that can be created by name.
+SINK_TYPES = {
+    'influx': InfluxSink,
+    'file': FileSink,
+    'stdout': StdoutSink
+}
+
+# Returns a new sink of <sink_type>: one of SINK_TYPES, or '<module>:<class>' for a Sink subclass
+# from any importable module. <kwargs> are passed to the constructor.
+def create_sink(sink_type, name, **kwargs):
+    if ':' in sink_type:
+        module, cls = sink_type.split(':', 1)
+        try:
+            sink_class = getattr(importlib.import_module(module), cls)
+        except (ImportError, AttributeError) as e:
+            raise BSECLibraryError("Could not load sink type {}: {}".format(sink_type, e))
+        if not (isinstance(sink_class, type) and issubclass(sink_class, Sink)):
+            raise BSECLibraryError("Sink type {} isn't a subclass of bseclib.sinks.Sink.".format(sink_type))
+    elif sink_type in SINK_TYPES:
+        sink_class = SINK_TYPES[sink_type]
+    else:
+        raise BSECLibraryError("Unknown sink type: {} (Choose from: {}, or <module>:<class>)".format(sink_type, ', '.join(SINK_TYPES)))
+    return sink_class(name, **kwargs)
+
+# Returns a record as a list of CSV rows in <columns> order (CSV_COLUMNS and any extras): one, or one per statistic for a rollup.
+def _csv_rows(record, columns=CSV_COLUMNS):
+    values = record.values
+    start = [record.timestamp, '' if record.sensor is None else record.sensor, record.kind]
+    if record.kind != 'rollup':
+        return [start + ['', ''] + [values.get(column, '') for column in columns[5:]]]
+    return [start + [record.resolution, stat] + [values[column][stat] if column in values else '' for column in columns[5:]]
+            for stat in ROLLUP_STATS]
+
+# Returns a record as one line of JSON.
+def _json_line(record):
+    data = {'timestamp': record.timestamp, 'sensor': record.sensor, 'kind': record.kind}
+    if record.resolution is not None:
+        data['resolution'] = record.resolution
+    data.update(record.values)
+    return json.dumps(data) + '\n'
+
+# Returns a line protocol field, or None for a missing value.
+# Numbers are always written as floats, so a field keeps one type whether it's rounded or not.
+def _influx_field(name, value):
+    if isinstance(value, str):
+        return '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+    if value is None:
+        return None
+    return '{}={}'.format(name, float(value))
+
+# Returns <value> with each of <characters> backslash escaped, for line protocol names and tags.
+def _influx_escape(value, characters):
+    for character in characters:
+        value = value.replace(character, '\\' + character)
+    return value
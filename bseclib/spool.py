@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+# BSEC-Conduit Message Spool - (C) 2018 TimothyBrown
+Bounded, disk-backed store-and-forward queue for messages published while the broker is unreachable.
+MIT License
+"""
+
+import time
+import logging
+import sqlite3
+import threading
+from bseclib import BSECLibraryError
+
+class MessageSpool:
+    """Stores messages on disk while disconnected and replays them in order once reconnected."""
+
+    # path: SQLite database file used for the spool.
+    # publish: Callable(topic, payload, qos, retain) that returns True if the message was sent.
+    # max_messages: Upper bound on the number of stored messages.
+    # policy: What to do when the spool is full.
+    #         'drop_oldest': Delete the oldest message.
+    #         'summarize': Collapse the oldest half of the spool into one message per topic
+    #                      (the mean for numeric payloads, otherwise the latest payload).
+    # batch_size: Number of messages sent per replay batch.
+    # batch_interval: Seconds to wait between replay batches.
+    def __init__(self, path, publish, max_messages=10000, policy='drop_oldest', batch_size=100, batch_interval=1.0, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+
+        if policy != 'drop_oldest' and policy != 'summarize':
+            self.log.error("Error: <policy> must be one of 'drop_oldest' or 'summarize'.")
+            raise BSECLibraryError()
+        if max_messages < 2:
+            self.log.error("Error: <max_messages> must be at least 2.")
+            raise BSECLibraryError()
+        self.path = path
+        self._publish = publish
+        self.max_messages = max_messages
+        self.policy = policy
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.dropped = 0
+        self.connected = False
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, timestamp REAL, topic TEXT, payload BLOB, qos INTEGER, retain INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_order ON messages (timestamp, id)')
+        self.count = self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        if self.count:
+            self.log.info("Found {} spooled messages in [{}].".format(self.count, path))
+
+    # Function to publish a message, or spool it if we're disconnected.
+    # While older messages are still spooled, new ones are spooled behind them to keep the order.
+    def publish(self, topic, payload, qos=0, retain=False, timestamp=None):
+        with self._lock:
+            if self.connected and self.count == 0:
+                if self._publish(topic, payload, qos, retain):
+                    return
+            if timestamp is None:
+                timestamp = time.time()
+            if self.count >= self.max_messages:
+                self._overflow()
+            if isinstance(payload, str):
+                payload = payload.encode('UTF-8')
+            elif not isinstance(payload, bytes):
+                payload = str(payload).encode('UTF-8')
+            self._db.execute('INSERT INTO messages (timestamp, topic, payload, qos, retain) VALUES (?, ?, ?, ?, ?)',
+                             (timestamp, topic, payload, qos, int(retain)))
+            self.count += 1
+
+    # Function to tell the spool about the broker connection state. Starts the replay on connect.
+    def set_connected(self, connected):
+        self.connected = connected
+        if connected and self.count:
+            # Let a replay from a previous connection finish before starting a new one.
+            if self._thread is not None:
+                self._thread.join()
+            self._wake.clear()
+            self._thread = threading.Thread(target=self._replay, name='spool-replay', daemon=True)
+            self._thread.start()
+        elif not connected:
+            self._wake.set()
+
+    # Private function to make room for a new message. Called with the lock held.
+    def _overflow(self):
+        if self.policy == 'summarize':
+            rows = self._db.execute('SELECT id, timestamp, topic, payload, qos, retain FROM messages ORDER BY timestamp, id LIMIT ?',
+                                    (self.max_messages // 2,)).fetchall()
+            topics = {}
+            for row in rows:
+                topics.setdefault(row[2], []).append(row)
+            summaries = []
+            for topic, messages in topics.items():
+                try:
+                    values = [float(message[3]) for message in messages]
+                    payload = str(round(sum(values) / len(values), 2)).encode('UTF-8')
+                except ValueError:
+                    payload = messages[-1][3]
+                last = messages[-1]
+                summaries.append((last[1], topic, payload, last[4], last[5]))
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY timestamp, id LIMIT ?)', (len(rows),))
+            self._db.executemany('INSERT INTO messages (timestamp, topic, payload, qos, retain) VALUES (?, ?, ?, ?, ?)', summaries)
+            self._db.execute('COMMIT')
+            self.dropped += len(rows) - len(summaries)
+            self.count += len(summaries) - len(rows)
+            self.log.warning("Spool full, summarized {} messages into {}.".format(len(rows), len(summaries)))
+        if self.count >= self.max_messages:
+            self._db.execute('DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY timestamp, id LIMIT 1)')
+            self.count -= 1
+            self.dropped += 1
+
+    # Private function run on a thread to replay spooled messages in batches.
+    def _replay(self):
+        self.log.info("Replaying {} spooled messages.".format(self.count))
+        while self.connected:
+            with self._lock:
+                rows = self._db.execute('SELECT id, topic, payload, qos, retain FROM messages ORDER BY timestamp, id LIMIT ?',
+                                        (self.batch_size,)).fetchall()
+                sent = []
+                for id, topic, payload, qos, retain in rows:
+                    if not self.connected or not self._publish(topic, payload, qos, bool(retain)):
+                        break
+                    sent.append((id,))
+                if sent:
+                    self._db.executemany('DELETE FROM messages WHERE id = ?', sent)
+                    self.count -= len(sent)
+                if self.count == 0:
+                    self.log.info("Spool replay complete.")
+                    return
+                if len(sent) < len(rows):
+                    self.log.warning("Spool replay interrupted, {} messages left.".format(self.count))
+                    return
+            # Rate limit between batches; wakes early if we disconnect.
+            if self._wake.wait(self.batch_interval):
+                return
+
+    # Function to stop the replay and close the database.
+    def close(self):
+        self.connected = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+# BSECSupervisor - (C) 2018 TimothyBrown
+Runs several BSECLibrary processes and reads all of their output in a single loop.
+MIT License
+"""
+
+import logging
+import selectors
+import time
+from bseclib import BSECLibraryError
+
+class BSECSupervisor:
+    """Runs several BSECLibrary instances and multiplexes their output."""
+
+    # libraries: Dict of {name: BSECLibrary}. Any object with open(), close(), terminate(),
+    #            fileno() and read_available() will do, e.g. fake children in tests.
+    # restart_delay: Seconds to wait before restarting a failed process.
+    # max_restarts: Give up (raise BSECLibraryError) after this many restarts of one process.
+    def __init__(self, libraries, logger=None, restart_delay=5, max_restarts=5):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+
+        if len(libraries) == 0:
+            self.log.error("Error: <libraries> must contain at least one BSECLibrary.")
+            raise BSECLibraryError()
+        self.libraries = dict(libraries)
+        self.restart_delay = restart_delay
+        self.max_restarts = max_restarts
+        self.restarts = {name: 0 for name in self.libraries}
+        self.selector = None
+        # Dict of {name: monotonic time} for processes waiting to be restarted.
+        self._pending = {}
+        # Names of processes that have been closed, and whether terminate() was called.
+        self._stopped = set()
+        self._terminating = False
+
+    # Function to start every bsec-library process.
+    def open(self):
+        if self.selector is not None:
+            self.log.warning("BSEC-Supervisor is already running!")
+        else:
+            self.selector = selectors.DefaultSelector()
+            self._terminating = False
+            for name in self.libraries:
+                self._start(name)
+
+    # Function to stop every bsec-library process.
+    def close(self):
+        if self.selector is None:
+            self.log.warning("BSEC-Supervisor is not running!")
+        else:
+            for name in self.libraries:
+                if name not in self._pending and name not in self._stopped:
+                    self._stop(name)
+            self._pending = {}
+            self.selector.close()
+            self.selector = None
+
+    # Function to ask every process to save its state and exit, without waiting.
+    # Safe to call from a signal handler: output() stops, without restarting anything,
+    # once they've all exited. Each is killed if it's still running after <timeout> seconds.
+    def terminate(self, timeout=5):
+        self._terminating = True
+        self._pending = {}
+        for name, library in self.libraries.items():
+            if name not in self._stopped:
+                library.terminate(timeout)
+
+    # Function to iterate over the output of every process. Yields (name, Sample) tuples.
+    def output(self):
+        if self.selector is None:
+            self.log.warning("No data to to parse! Have you started the BSEC-Supervisor?")
+            return None
+        while self.selector is not None:
+            if self._terminating and not self.selector.get_map():
+                return
+            timeout = self._restart_pending()
+            for key, events in self.selector.select(timeout):
+                name = key.data
+                try:
+                    samples = self.libraries[name].read_available()
+                except BSECLibraryError:
+                    samples = None
+                if samples is None:
+                    if self._terminating:
+                        self._stop(name)
+                    else:
+                        self._failed(name)
+                    continue
+                for sample in samples:
+                    yield name, sample
+
+    # Private function to open a process and register its output.
+    def _start(self, name):
+        library = self.libraries[name]
+        library.open()
+        self._stopped.discard(name)
+        self.selector.register(library.fileno(), selectors.EVENT_READ, name)
+        self.log.info("Sensor [{}] started.".format(name))
+
+    # Private function to unregister a process and close it.
+    def _stop(self, name):
+        library = self.libraries[name]
+        try:
+            self.selector.unregister(library.fileno())
+        except (KeyError, ValueError):
+            pass
+        library.close()
+        self._stopped.add(name)
+
+    # Private function to stop a failed process and schedule a restart.
+    def _failed(self, name):
+        self._stop(name)
+        self.restarts[name] += 1
+        if self.restarts[name] > self.max_restarts:
+            self.log.error("Sensor [{}] failed {} times, giving up.".format(name, self.restarts[name]))
+            raise BSECLibraryError()
+        self.log.warning("Sensor [{}] failed, restarting in {}s ({} of {}).".format(name, self.restart_delay, self.restarts[name], self.max_restarts))
+        self._pending[name] = time.monotonic() + self.restart_delay
+
+    # Private function to restart processes whose delay has passed.
+    # Returns the select() timeout until the next pending restart, or None.
+    def _restart_pending(self):
+        if not self._pending:
+            return None
+        now = time.monotonic()
+        for name, due in list(self._pending.items()):
+            if due <= now:
+                del self._pending[name]
+                self._start(name)
+        if not self._pending:
+            return None
+        return max(min(self._pending.values()) - now, 0)
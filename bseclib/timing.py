@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+# BSECLibrary Sample Timing - (C) 2018 TimothyBrown
+Uses the sensor timestamp and sequence number of each sample to measure pipe
+latency and cadence jitter, and to count missed and dropped samples.
+MIT License
+"""
+
+import logging
+
+class SampleTiming:
+    """Timing checks for one stream of samples."""
+
+    # period: Expected seconds between samples (BSECLibrary.sample_period). 0 skips the cadence checks.
+    # metrics: Optional bseclib.metrics registry to record the results in.
+    def __init__(self, period, metrics=None, logger=None):
+        # If the user doesn't pass a logger object, create one.
+        if logger is None:
+            logger = __name__
+        self.log = logging.getLogger(logger)
+        self.period = period
+        # Seconds from the sensor reading to us reading the sample, for the last sample.
+        self.latency = None
+        # Seconds the last interval between samples differed from the cadence.
+        self.jitter = None
+        # Samples the sensor loop didn't produce on time (gaps in the sensor timestamps).
+        self.missed = 0
+        # Samples that were produced but never reached us (gaps in the sequence numbers).
+        self.dropped = 0
+        self._last_time = None
+        self._last_sequence = None
+        if metrics is not None:
+            self._latency = metrics.histogram('bsec_pipe_latency_seconds', 'Time from the sensor reading to the sample being read.')
+            self._jitter = metrics.histogram('bsec_jitter_seconds', 'Difference between the time between samples and the sample rate.')
+            self._missed = metrics.counter('bsec_missed_samples_total', 'Samples the sensor loop skipped.')
+            self._dropped = metrics.counter('bsec_dropped_samples_total', 'Samples lost between BSEC-Library and the reader.')
+        else:
+            self._latency = self._jitter = self._missed = self._dropped = None
+
+    # Function to check a Sample. Samples without a sensor timestamp are ignored.
+    def add(self, sample):
+        sensor_time = sample.sensor_time
+        if sensor_time is None:
+            return
+        sequence = sample.sensor_sequence
+        self.latency = sample.timestamp - sensor_time
+        if self._latency is not None:
+            self._latency.observe(self.latency)
+
+        # A sequence that goes backwards means the process was restarted; start over.
+        if sequence is not None and self._last_sequence is not None and sequence < self._last_sequence:
+            self._last_time = None
+        if self._last_time is not None:
+            if sequence is not None and self._last_sequence is not None and sequence > self._last_sequence + 1:
+                dropped = sequence - self._last_sequence - 1
+                self.dropped += dropped
+                if self._dropped is not None:
+                    self._dropped.inc(dropped)
+                self.log.warning("Lost {} samples between BSEC-Library and the reader.".format(dropped))
+            if self.period:
+                interval = sensor_time - self._last_time
+                expected = max(1, round(interval / self.period))
+                self.jitter = interval - expected * self.period
+                if self._jitter is not None:
+                    self._jitter.observe(abs(self.jitter))
+                if expected > 1:
+                    self.missed += expected - 1
+                    if self._missed is not None:
+                        self._missed.inc(expected - 1)
+                    self.log.warning("Sensor skipped {} samples ({:.1f}s between samples).".format(expected - 1, interval))
+        self._last_time = sensor_time
+        self._last_sequence = sequence
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+# BSECLibrary Window Statistics - (C) 2018 TimothyBrown
+Streaming statistics over sliding and tumbling sample windows.
+MIT License
+"""
+
+from collections import deque
+from math import fsum, sqrt
+
+class RunningStats:
+    """Running count, sum, mean and last value over a window of values, plus min, max and variance if asked for."""
+    __slots__ = ('size', 'full', 'values', 'total', '_sum', '_scale', '_mean', '_m2', '_mins', '_maxs', '_evictions')
+
+    # size: Number of values to keep (sliding window). Use None for a tumbling
+    # window that grows until reset() is called.
+    # full: Also keep the min, max and variance. A cache only publishes the mean,
+    # so they're left out unless something (i.e. a rollup) reads them.
+    def __init__(self, size=None, full=False):
+        if size is not None and size < 1:
+            raise ValueError("<size> must be at least 1.")
+        self.size = size
+        self.full = full
+        self.reset()
+
+    # Function to clear the window.
+    def reset(self):
+        self.values = deque()
+        self.total = 0
+        # The sum is kept exactly as an integer scaled by 2**_scale, so the mean
+        # is correctly rounded and matches statistics.mean() to the last bit.
+        self._sum = 0
+        self._scale = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._mins = deque()
+        self._maxs = deque()
+        self._evictions = 0
+
+    # Function to add a value, evicting the oldest one if the window is full. O(1) amortized.
+    def add(self, value):
+        values = self.values
+        if self.size is not None and len(values) == self.size:
+            self._evict()
+        values.append(value)
+        # Exact running sum.
+        num, den = value.as_integer_ratio()
+        shift = den.bit_length() - 1
+        if shift > self._scale:
+            self._sum <<= shift - self._scale
+            self._scale = shift
+        self._sum += num << (self._scale - shift)
+        index = self.total
+        self.total = index + 1
+        if not self.full:
+            return
+        # Welford update.
+        n = len(values)
+        delta = value - self._mean
+        self._mean += delta / n
+        self._m2 += delta * (value - self._mean)
+        # Monotonic queues for the window min and max.
+        mins = self._mins
+        while mins and mins[-1][1] >= value:
+            mins.pop()
+        mins.append((index, value))
+        maxs = self._maxs
+        while maxs and maxs[-1][1] <= value:
+            maxs.pop()
+        maxs.append((index, value))
+
+    # Function to drop the oldest value, i.e. for windows bounded by time instead of count.
+    def evict(self):
+        if self.values:
+            self._evict()
+
+    # Private function to drop the oldest value from the window.
+    def _evict(self):
+        values = self.values
+        index = self.total - len(values)
+        value = values.popleft()
+        n = len(values)
+        num, den = value.as_integer_ratio()
+        self._sum -= num << (self._scale - (den.bit_length() - 1))
+        self._evictions += 1
+        if n == 0 or self._evictions >= (n if self.size is None else self.size):
+            # Once per full turn of the window, recompute the variance from scratch
+            # so rounding errors from the running updates can't accumulate.
+            self._resync()
+        elif self.full:
+            delta = value - self._mean
+            self._mean -= delta / n
+            self._m2 -= delta * (value - self._mean)
+        if self.full:
+            if self._mins[0][0] == index:
+                self._mins.popleft()
+            if self._maxs[0][0] == index:
+                self._maxs.popleft()
+
+    # Private function to recompute the Welford mean and variance from the stored values.
+    # An empty window also starts the exact sum over, so its scale doesn't keep growing.
+    def _resync(self):
+        values = self.values
+        self._evictions = 0
+        if not values:
+            self._sum = 0
+            self._scale = 0
+        if values and self.full:
+            mean = self._mean = self.mean
+            self._m2 = fsum((v - mean) * (v - mean) for v in values)
+        else:
+            self._mean = 0.0
+            self._m2 = 0.0
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    @property
+    def sum(self):
+        return self._sum / (1 << self._scale)
+
+    @property
+    def mean(self):
+        if not self.values:
+            raise ValueError("mean requires at least one value.")
+        return self._sum / (len(self.values) << self._scale)
+
+    @property
+    def min(self):
+        if not self.full:
+            raise ValueError("min requires RunningStats(full=True).")
+        if not self.values:
+            raise ValueError("min requires at least one value.")
+        return self._mins[0][1]
+
+    @property
+    def max(self):
+        if not self.full:
+            raise ValueError("max requires RunningStats(full=True).")
+        if not self.values:
+            raise ValueError("max requires at least one value.")
+        return self._maxs[0][1]
+
+    @property
+    def last(self):
+        if not self.values:
+            raise ValueError("last requires at least one value.")
+        return self.values[-1]
+
+    # Sample variance (same as statistics.variance()).
+    @property
+    def variance(self):
+        if not self.full:
+            raise ValueError("variance requires RunningStats(full=True).")
+        if len(self.values) < 2:
+            raise ValueError("variance requires at least two values.")
+        return max(self._m2, 0.0) / (len(self.values) - 1)
+
+    @property
+    def stdev(self):
+        return sqrt(self.variance)
+
+class WindowAggregator:
+    """Aggregates Sample attributes over a window and signals when it's time to publish."""
+
+    # fields: Sample attribute names to aggregate.
+    # size: Number of samples kept per field (the [Cache] size).
+    # interval: Number of samples between publishes (update_rate / sample_rate).
+    # tumbling: If True, the window is cleared after every publish.
+    # by_time: If True, <size> and <interval> are in seconds of sensor time (Sample.sensor_time,
+    #          or Sample.timestamp if there isn't one), so late or missing samples don't stretch the window.
+    # full: Keep the min, max and variance of every field too (see RunningStats).
+    def __init__(self, fields, size, interval, tumbling=False, by_time=False, full=False):
+        if by_time and interval <= 0:
+            raise ValueError("<interval> must be more than 0 seconds.")
+        if not by_time and interval < 1:
+            raise ValueError("<interval> must be at least 1.")
+        self.fields = tuple(fields)
+        self.size = size
+        self.interval = interval
+        self.tumbling = tumbling
+        self.by_time = by_time
+        self.stats = {field: RunningStats(None if tumbling or by_time else size, full) for field in self.fields}
+        self._items = tuple(self.stats.items())
+        self.count = 0
+        # Number of samples added between the last two publishes.
+        self.last_count = 0
+        self._reset_pending = False
+        # Sample times in the window and the next publish time, when aggregating by time.
+        self._times = deque()
+        self._next_publish = None
+        # A sample that closed a tumbling time window, held over to start the next one.
+        self._carry = None
+
+    # Function to add a sample. Returns True once every <interval> samples (or seconds).
+    def add(self, sample):
+        if self._reset_pending:
+            carry = self._carry
+            self.reset()
+            if carry is not None:
+                self._append(carry, self._time(carry))
+        if self.by_time:
+            return self._add_timed(sample)
+        for field, stats in self._items:
+            stats.add(getattr(sample, field))
+        self.count += 1
+        if self.count >= self.interval:
+            self.last_count = self.count
+            self.count = 0
+            self._reset_pending = self.tumbling
+            return True
+        return False
+
+    # Private function to add a sample to a window bounded by time.
+    def _add_timed(self, sample):
+        now = self._time(sample)
+        if self.tumbling:
+            if self._next_publish is not None and now >= self._next_publish:
+                # The sample belongs to the next window: publish this one without it, and start the next one with it.
+                self._carry = sample
+                self._close(now)
+                return True
+        else:
+            times = self._times
+            cutoff = now - self.size
+            while times and times[0] <= cutoff:
+                times.popleft()
+                for field, stats in self._items:
+                    stats.evict()
+        self._append(sample, now)
+        if self._next_publish is None:
+            self._next_publish = now + self.interval
+        elif now >= self._next_publish:
+            self._close(now)
+            return True
+        return False
+
+    # Private function to add a sample's values to a window bounded by time.
+    def _append(self, sample, now):
+        self._times.append(now)
+        for field, stats in self._items:
+            stats.add(getattr(sample, field))
+        self.count += 1
+
+    # Private function to end the current publish interval of a window bounded by time.
+    def _close(self, now):
+        # Skip whole intervals with no samples in them, rather than publishing for each.
+        while self._next_publish <= now:
+            self._next_publish += self.interval
+        self.last_count = self.count
+        self.count = 0
+        self._reset_pending = self.tumbling
+
+    # Private function to return the time of a sample, for windows bounded by time.
+    @staticmethod
+    def _time(sample):
+        return sample.sensor_time if sample.sensor_time is not None else sample.timestamp
+
+    # Function to clear every field's window.
+    def reset(self):
+        for stats in self.stats.values():
+            stats.reset()
+        self.count = 0
+        self._times.clear()
+        self._reset_pending = False
+        self._carry = None
+
+    def __getitem__(self, field):
+        return self.stats[field]
+
+# Names published for each IAQ accuracy level.
+ACCURACY_CODES = {0: 'Stabilizing', 1: 'Low', 2: 'Medium', 3: 'High'}
+
+# Decimal places each field is published with; 0 publishes a whole number.
+PUBLISH_DECIMALS = {
+    'iaq': 1,
+    'temperature': 2,
+    'humidity': 2,
+    'pressure': 2,
+    'gas': 0,
+    'static_iaq': 1,
+    'co2_equivalent': 0,
+    'breath_voc_equivalent': 3,
+    'raw_temperature': 2,
+    'raw_humidity': 2
+}
+
+# Statistics published for each field of a rollup.
+ROLLUP_STATS = ('mean', 'min', 'max', 'last')
+
+# Returns the values published for a window: the rounded mean of each field of the
+# aggregator, with the IAQs optionally as a percentage and temperatures optionally in F.
+def summarize(aggregator, convert_to_f=False, iaq_as_percent=False):
+    values = {}
+    for field in aggregator.fields:
+        mean = aggregator[field].mean
+        if field == 'iaq_accuracy':
+            values[field] = ACCURACY_CODES.get(int(mean), 'Unknown')
+        else:
+            values[field] = publish_value(field, mean, convert_to_f, iaq_as_percent)
+    return values
+
+# Returns the values published for a rollup: the mean, min, max and last value of each field,
+# as {field: {stat: value}}, rounded and converted like summarize(). The IAQ accuracy stays a number.
+# The aggregator must keep the full statistics (full=True).
+def summarize_stats(aggregator, convert_to_f=False, iaq_as_percent=False):
+    values = {}
+    for field in aggregator.fields:
+        stats = aggregator[field]
+        if not stats.count:
+            continue
+        values[field] = {stat: publish_value(field, getattr(stats, stat), convert_to_f, iaq_as_percent) for stat in ROLLUP_STATS}
+        if iaq_as_percent and (field == 'iaq' or field == 'static_iaq'):
+            # The percentage goes down as the IAQ goes up.
+            values[field]['min'], values[field]['max'] = values[field]['max'], values[field]['min']
+    return values
+
+# Returns a value of <field> in its published units and precision.
+def publish_value(field, value, convert_to_f=False, iaq_as_percent=False):
+    if iaq_as_percent and (field == 'iaq' or field == 'static_iaq'):
+        # There may be a better way to do this, but this is the straight line approach.
+        return round((-value + 500) / 5, 2)
+    if convert_to_f and (field == 'temperature' or field == 'raw_temperature'):
+        return round((value * 9 / 5) + 32, 2)
+    if PUBLISH_DECIMALS.get(field, 2) == 0:
+        return int(value)
+    return round(value, PUBLISH_DECIMALS.get(field, 2))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+# AsyncBSECLibrary Tests - (C) 2018 TimothyBrown
+Runs AsyncBSECLibrary against a stand-in process that writes samples to stdout
+and state save reports to stderr, like bsec-library does.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import asyncio
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import BSECLibraryError
+from bseclib.aio import AsyncBSECLibrary
+from bseclib.simulate import SyntheticBackend
+
+# Two samples, then the reports bsec-library writes when it saves its state.
+CHILD = r'''
+import sys
+for i in range(2):
+    sys.stdout.write('{"IAQ_Accuracy": "1", "IAQ": "25.0", "Temperature": "21.0", "Humidity": "45.0", "Pressure": "1013.0", "Gas": "100000", "Status": "0"}\n')
+sys.stdout.flush()
+sys.stderr.write('state unchanged\nstate saved 139 0.004\nsomething else\n')
+'''
+
+# One sample, then waits to be stopped like bsec-library does.
+ENDLESS_CHILD = r'''
+import sys, time
+sys.stdout.write('{"IAQ_Accuracy": "1", "IAQ": "25.0", "Temperature": "21.0", "Humidity": "45.0", "Pressure": "1013.0", "Gas": "100000", "Status": "0"}\n')
+sys.stdout.flush()
+time.sleep(60)
+'''
+
+class StandInLibrary(AsyncBSECLibrary):
+    child = CHILD
+
+    def _run_command(self):
+        return [sys.executable, '-c', self.child]
+
+class EndlessLibrary(StandInLibrary):
+    child = ENDLESS_CHILD
+
+class AsyncLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.base_dir.cleanup()
+
+    def library(self, cls=StandInLibrary, **kwargs):
+        return cls(0x77, 0.0, 3, 3.3, 4, logger='test', base_dir=self.base_dir.name, backend=SyntheticBackend(), **kwargs)
+
+    def test_samples_and_state_reports(self):
+        async def run():
+            with self.assertLogs('test', logging.WARNING) as logs:
+                async with self.library() as bsec_lib:
+                    samples = [sample async for sample in bsec_lib.asamples()]
+            return bsec_lib, samples, logs.output
+        bsec_lib, samples, output = asyncio.run(run())
+        self.assertEqual([sample.iaq for sample in samples], [25.0, 25.0])
+        self.assertEqual(bsec_lib.state_unchanged, 1)
+        self.assertEqual(bsec_lib.state_writes, 1)
+        self.assertEqual(bsec_lib.state_write_seconds, 0.004)
+        # Other lines are logged, not printed.
+        self.assertTrue(any('something else' in line for line in output))
+
+    def test_read_queue_is_ignored(self):
+        with self.assertLogs('test', logging.INFO) as logs:
+            bsec_lib = self.library(read_queue=100)
+        self.assertEqual(bsec_lib.read_queue, 0)
+        self.assertTrue(any('ignoring read_queue' in line for line in logs.output))
+
+    def test_terminate_ends_the_output(self):
+        async def run():
+            async with self.library(EndlessLibrary) as bsec_lib:
+                samples = []
+                async for sample in bsec_lib.asamples():
+                    samples.append(sample)
+                    bsec_lib.terminate()
+                returncode = await bsec_lib.proc.wait()
+            return samples, returncode
+        with self.assertLogs('test', logging.WARNING):
+            samples, returncode = asyncio.run(asyncio.wait_for(run(), 10))
+        self.assertEqual(len(samples), 1)
+        self.assertEqual(returncode, -15)
+
+    def test_blocking_readers_raise(self):
+        async def run():
+            async with self.library() as bsec_lib:
+                for method in (bsec_lib.output, bsec_lib.samples, bsec_lib.fileno, bsec_lib.read_available, bsec_lib.read_batch):
+                    with self.assertRaises(BSECLibraryError):
+                        method()
+        with self.assertLogs('test', logging.ERROR) as logs:
+            asyncio.run(run())
+        self.assertTrue(any('use asamples() instead' in line for line in logs.output))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+# WindowAnalytics Tests - (C) 2018 TimothyBrown
+Checks the plain Python analytics against known values and the statistics
+module, and against the NumPy backend when NumPy is installed.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import random
+import logging
+import statistics
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import Sample, BSECLibraryError
+from bseclib.analytics import WindowAnalytics, summarize_analytics, numpy
+
+STATS = ('median', 'p10', 'p95', 'stdev', 'ema', 'slope', 'rate')
+
+def make_sample(n, sensor_time, iaq=25.0, temperature=21.0):
+    return Sample(None, n, 0, 3, iaq, temperature, 45.0, 1013.0, 100000.0, sensor_time, n)
+
+class PythonAnalyticsTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def analytics(self, capacity=100, window=None, ema_alpha=0.5):
+        return WindowAnalytics({'iaq': STATS, 'temperature': ('ema', 'slope')}, capacity, window, ema_alpha, backend='python')
+
+    def test_known_values(self):
+        analytics = self.analytics()
+        iaqs = [50.0, 52.0, 54.0, 56.0, 58.0]
+        for n, iaq in enumerate(iaqs):
+            analytics.add(make_sample(n, n * 3.0, iaq=iaq))
+        results = analytics.compute()['iaq']
+        self.assertEqual(results['median'], statistics.median(iaqs))
+        self.assertAlmostEqual(results['p10'], 50.8)
+        self.assertAlmostEqual(results['p95'], 57.6)
+        self.assertAlmostEqual(results['stdev'], statistics.stdev(iaqs))
+        # 50, then halfway to each next value.
+        self.assertAlmostEqual(results['ema'], 56.125)
+        # 2 per 3 seconds.
+        self.assertAlmostEqual(results['slope'], 40.0)
+        # 16% over 12 seconds.
+        self.assertAlmostEqual(results['rate'], 80.0)
+        self.assertEqual(analytics.compute()['temperature'], {'ema': 21.0, 'slope': 0.0})
+
+    def test_needs_more_samples(self):
+        analytics = self.analytics()
+        self.assertEqual(analytics.compute(), {})
+        analytics.add(make_sample(0, 0.0))
+        results = analytics.compute()['iaq']
+        self.assertEqual((results['median'], results['ema']), (25.0, 25.0))
+        self.assertEqual((results['stdev'], results['slope'], results['rate']), (None, None, None))
+        self.assertEqual(summarize_analytics(analytics.compute()), {'iaq_median': 25.0, 'iaq_p10': 25.0, 'iaq_p95': 25.0, 'iaq_ema': 25.0, 'temperature_ema': 21.0})
+
+    def test_capacity_and_window(self):
+        analytics = self.analytics(capacity=4)
+        for n in range(10):
+            analytics.add(make_sample(n, n * 3.0, iaq=float(n)))
+        self.assertEqual(analytics.count, 4)
+        self.assertEqual(analytics.compute()['iaq']['median'], 7.5)
+        # Only samples from the last 6 seconds (27 > t > 21) are used.
+        analytics = self.analytics(window=6)
+        for n in range(10):
+            analytics.add(make_sample(n, n * 3.0, iaq=float(n)))
+        self.assertEqual(analytics.compute()['iaq']['median'], 8.5)
+
+    def test_published_units(self):
+        results = {'iaq': {'median': 100.0, 'stdev': 10.0, 'slope': 5.0}, 'temperature': {'ema': 20.0, 'slope': 1.0}}
+        self.assertEqual(summarize_analytics(results, convert_to_f=True, iaq_as_percent=True),
+                         {'iaq_median': 80.0, 'iaq_stdev': 2.0, 'iaq_slope': -1.0, 'temperature_ema': 68.0, 'temperature_slope': 1.8})
+
+    def test_bad_arguments(self):
+        for kwargs in ({'backend': 'fortran'}, {'capacity': 1}, {'ema_alpha': 0}, {'stats': {'radon': ('median',)}}, {'stats': {'iaq': ('mode',)}}):
+            arguments = dict({'stats': {'iaq': ('median',)}, 'capacity': 10}, **kwargs)
+            with self.assertRaises(BSECLibraryError):
+                WindowAnalytics(**arguments)
+
+    @unittest.skipIf(numpy is not None, "NumPy is installed")
+    def test_numpy_backend_needs_numpy(self):
+        with self.assertRaises(BSECLibraryError):
+            WindowAnalytics({'iaq': ('median',)}, 10, backend='numpy')
+
+@unittest.skipUnless(numpy is not None, "NumPy isn't installed")
+class NumpyAnalyticsTest(unittest.TestCase):
+
+    # Feeds the same random stream (with late samples, a gap and more samples than the ring holds)
+    # to both backends and checks they agree after each one.
+    def compare(self, capacity, window):
+        stats = {'iaq': STATS, 'temperature': STATS, 'gas': ('ema', 'slope')}
+        backends = [WindowAnalytics(stats, capacity, window, 0.1, backend=backend) for backend in ('python', 'numpy')]
+        rand = random.Random(2018)
+        sensor_time = 1000.0
+        for n in range(500):
+            sensor_time += 120.0 if n == 250 else rand.uniform(2.5, 3.5)
+            sample = Sample(None, n, 0, 3, rand.uniform(0, 500), rand.uniform(15, 30), 45.0, 1013.0, rand.uniform(5e4, 2e5), sensor_time, n)
+            for analytics in backends:
+                analytics.add(sample)
+            python, numpy_results = [analytics.compute() for analytics in backends]
+            for field in stats:
+                for name in stats[field]:
+                    expected, value = python[field][name], numpy_results[field][name]
+                    if expected is None:
+                        self.assertIsNone(value, '{} {} after {} samples'.format(field, name, n + 1))
+                    else:
+                        self.assertAlmostEqual(value, expected, delta=1e-9 * max(1.0, abs(expected)),
+                                               msg='{} {} after {} samples'.format(field, name, n + 1))
+
+    def test_matches_python_by_count(self):
+        self.compare(60, None)
+
+    def test_matches_python_by_time(self):
+        self.compare(60, 90)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+# Deadband Tests - (C) 2018 TimothyBrown
+Feeds published values through the deadband filter with controlled times.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import BSECLibraryError
+from bseclib.deadband import Deadband, parse_threshold
+from bseclib.metrics import Metrics
+
+class DeadbandTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_first_sample_passes_through(self):
+        deadband = Deadband({'temperature': '0.5'})
+        values = {'temperature': 21.0, 'humidity': 45.0, 'iaq_accuracy': 'Low'}
+        self.assertEqual(deadband.filter('bsec', values, now=0), values)
+        # Each key has its own history.
+        self.assertEqual(deadband.filter('other', values, now=0), values)
+
+    def test_suppressed_inside_the_band(self):
+        metrics = Metrics()
+        deadband = Deadband({'temperature': '0.5', 'iaq': '10%'}, metrics=metrics)
+        deadband.filter('bsec', {'temperature': 21.0, 'iaq': 50.0, 'humidity': 45.0}, now=0)
+        # Moves of up to the threshold (0.5, and 10% of 50), and unchanged values without one, are held back.
+        self.assertEqual(deadband.filter('bsec', {'temperature': 21.5, 'iaq': 55.0, 'humidity': 45.0}, now=1), {})
+        self.assertEqual(deadband.filter('bsec', {'temperature': 20.6, 'iaq': 46.0, 'humidity': 45.0}, now=2), {})
+        self.assertEqual(deadband.sent, 3)
+        self.assertEqual(deadband.suppressed, 6)
+        self.assertEqual(metrics.counter('deadband_sent_total', '').value, 3)
+        self.assertEqual(metrics.counter('deadband_suppressed_total', '').value, 6)
+
+    def test_sent_when_the_band_is_crossed(self):
+        deadband = Deadband({'temperature': '0.5', 'iaq': '10%'})
+        deadband.filter('bsec', {'temperature': 21.0, 'iaq': 50.0, 'humidity': 45.0, 'iaq_accuracy': 'Low'}, now=0)
+        self.assertEqual(deadband.filter('bsec', {'temperature': 21.6, 'iaq': 50.0, 'humidity': 45.0, 'iaq_accuracy': 'Low'}, now=1),
+                         {'temperature': 21.6})
+        # The band is around the last value sent (21.6), not the first.
+        self.assertEqual(deadband.filter('bsec', {'temperature': 21.2, 'iaq': 44.9, 'humidity': 45.01, 'iaq_accuracy': 'High'}, now=2),
+                         {'iaq': 44.9, 'humidity': 45.01, 'iaq_accuracy': 'High'})
+        self.assertEqual(deadband.filter('bsec', {'temperature': 21.0, 'iaq': 44.9, 'humidity': 45.01, 'iaq_accuracy': 'High'}, now=3),
+                         {'temperature': 21.0})
+
+    def test_bundle_sends_everything_when_anything_is_due(self):
+        deadband = Deadband({'temperature': '0.5'})
+        values = {'temperature': 21.0, 'humidity': 45.0}
+        deadband.filter('bsec', values, now=0, bundle=True)
+        self.assertEqual(deadband.filter('bsec', values, now=1, bundle=True), {})
+        self.assertEqual(deadband.filter('bsec', {'temperature': 22.0, 'humidity': 45.0}, now=2, bundle=True),
+                         {'temperature': 22.0, 'humidity': 45.0})
+
+    def test_heartbeat_forces_a_publish(self):
+        deadband = Deadband({'temperature': '0.5'}, heartbeat=60)
+        values = {'temperature': 21.0, 'humidity': 45.0}
+        deadband.filter('bsec', values, now=0)
+        self.assertEqual(deadband.filter('bsec', values, now=59.9), {})
+        self.assertEqual(deadband.filter('bsec', values, now=60), values)
+        # The heartbeat starts over from each send, per field.
+        self.assertEqual(deadband.filter('bsec', {'temperature': 22.0, 'humidity': 45.0}, now=90), {'temperature': 22.0})
+        self.assertEqual(deadband.filter('bsec', {'temperature': 22.0, 'humidity': 45.0}, now=120), {'humidity': 45.0})
+        self.assertEqual(deadband.filter('bsec', {'temperature': 22.0, 'humidity': 45.0}, now=150), {'temperature': 22.0})
+
+    def test_no_heartbeat(self):
+        deadband = Deadband(heartbeat=0)
+        deadband.filter('bsec', {'humidity': 45.0}, now=0)
+        self.assertEqual(deadband.filter('bsec', {'humidity': 45.0}, now=100000), {})
+
+    def test_reset(self):
+        deadband = Deadband()
+        deadband.filter('bsec', {'humidity': 45.0}, now=0)
+        deadband.filter('other', {'humidity': 45.0}, now=0)
+        deadband.reset('bsec')
+        self.assertEqual(deadband.filter('bsec', {'humidity': 45.0}, now=1), {'humidity': 45.0})
+        self.assertEqual(deadband.filter('other', {'humidity': 45.0}, now=1), {})
+        deadband.reset()
+        self.assertEqual(deadband.filter('other', {'humidity': 45.0}, now=2), {'humidity': 45.0})
+
+    def test_thresholds(self):
+        self.assertEqual(parse_threshold('0.5'), (0.5, False))
+        self.assertEqual(parse_threshold(' 2% '), (0.02, True))
+        with self.assertRaises(ValueError):
+            parse_threshold('-1')
+        with self.assertRaises(ValueError):
+            parse_threshold('lots')
+        with self.assertRaises(BSECLibraryError):
+            Deadband({'temperature': 'lots'})
+        with self.assertRaises(BSECLibraryError):
+            Deadband(heartbeat=-1)
+
+if __name__ == "__main__":
+    unittest.main()
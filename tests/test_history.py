@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+# SampleHistory Tests - (C) 2018 TimothyBrown
+Round trips samples through the ring file and checks range queries.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import Sample
+from bseclib.history import SampleHistory
+
+# Returns a Sample with every output set, sensor_time seconds after the sensor started.
+def sample(n, sensor_time=None):
+    return Sample(None, n, 0, n % 4, 25.0 + n, 21.0, 45.0, 1013.0, 100000.0, sensor_time, n,
+                  30.0 + n, 600.0, 0.5, 22.5, 40.0)
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bsec-history.ring')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def test_every_field_is_kept(self):
+        history = SampleHistory(self.path, 10)
+        history.append(sample(1, 100.5), timestamp=1000.0)
+        stored, = history.query()
+        history.close()
+        self.assertEqual(stored.timestamp, 1000.0)
+        self.assertEqual(stored.sequence, 0)
+        for name in Sample.__slots__:
+            if name not in ('timestamp', 'sequence'):
+                self.assertEqual(getattr(stored, name), getattr(sample(1, 100.5), name), name)
+
+    def test_unselected_outputs_are_none(self):
+        history = SampleHistory(self.path, 10)
+        history.append(Sample(None, 0, 0, 3, 25.0, None, None, None, None), timestamp=1000.0)
+        stored, = history.query()
+        history.close()
+        self.assertEqual((stored.iaq, stored.temperature, stored.co2_equivalent, stored.sensor_time, stored.sensor_sequence),
+                         (25.0, None, None, None, None))
+
+    def test_clock_step_keeps_ranges_in_order(self):
+        history = SampleHistory(self.path, 10)
+        # The wall clock steps back 100 seconds after the third sample.
+        for n, timestamp in enumerate((1000.0, 1003.0, 1006.0, 906.0, 909.0)):
+            history.append(sample(n), timestamp=timestamp)
+        self.assertEqual([i.timestamp for i in history.query()], [1000.0, 1003.0, 1006.0, 1006.0, 1006.0])
+        self.assertEqual([i.sequence for i in history.query(1003.0, 1006.0)], [1])
+        self.assertEqual([i.sequence for i in history.query(1006.0)], [2, 3, 4])
+        history.close()
+
+    def test_timestamps_follow_the_sensor_clock(self):
+        history = SampleHistory(self.path, 10)
+        for n in range(3):
+            history.append(sample(n, 500.0 + 3 * n))
+        times = [i.timestamp for i in history.query()]
+        history.close()
+        self.assertEqual([round(b - a, 6) for a, b in zip(times, times[1:])], [3.0, 3.0])
+
+    def test_reopen_and_wrap(self):
+        history = SampleHistory(self.path, 4)
+        for n in range(3):
+            history.append(sample(n), timestamp=1000.0 + n)
+        history.close()
+        history = SampleHistory(self.path, 4)
+        for n in range(3, 6):
+            history.append(sample(n), timestamp=1000.0 + n)
+        self.assertEqual([i.sequence for i in history.query()], [2, 3, 4, 5])
+        self.assertEqual([i.iaq for i in history.query(1003.0, 1005.0)], [28.0, 29.0])
+        history.close()
+
+if __name__ == "__main__":
+    unittest.main()
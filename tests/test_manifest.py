@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+# StartupManifest Tests - (C) 2018 TimothyBrown
+Records an installed file and checks it's caught when changed or replaced.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib.manifest import StartupManifest
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bsec-library.manifest')
+        self.executable = os.path.join(self.directory.name, 'bsec-library')
+        self.write(b'\x7fELF one')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def write(self, data):
+        with open(self.executable, 'wb') as f:
+            f.write(data)
+
+    # Records the executable and returns a manifest reopened from disk.
+    def recorded(self):
+        manifest = StartupManifest(self.path)
+        manifest.record_file(self.executable, key='abc')
+        manifest.save()
+        return StartupManifest(self.path)
+
+    def test_unchanged_file_verifies_without_reading(self):
+        manifest = self.recorded()
+        self.assertEqual(manifest.verify_file(self.executable), {'key': 'abc'})
+        self.assertEqual((manifest.hits, manifest.misses), (1, 0))
+
+    def test_changed_file_fails(self):
+        manifest = self.recorded()
+        self.write(b'\x7fELF two three')
+        self.assertIsNone(manifest.verify_file(self.executable))
+
+    def test_replaced_file_with_same_size_and_mtime_fails(self):
+        manifest = self.recorded()
+        stat = os.stat(self.executable)
+        replacement = self.executable + '.new'
+        with open(replacement, 'wb') as f:
+            f.write(b'\x7fELF two')
+        os.utime(replacement, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(replacement, self.executable)
+        # Same size and mtime, but a new inode: the digest is recomputed and doesn't match.
+        self.assertIsNone(manifest.verify_file(self.executable))
+
+    def test_missing_or_unrecorded_file_fails(self):
+        manifest = self.recorded()
+        self.assertIsNone(StartupManifest(self.path, full_check=True).verify_file(self.executable))
+        os.remove(self.executable)
+        self.assertIsNone(manifest.verify_file(self.executable))
+
+if __name__ == "__main__":
+    unittest.main()
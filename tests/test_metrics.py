@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+# Metrics Tests - (C) 2018 TimothyBrown
+Renders a metrics registry in the Prometheus text exposition format and
+scrapes it over a Unix socket.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import socket
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib.metrics import Metrics, MetricsServer
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_counter(self):
+        counter = self.metrics.counter('bsec_samples_total', 'Samples read.')
+        counter.inc()
+        counter.inc(2)
+        self.assertEqual(self.metrics.render(), '# HELP bsec_samples_total Samples read.\n'
+                                                '# TYPE bsec_samples_total counter\n'
+                                                'bsec_samples_total 3\n')
+
+    def test_gauge(self):
+        gauge = self.metrics.gauge('bsec_queue_depth', 'Messages waiting.')
+        gauge.set(5)
+        gauge.dec(2)
+        self.metrics.gauge('bsec_uptime_seconds', 'Seconds since start.', function=lambda: 12.5)
+        self.metrics.gauge('bsec_temperature', 'Last temperature.').set(None)
+        self.metrics.gauge('bsec_floor', 'Lowest value.').set(float('-inf'))
+        self.assertEqual(self.metrics.render().splitlines()[2::3],
+                         ['bsec_queue_depth 3', 'bsec_uptime_seconds 12.5', 'bsec_temperature NaN', 'bsec_floor -Inf'])
+
+    def test_histogram(self):
+        histogram = self.metrics.histogram('bsec_parse_seconds', 'Parse time.', buckets=(0.001, 0.01))
+        for value in (0.0005, 0.001, 0.005, 0.5):
+            histogram.observe(value)
+        # Buckets are cumulative and include their upper bound; +Inf holds everything.
+        self.assertEqual(self.metrics.render(), '# HELP bsec_parse_seconds Parse time.\n'
+                                                '# TYPE bsec_parse_seconds histogram\n'
+                                                'bsec_parse_seconds_bucket{le="0.001"} 2\n'
+                                                'bsec_parse_seconds_bucket{le="0.01"} 3\n'
+                                                'bsec_parse_seconds_bucket{le="+Inf"} 4\n'
+                                                'bsec_parse_seconds_sum 0.5065\n'
+                                                'bsec_parse_seconds_count 4\n')
+
+    def test_labels(self):
+        sensor = self.metrics.child(sensor='living room')
+        sensor.counter('bsec_samples_total', 'Samples read.').inc()
+        self.metrics.counter('bsec_samples_total', 'Samples read.', sensor='attic').inc(2)
+        sensor.histogram('bsec_parse_seconds', 'Parse time.', buckets=(0.01,), stage='json').observe(0.001)
+        lines = self.metrics.render().splitlines()
+        self.assertIn('bsec_samples_total{sensor="living room"} 1', lines)
+        self.assertIn('bsec_samples_total{sensor="attic"} 2', lines)
+        # Labels are sorted by name, and le comes last.
+        self.assertIn('bsec_parse_seconds_bucket{sensor="living room",stage="json",le="0.01"} 1', lines)
+        self.assertIn('bsec_parse_seconds_sum{sensor="living room",stage="json"} 0.001', lines)
+        # One HELP and TYPE per name, however many label sets it has.
+        self.assertEqual(lines.count('# TYPE bsec_samples_total counter'), 1)
+        self.assertTrue(self.metrics.remove('bsec_samples_total', sensor='attic'))
+        self.assertFalse(self.metrics.remove('bsec_samples_total', sensor='attic'))
+        self.assertNotIn('bsec_samples_total{sensor="attic"} 2', self.metrics.render().splitlines())
+
+    def test_escaping(self):
+        self.metrics.counter('bsec_errors_total', 'Errors, i.e. "bad" \\ broken\nones.', topic='bsec/"x"\\y\nz').inc()
+        self.assertEqual(self.metrics.render(), '# HELP bsec_errors_total Errors, i.e. "bad" \\\\ broken\\nones.\n'
+                                                '# TYPE bsec_errors_total counter\n'
+                                                'bsec_errors_total{topic="bsec/\\"x\\"\\\\y\\nz"} 1\n')
+
+    def test_type_mismatch(self):
+        self.metrics.counter('bsec_samples_total', 'Samples read.')
+        with self.assertRaises(ValueError):
+            self.metrics.gauge('bsec_samples_total', 'Samples read.')
+
+    def test_snapshot(self):
+        self.metrics.counter('bsec_samples_total', 'Samples read.', sensor='attic').inc(4)
+        self.metrics.histogram('bsec_parse_seconds', 'Parse time.', buckets=(0.001, 0.01)).observe(0.002)
+        self.assertEqual(self.metrics.snapshot(), {
+            'bsec_samples_total{sensor="attic"}': 4,
+            'bsec_parse_seconds': {'count': 1, 'mean': 0.002, 'p50': 0.01, 'p99': 0.01}
+        })
+
+    def test_served_over_a_unix_socket(self):
+        self.metrics.counter('bsec_samples_total', 'Samples read.').inc()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.sock')
+            server = MetricsServer(self.metrics, path)
+            try:
+                with socket.socket(socket.AF_UNIX) as client:
+                    client.connect(path)
+                    client.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+                    response = b''
+                    while True:
+                        data = client.recv(65536)
+                        if not data:
+                            break
+                        response += data
+            finally:
+                server.close()
+            self.assertFalse(os.path.exists(path))
+        head, body = response.decode('UTF-8').split('\r\n\r\n', 1)
+        self.assertTrue(head.startswith('HTTP/1.0 200'))
+        self.assertIn('Content-Type: text/plain; version=0.0.4; charset=utf-8', head)
+        self.assertEqual(body, self.metrics.render())
+
+if __name__ == "__main__":
+    unittest.main()
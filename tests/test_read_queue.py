@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+# Read Queue Tests - (C) 2018 TimothyBrown
+Runs BSECLibrary with a read queue against a stand-in process that writes a
+burst of samples to stdout and exits, like a stalled consumer would see.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import select
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import BSECLibrary, BSECLibraryError
+from bseclib.metrics import Metrics
+from bseclib.simulate import SyntheticBackend
+
+# Writes one sample per status, with the IAQ counting up from 0, then exits.
+CHILD = r'''
+import sys
+for n, status in enumerate(sys.argv[1].split(',')):
+    sys.stdout.write('{{"IAQ_Accuracy": "1", "IAQ": "{}", "Temperature": "21.0", "Humidity": "45.0", "Pressure": "1013.0", "Gas": "100000", "Status": "{}"}}\n'.format(n, status))
+'''
+
+class StandInLibrary(BSECLibrary):
+
+    def __init__(self, statuses, *args, **kwargs):
+        self.statuses = statuses
+        super().__init__(*args, **kwargs)
+
+    def _run_command(self):
+        return [sys.executable, '-c', CHILD, ','.join(str(status) for status in self.statuses)]
+
+class ReadQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.base_dir = tempfile.TemporaryDirectory()
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        self.base_dir.cleanup()
+        logging.disable(logging.NOTSET)
+
+    # Starts a stand-in that writes a sample for each of <statuses>, and waits until the reader has queued all of it.
+    def library(self, statuses, read_queue):
+        bsec_lib = StandInLibrary(statuses, 0x77, 0.0, 3, 3.3, 4, logger='test', base_dir=self.base_dir.name, backend=SyntheticBackend(),
+                                  metrics=self.metrics, read_queue=read_queue)
+        bsec_lib.open()
+        bsec_lib._reader.join(5)
+        self.addCleanup(bsec_lib.close)
+        return bsec_lib
+
+    def counter(self, name):
+        return self.metrics.counter(name, '').value
+
+    def test_batches_in_order(self):
+        bsec_lib = self.library([0] * 5, 10)
+        batch = bsec_lib.read_batch(3, 0)
+        self.assertEqual([sample.iaq for sample in batch], [0.0, 1.0, 2.0])
+        self.assertEqual([sample.sequence for sample in batch], [0, 1, 2])
+        self.assertEqual([sample.iaq for sample in bsec_lib.read_batch(3, 0)], [3.0, 4.0])
+        self.assertIsNone(bsec_lib.read_batch(3, 0))
+        self.assertEqual(bsec_lib.read_dropped, 0)
+        self.assertEqual(bsec_lib.read_overflows, 0)
+
+    def test_overflow_drops_the_oldest_and_counts_them(self):
+        bsec_lib = self.library([0] * 50, 5)
+        # Nothing was taken while the stand-in wrote 50 samples: only the newest 5 are left.
+        self.assertEqual([sample.iaq for sample in bsec_lib.read_batch(10, 0)], [45.0, 46.0, 47.0, 48.0, 49.0])
+        self.assertEqual(bsec_lib.read_dropped, 45)
+        # One overflow, however many reads it lasted.
+        self.assertEqual(bsec_lib.read_overflows, 1)
+        self.assertEqual(self.counter('bsec_read_dropped_total'), 45)
+        self.assertEqual(self.counter('bsec_read_overflows_total'), 1)
+        self.assertEqual(self.metrics.gauge('bsec_read_queue_depth', '').value, 0)
+
+    def test_error_status_keeps_the_rest_of_the_batch(self):
+        bsec_lib = self.library([0, 0, -2, 0, 0], 10)
+        # The samples ahead of the error come first...
+        self.assertEqual([sample.iaq for sample in bsec_lib.read_batch(10, 0)], [0.0, 1.0])
+        # ...then the error on its own...
+        with self.assertRaises(BSECLibraryError):
+            bsec_lib.read_batch(10, 0)
+        self.assertEqual(self.counter('bsec_status_errors_total'), 1)
+        # ...and the samples behind it are still queued.
+        batch = bsec_lib.read_batch(10, 0)
+        self.assertEqual([sample.iaq for sample in batch], [3.0, 4.0])
+        self.assertEqual([sample.sequence for sample in batch], [2, 3])
+        self.assertIsNone(bsec_lib.read_batch(10, 0))
+
+    def test_fileno_is_readable_when_samples_are_queued(self):
+        bsec_lib = self.library([0] * 3, 10)
+        readable, writable, errors = select.select([bsec_lib.fileno()], [], [], 0)
+        self.assertEqual(readable, [bsec_lib.fileno()])
+        self.assertEqual([sample.iaq for sample in bsec_lib.read_available()], [0.0, 1.0, 2.0])
+        # The reader closed its end of the pipe when the output ended.
+        self.assertIsNone(bsec_lib.read_available())
+
+if __name__ == "__main__":
+    unittest.main()
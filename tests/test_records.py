@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+# Binary Record Tests - (C) 2018 TimothyBrown
+Round-trips the binary records written by the bsec-library process in 'binary'
+mode through the encoder and decoders.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import (BSECLibraryError, OUTPUT_FIELDS, DEFAULT_FIELDS, RECORD_HEADER, RECORD_MAGIC, RECORD_VERSION,
+                     field_mask, mask_fields, record_size, encode_record, decode_record, decode_records, decode_record_buffer)
+
+ALL_FIELDS = tuple(field for field, key in OUTPUT_FIELDS)
+
+# A record with every output. The values are exact in float32, so they come back unchanged.
+def make_data(n=0, fields=ALL_FIELDS):
+    data = {'Status': 0, 'IAQ_Accuracy': 3, 'Timestamp': 1234567890123 + n, 'Sequence': n}
+    for i, (field, key) in enumerate(OUTPUT_FIELDS):
+        if field in fields:
+            data[key] = 25.5 + i + n
+    return data
+
+class FieldMaskTest(unittest.TestCase):
+
+    def test_masks(self):
+        self.assertEqual(field_mask(DEFAULT_FIELDS), 0x1F)
+        self.assertEqual(field_mask(ALL_FIELDS), (1 << len(OUTPUT_FIELDS)) - 1)
+        self.assertEqual(field_mask(['raw_humidity', 'iaq']), 0x201)
+        self.assertEqual(field_mask([]), 0)
+        self.assertEqual(mask_fields(field_mask(['raw_humidity', 'iaq'])), ('iaq', 'raw_humidity'))
+
+    def test_unknown_field(self):
+        with self.assertRaises(BSECLibraryError):
+            field_mask(['iaq', 'radon'])
+
+class RecordTest(unittest.TestCase):
+
+    def test_full_mask_round_trip(self):
+        data = make_data()
+        record = encode_record(data)
+        self.assertEqual(len(record), record_size(field_mask(ALL_FIELDS)))
+        self.assertEqual(decode_record(record), data)
+        self.assertEqual(decode_record_buffer(record), ([data], len(record)))
+        self.assertEqual(list(decode_records(io.BytesIO(record))), [data])
+
+    def test_partial_mask_round_trip(self):
+        fields = ('iaq', 'gas', 'raw_temperature')
+        data = make_data(fields=fields)
+        record = encode_record(data)
+        self.assertEqual(len(record), record_size(field_mask(fields)))
+        self.assertLess(len(record), record_size(field_mask(ALL_FIELDS)))
+        self.assertEqual(decode_record(record), data)
+        # An explicit mask leaves out outputs that aren't in it.
+        self.assertEqual(decode_record(encode_record(make_data(), field_mask(fields))), data)
+
+    def test_buffer_of_mixed_masks(self):
+        records = [make_data(0), make_data(1, DEFAULT_FIELDS), make_data(2, ('humidity',))]
+        buffer = b''.join(encode_record(data) for data in records)
+        self.assertEqual(decode_record_buffer(buffer), (records, len(buffer)))
+        self.assertEqual(list(decode_records(io.BytesIO(buffer))), records)
+
+    def test_truncated_buffer(self):
+        first, second = encode_record(make_data(0)), encode_record(make_data(1))
+        buffer = first + second[:-1]
+        # Only complete records are decoded; the rest waits for more data.
+        self.assertEqual(decode_record_buffer(buffer), ([make_data(0)], len(first)))
+        self.assertEqual(decode_record_buffer(first[:RECORD_HEADER.size + 2]), ([], 0))
+        self.assertEqual(list(decode_records(io.BytesIO(buffer))), [make_data(0)])
+        with self.assertRaises(BSECLibraryError):
+            decode_record(buffer)
+        with self.assertRaises(BSECLibraryError):
+            decode_record(first[:-1])
+
+    def test_bad_magic(self):
+        record = encode_record(make_data())
+        bad = RECORD_HEADER.pack(RECORD_MAGIC ^ 0xFFFF, RECORD_VERSION, len(record)) + record[RECORD_HEADER.size:]
+        with self.assertRaises(BSECLibraryError):
+            decode_record_buffer(bad)
+        with self.assertRaises(BSECLibraryError):
+            list(decode_records(io.BytesIO(bad)))
+
+    def test_bad_version(self):
+        record = encode_record(make_data())
+        bad = RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION - 1, len(record)) + record[RECORD_HEADER.size:]
+        with self.assertRaises(BSECLibraryError):
+            decode_record_buffer(bad)
+        with self.assertRaises(BSECLibraryError):
+            list(decode_records(io.BytesIO(bad)))
+
+    def test_length_that_doesnt_match_the_mask(self):
+        record = encode_record(make_data())
+        bad = RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, len(record) - 4) + record[RECORD_HEADER.size:-4]
+        with self.assertRaises(BSECLibraryError):
+            decode_record_buffer(bad)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+# SampleSegment Tests - (C) 2018 TimothyBrown
+Writes samples to a segment and reads them back, including records that are
+half written, torn or overwritten.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import Sample
+from bseclib.segment import SampleSegment, SampleSegmentReader, SAMPLES, SEGMENT_SEQUENCE
+
+# Returns a Sample with every output set.
+def sample(n):
+    return Sample(None, n, 0, n % 4, 25.0 + n, 21.0, 45.0, 1013.0, 100000.0, 100.0 + n, n,
+                  30.0 + n, 600.0, 0.5, 22.5, 40.0)
+
+class SegmentTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bsec-conduit')
+        self.segment = SampleSegment(self.path, capacity=4, window_capacity=2)
+        self.reader = SampleSegmentReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.segment.close()
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def test_round_trip(self):
+        for n in range(6):
+            self.segment.append(sample(n), timestamp=1000.0 + n)
+        recent = self.reader.recent(10)
+        # Only the last <capacity> are kept, oldest first.
+        self.assertEqual([i.sequence for i in recent], [2, 3, 4, 5])
+        latest = self.reader.latest()
+        self.assertEqual((latest.timestamp, latest.iaq, latest.sensor_time, latest.raw_humidity), (1005.0, 30.0, 105.0, 40.0))
+
+    def test_half_written_record_is_skipped(self):
+        self.segment.append(sample(0), timestamp=1000.0)
+        self.segment.append(sample(1), timestamp=1001.0)
+        # The writer stopped between marking slot 1 odd and finishing it.
+        SEGMENT_SEQUENCE.pack_into(self.segment._mmap, self.segment._offset(SAMPLES, 1), 3)
+        self.assertEqual([i.sequence for i in self.reader.recent(2)], [0])
+
+    def test_torn_record_fails_its_crc(self):
+        self.segment.append(sample(0), timestamp=1000.0)
+        self.segment.append(sample(1), timestamp=1001.0)
+        # As a reader on a weakly ordered CPU might see it: the seqlock is done, but part of the body is stale.
+        offset = self.segment._offset(SAMPLES, 1) + SEGMENT_SEQUENCE.size
+        self.segment._mmap[offset:offset + 8] = bytes(8)
+        self.assertEqual([i.sequence for i in self.reader.recent(2)], [0])
+
+    def test_reopened_segment_carries_on(self):
+        self.segment.append(sample(0), timestamp=1000.0)
+        self.segment.close()
+        self.segment = SampleSegment(self.path, capacity=4, window_capacity=2)
+        self.segment.append(sample(1), timestamp=1001.0)
+        self.assertEqual([i.timestamp for i in self.reader.recent(4)], [1000.0, 1001.0])
+
+if __name__ == "__main__":
+    unittest.main()
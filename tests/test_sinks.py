@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+# Sink Tests - (C) 2018 TimothyBrown
+Writes records through the file based sinks and checks what ends up on disk.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import csv
+import sys
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib.sinks import InfluxSink, FileSink, SinkRecord, CSV_COLUMNS
+
+class InfluxSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bsec.lp')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def lines(self, records):
+        sink = InfluxSink('influx', self.path)
+        sink.write(records)
+        sink.finish()
+        with open(self.path, 'rt') as f:
+            return f.read().splitlines()
+
+    def test_each_kind_has_its_own_measurement(self):
+        lines = self.lines([SinkRecord('sample', 'kitchen', 'bsec', 1.0, {'iaq': 25.0, 'iaq_accuracy': 1, 'status': 0}),
+                            SinkRecord('window', 'kitchen', 'bsec', 2.0, {'iaq': 25.0, 'iaq_accuracy': 'Low'}),
+                            SinkRecord('rollup', None, 'bsec', 3.0, {'iaq': {'mean': 25.0, 'max': 30}}, resolution='15m')])
+        self.assertEqual(lines, ['bsec_sample,sensor=kitchen iaq=25.0,iaq_accuracy=1.0,status=0.0 1000000000',
+                                 'bsec_window,sensor=kitchen iaq=25.0,iaq_accuracy="Low" 2000000000',
+                                 'bsec_rollup,resolution=15m iaq_mean=25.0,iaq_max=30.0 3000000000'])
+
+    def test_field_types_never_conflict_within_a_measurement(self):
+        records = [SinkRecord('sample', None, 'bsec', 1.0, {'iaq_accuracy': 3, 'status': 0}),
+                   SinkRecord('window', None, 'bsec', 2.0, {'iaq_accuracy': 'High'}),
+                   SinkRecord('sample', None, 'bsec', 3.0, {'iaq_accuracy': 2, 'status': -2}),
+                   SinkRecord('window', None, 'bsec', 4.0, {'iaq_accuracy': 'Medium'})]
+        types = {}
+        for line in self.lines(records):
+            measurement, fields, timestamp = line.split(' ')
+            for field in fields.split(','):
+                name, value = field.split('=')
+                types.setdefault((measurement, name), set()).add(value.startswith('"'))
+        self.assertTrue(all(len(kinds) == 1 for kinds in types.values()))
+
+class CSVFileSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bsec.csv')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def write(self, records, columns=()):
+        sink = FileSink('file', self.path, format='csv', columns=columns)
+        sink.write(records)
+        sink.finish()
+
+    def rows(self, path=None):
+        with open(path or self.path, 'rt', newline='') as f:
+            return [dict(zip(rows[0], row)) for rows in [list(csv.reader(f))] for row in rows[1:]]
+
+    def test_analytics_columns(self):
+        self.write([SinkRecord('window', None, 'bsec', 1.0, {'iaq': 25.0, 'iaq_slope': -0.5})], columns=('iaq_slope',))
+        row, = self.rows()
+        self.assertEqual((row['iaq'], row['iaq_slope']), ('25.0', '-0.5'))
+        # The same columns append to the same file.
+        self.write([SinkRecord('window', None, 'bsec', 2.0, {'iaq': 26.0, 'iaq_slope': 0.5})], columns=('iaq_slope',))
+        self.assertEqual([row['iaq_slope'] for row in self.rows()], ['-0.5', '0.5'])
+        self.assertEqual(os.listdir(self.directory.name), ['bsec.csv'])
+
+    def test_new_value_starts_a_new_file(self):
+        self.write([SinkRecord('window', None, 'bsec', 1.0, {'iaq': 25.0})])
+        # i.e. after a reload added analytics: nothing is dropped, the old file is kept beside the new one.
+        self.write([SinkRecord('window', None, 'bsec', 2.0, {'iaq': 26.0, 'iaq_p95': 30.0}),
+                    SinkRecord('rollup', None, 'bsec', 3.0, {'iaq': {'mean': 25.5, 'min': 25.0, 'max': 26.0, 'last': 26.0}}, resolution='15m')])
+        old, = [name for name in os.listdir(self.directory.name) if name != 'bsec.csv']
+        self.assertEqual([row['iaq'] for row in self.rows(os.path.join(self.directory.name, old))], ['25.0'])
+        rows = self.rows()
+        self.assertEqual((rows[0]['iaq'], rows[0]['iaq_p95']), ('26.0', '30.0'))
+        self.assertEqual([(row['stat'], row['iaq'], row['iaq_p95']) for row in rows[1:3]], [('mean', '25.5', ''), ('min', '25.0', '')])
+
+    def test_fewer_columns_keep_the_file(self):
+        self.write([SinkRecord('window', None, 'bsec', 1.0, {'iaq': 25.0, 'iaq_median': 25.0})], columns=('iaq_median',))
+        self.write([SinkRecord('window', None, 'bsec', 2.0, {'iaq': 26.0})])
+        self.assertEqual([row['iaq_median'] for row in self.rows()], ['25.0', ''])
+        with open(self.path, 'rt', newline='') as f:
+            self.assertEqual(tuple(next(csv.reader(f))), CSV_COLUMNS + ('iaq_median',))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+# MessageSpool Tests - (C) 2018 TimothyBrown
+Runs the spool against a broker stand-in that can be taken offline.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import logging
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib.spool import MessageSpool
+
+class BrokerStandIn:
+    """Accepts messages while online, and refuses them (as paho does when disconnected) while offline."""
+
+    def __init__(self, online=False, fail_after=None):
+        self.online = online
+        # Go offline after accepting this many messages, i.e. in the middle of a replay.
+        self.fail_after = fail_after
+        self.received = []
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload, qos, retain):
+        with self.lock:
+            if self.fail_after is not None and len(self.received) >= self.fail_after:
+                self.online = False
+            if not self.online:
+                return False
+            self.received.append((topic, payload.decode('UTF-8') if isinstance(payload, bytes) else payload, qos, retain))
+            return True
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bsec-conduit.spool')
+        self.broker = BrokerStandIn()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def spool(self, **kwargs):
+        kwargs.setdefault('batch_interval', 0.01)
+        return MessageSpool(self.path, self.broker.publish, **kwargs)
+
+    # Connects the spool to the broker and waits for the replay to finish.
+    def reconnect(self, spool):
+        self.broker.online = True
+        spool.set_connected(True)
+        if spool._thread is not None:
+            spool._thread.join(5)
+
+    def test_online_publishes_straight_through(self):
+        spool = self.spool()
+        self.reconnect(spool)
+        spool.publish('bsec/iaq', '25.0', 1, True)
+        self.assertEqual(self.broker.received, [('bsec/iaq', '25.0', 1, True)])
+        self.assertEqual(spool.count, 0)
+        spool.close()
+
+    def test_offline_messages_are_spooled_and_survive_a_restart(self):
+        spool = self.spool()
+        for n in range(3):
+            spool.publish('bsec/iaq', str(n), timestamp=1000.0 + n)
+        self.assertEqual(spool.count, 3)
+        self.assertEqual(self.broker.received, [])
+        spool.close()
+        spool = self.spool()
+        self.assertEqual(spool.count, 3)
+        self.reconnect(spool)
+        self.assertEqual([i[1] for i in self.broker.received], ['0', '1', '2'])
+        self.assertEqual(spool.count, 0)
+        spool.close()
+
+    def test_replay_in_timestamp_order_and_in_batches(self):
+        spool = self.spool(batch_size=2)
+        for n, timestamp in enumerate((1003.0, 1001.0, 1002.0, 1000.0, 1004.0)):
+            spool.publish('bsec/{}'.format(n), str(timestamp), 0, True, timestamp=timestamp)
+        self.reconnect(spool)
+        self.assertEqual([i[1] for i in self.broker.received], ['1000.0', '1001.0', '1002.0', '1003.0', '1004.0'])
+        # Retain and QoS come back as they were published.
+        self.assertTrue(all(i[2] == 0 and i[3] is True for i in self.broker.received))
+        spool.close()
+
+    def test_new_messages_wait_behind_the_spool(self):
+        spool = self.spool()
+        spool.publish('bsec/iaq', 'old', timestamp=1000.0)
+        # Connected, but the spool isn't empty yet: the new message goes behind the old one.
+        spool.connected = True
+        self.broker.online = True
+        spool.publish('bsec/iaq', 'new', timestamp=1001.0)
+        self.assertEqual(self.broker.received, [])
+        self.reconnect(spool)
+        self.assertEqual([i[1] for i in self.broker.received], ['old', 'new'])
+        spool.close()
+
+    def test_replay_interrupted_by_the_broker_going_away(self):
+        spool = self.spool(batch_size=2)
+        for n in range(5):
+            spool.publish('bsec/iaq', str(n), timestamp=1000.0 + n)
+        self.broker.fail_after = 3
+        self.reconnect(spool)
+        self.assertEqual([i[1] for i in self.broker.received], ['0', '1', '2'])
+        self.assertEqual(spool.count, 2)
+        # The rest goes out, still in order, on the next connection.
+        self.broker.fail_after = None
+        self.reconnect(spool)
+        self.assertEqual([i[1] for i in self.broker.received], ['0', '1', '2', '3', '4'])
+        spool.close()
+
+    def test_drop_oldest_caps_the_size(self):
+        spool = self.spool(max_messages=4)
+        for n in range(7):
+            spool.publish('bsec/iaq', str(n), timestamp=1000.0 + n)
+        self.assertEqual(spool.count, 4)
+        self.assertEqual(spool.dropped, 3)
+        self.reconnect(spool)
+        self.assertEqual([i[1] for i in self.broker.received], ['3', '4', '5', '6'])
+        spool.close()
+
+    def test_summarize_collapses_the_oldest_half(self):
+        spool = self.spool(max_messages=4, policy='summarize')
+        for n, (topic, payload) in enumerate((('bsec/iaq', '10'), ('bsec/iaq', '20'), ('bsec/accuracy', 'Low'), ('bsec/accuracy', 'High'))):
+            spool.publish(topic, payload, timestamp=1000.0 + n)
+        # The fifth message overflows: the oldest half becomes one message per topic, with the mean value.
+        spool.publish('bsec/iaq', '30', timestamp=1004.0)
+        self.assertEqual(spool.count, 4)
+        self.assertEqual(spool.dropped, 1)
+        self.reconnect(spool)
+        received = [(i[0], i[1]) for i in self.broker.received]
+        self.assertEqual(received, [('bsec/iaq', '15.0'), ('bsec/accuracy', 'Low'), ('bsec/accuracy', 'High'), ('bsec/iaq', '30')])
+        spool.close()
+
+if __name__ == "__main__":
+    unittest.main()
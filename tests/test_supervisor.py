@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+# BSECSupervisor Tests - (C) 2018 TimothyBrown
+Runs the supervisor against fake children: pipes the tests write lines into
+instead of bsec-library processes.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import time
+import logging
+import unittest
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import BSECLibraryError
+from bseclib.supervisor import BSECSupervisor
+
+class FakeChild:
+    """Stands in for a BSECLibrary: open() makes a new pipe, each line written to it is a sample."""
+
+    def __init__(self):
+        self.opened = []
+        self.closed = 0
+        self.terminated = 0
+        self._read = None
+        self._write = None
+
+    def open(self):
+        self._read, self._write = os.pipe()
+        self.opened.append(time.monotonic())
+
+    def close(self):
+        self.closed += 1
+        for fd in (self._read, self._write):
+            if fd is not None:
+                os.close(fd)
+        self._read = self._write = None
+
+    def terminate(self, timeout=5):
+        self.terminated += 1
+        self.exit()
+
+    def fileno(self):
+        return self._read
+
+    # Returns the lines waiting in the pipe, or None once the child has exited.
+    def read_available(self):
+        data = os.read(self._read, 65536)
+        if not data:
+            return None
+        return data.decode().split()
+
+    # Test helpers: send samples, or exit (EOF on the pipe).
+    def send(self, *samples):
+        os.write(self._write, ''.join('{}\n'.format(i) for i in samples).encode())
+
+    def exit(self):
+        if self._write is not None:
+            os.close(self._write)
+            self._write = None
+
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.children = {'a': FakeChild(), 'b': FakeChild()}
+        self.supervisor = BSECSupervisor(self.children, restart_delay=0.2, max_restarts=2)
+        self.supervisor.open()
+
+    def tearDown(self):
+        if self.supervisor.selector is not None:
+            self.supervisor.close()
+        logging.disable(logging.NOTSET)
+
+    def test_fan_in(self):
+        self.children['a'].send('a1', 'a2')
+        self.children['b'].send('b1')
+        output = self.supervisor.output()
+        received = [next(output) for i in range(3)]
+        self.assertEqual(sorted(received), [('a', 'a1'), ('a', 'a2'), ('b', 'b1')])
+        # Each child's samples stay in order.
+        self.children['b'].send('b2', 'b3')
+        received = [next(output) for i in range(2)]
+        self.assertEqual(received, [('b', 'b2'), ('b', 'b3')])
+
+    def test_restart_after_eof(self):
+        child = self.children['a']
+        child.exit()
+        output = self.supervisor.output()
+        # The other child keeps being read while the failed one waits out its delay.
+        self.children['b'].send('b1')
+        self.assertEqual(next(output), ('b', 'b1'))
+        self.assertEqual(child.closed, 1)
+        self.assertEqual(self.supervisor.restarts['a'], 1)
+        # Once restarted, its new pipe is read.
+        while len(child.opened) < 2:
+            self.children['b'].send('tick')
+            next(output)
+            time.sleep(0.01)
+        self.assertGreaterEqual(child.opened[1] - child.opened[0], 0.2)
+        child.send('a1')
+        self.assertEqual(next(output), ('a', 'a1'))
+
+    def test_backoff_waits_without_samples(self):
+        child = self.children['a']
+        child.exit()
+        self.children['b'].exit()
+        # Both failed: output() sleeps in select() until the first restart is due, then reads the new pipe.
+        def send_once_restarted():
+            while len(child.opened) < 2:
+                time.sleep(0.01)
+            child.send('a1')
+        threading.Thread(target=send_once_restarted, daemon=True).start()
+        started = time.monotonic()
+        self.assertEqual(next(self.supervisor.output()), ('a', 'a1'))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(self.supervisor.restarts, {'a': 1, 'b': 1})
+
+    def test_gives_up_after_max_restarts(self):
+        child = self.children['a']
+        output = self.supervisor.output()
+        with self.assertRaises(BSECLibraryError):
+            while True:
+                # Exit again every time it's restarted.
+                child.exit()
+                self.children['b'].send('tick')
+                next(output)
+        self.assertEqual(self.supervisor.restarts['a'], 3)
+
+    def test_terminate_stops_without_restarting(self):
+        output = self.supervisor.output()
+        self.supervisor.terminate()
+        self.assertEqual(list(output), [])
+        for child in self.children.values():
+            self.assertEqual(child.terminated, 1)
+            self.assertEqual(len(child.opened), 1)
+        self.assertEqual(self.supervisor.restarts, {'a': 0, 'b': 0})
+
+if __name__ == "__main__":
+    unittest.main()
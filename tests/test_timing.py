@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+# SampleTiming Tests - (C) 2018 TimothyBrown
+Feeds samples with controlled sensor timestamps and sequence numbers to the
+timing checks.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import Sample
+from bseclib.metrics import Metrics
+from bseclib.timing import SampleTiming
+
+# A sample the sensor took at <sensor_time> with output number <sensor_sequence>, read <latency> seconds later.
+def make_sample(sensor_time, sensor_sequence, latency=0.01):
+    return Sample(None if sensor_time is None else sensor_time + latency, sensor_sequence, 0, 3, 25.0, 21.0, 45.0, 1013.0, 100000.0,
+                  sensor_time, sensor_sequence)
+
+class SampleTimingTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.metrics = Metrics()
+        self.timing = SampleTiming(3, metrics=self.metrics)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def feed(self, samples):
+        for sample in samples:
+            self.timing.add(sample)
+
+    def test_steady_cadence(self):
+        self.feed(make_sample(100.0 + n * 3, n) for n in range(10))
+        self.assertAlmostEqual(self.timing.latency, 0.01)
+        self.assertAlmostEqual(self.timing.jitter, 0.0)
+        self.assertEqual((self.timing.missed, self.timing.dropped), (0, 0))
+        self.assertEqual(self.metrics.histogram('bsec_pipe_latency_seconds', '').count, 10)
+        self.assertEqual(self.metrics.histogram('bsec_jitter_seconds', '').count, 9)
+
+    def test_jitter(self):
+        self.feed([make_sample(100.0, 0), make_sample(103.25, 1)])
+        self.assertAlmostEqual(self.timing.jitter, 0.25)
+        self.feed([make_sample(106.0, 2)])
+        self.assertAlmostEqual(self.timing.jitter, -0.25)
+        self.assertEqual(self.timing.missed, 0)
+
+    def test_missed_samples(self):
+        # The sensor loop skipped the samples at 106 and 109; the sequence carries on unbroken.
+        self.feed([make_sample(100.0, 0), make_sample(103.0, 1), make_sample(112.1, 2)])
+        self.assertEqual(self.timing.missed, 2)
+        self.assertEqual(self.timing.dropped, 0)
+        self.assertAlmostEqual(self.timing.jitter, 0.1)
+        self.assertEqual(self.metrics.counter('bsec_missed_samples_total', '').value, 2)
+
+    def test_dropped_samples(self):
+        # Samples 2 to 4 were produced on time but never read.
+        self.feed([make_sample(100.0, 0), make_sample(103.0, 1), make_sample(115.0, 5)])
+        self.assertEqual(self.timing.dropped, 3)
+        self.assertEqual(self.metrics.counter('bsec_dropped_samples_total', '').value, 3)
+
+    def test_restart_starts_over(self):
+        # The sequence goes back to 0 when the process restarts, after a gap that isn't counted.
+        self.feed([make_sample(100.0, 0), make_sample(103.0, 1), make_sample(500.0, 0), make_sample(503.0, 1)])
+        self.assertEqual((self.timing.missed, self.timing.dropped), (0, 0))
+
+    def test_no_period_skips_the_cadence_checks(self):
+        timing = SampleTiming(0)
+        for sample in (make_sample(100.0, 0), make_sample(100.5, 1), make_sample(130.0, 3)):
+            timing.add(sample)
+        self.assertIsNone(timing.jitter)
+        self.assertEqual((timing.missed, timing.dropped), (0, 1))
+
+    def test_samples_without_a_sensor_time_are_ignored(self):
+        self.feed([make_sample(None, None), make_sample(100.0, 0)])
+        self.assertIsNone(self.timing.jitter)
+        self.assertEqual(self.metrics.histogram('bsec_pipe_latency_seconds', '').count, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+# Window Statistics Tests - (C) 2018 TimothyBrown
+Checks the streaming window statistics against the statistics module.
+MIT License
+
+Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+
+import os
+import sys
+import random
+import statistics
+import unittest
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bseclib import Sample
+from bseclib.window import RunningStats, WindowAggregator, summarize, summarize_stats, PUBLISH_DECIMALS, ROLLUP_STATS
+
+FIELDS = ('iaq', 'temperature', 'humidity', 'pressure')
+
+def make_sample(n, iaq=25.0, temperature=21.0, humidity=45.0, pressure=1013.0, sensor_time=None):
+    return Sample(None, n, 0, 3, iaq, temperature, humidity, pressure, 100000.0, sensor_time, n, iaq, 600.0, 0.5, temperature, humidity)
+
+class RunningStatsTest(unittest.TestCase):
+
+    def test_sliding_window_matches_statistics(self):
+        stats = RunningStats(5, full=True)
+        values = [1.1, 2.2, 3.3, 4.4, 5.5, 6.6, 0.7]
+        for n, value in enumerate(values):
+            stats.add(value)
+            window = values[max(0, n - 4):n + 1]
+            self.assertEqual(stats.count, len(window))
+            self.assertEqual(stats.mean, statistics.mean(window))
+            self.assertEqual(stats.min, min(window))
+            self.assertEqual(stats.max, max(window))
+            self.assertEqual(stats.last, value)
+            if len(window) > 1:
+                self.assertAlmostEqual(stats.variance, statistics.variance(window))
+
+    def test_sum_is_exact_after_evictions(self):
+        stats = RunningStats(2)
+        for value in (1e16, 1.0, -1e16, 0.1, 0.2):
+            stats.add(value)
+        self.assertEqual(stats.sum, 0.1 + 0.2)
+        self.assertEqual(stats.mean, statistics.mean([0.1, 0.2]))
+
+    def test_min_max_need_full(self):
+        stats = RunningStats(5)
+        stats.add(1.0)
+        with self.assertRaises(ValueError):
+            stats.min
+        with self.assertRaises(ValueError):
+            stats.variance
+
+    def test_reset(self):
+        stats = RunningStats(None, full=True)
+        for value in (1.5, 2.5):
+            stats.add(value)
+        stats.reset()
+        self.assertEqual(stats.count, 0)
+        self.assertEqual(stats.sum, 0)
+        with self.assertRaises(ValueError):
+            stats.mean
+
+class WindowAggregatorTest(unittest.TestCase):
+
+    def test_published_means_match_the_baseline_over_a_long_stream(self):
+        # The original cache: a deque of the last <size> readings, published as round(statistics.mean(cache), n).
+        size, interval = 60, 20
+        aggregator = WindowAggregator(FIELDS, size, interval)
+        caches = {field: deque(maxlen=size) for field in FIELDS}
+        rand = random.Random(2018)
+        publishes = 0
+        for n in range(60000):
+            readings = {
+                'iaq': round(rand.uniform(0, 500), 2),
+                'temperature': round(rand.uniform(-20, 60), 2),
+                'humidity': round(rand.uniform(0, 100), 2),
+                'pressure': round(rand.uniform(900, 1100), 2)
+            }
+            for field in FIELDS:
+                caches[field].append(readings[field])
+            if aggregator.add(make_sample(n, **readings)):
+                publishes += 1
+                values = summarize(aggregator)
+                for field in FIELDS:
+                    self.assertEqual(values[field], round(statistics.mean(caches[field]), PUBLISH_DECIMALS[field]),
+                                     '{} after {} samples'.format(field, n + 1))
+        self.assertEqual(publishes, 60000 // interval)
+
+    def test_tumbling_window_clears_after_each_publish(self):
+        aggregator = WindowAggregator(['iaq'], 10, 3, tumbling=True)
+        published = []
+        for n in range(9):
+            if aggregator.add(make_sample(n, iaq=float(n))):
+                published.append((aggregator['iaq'].mean, aggregator.last_count))
+        self.assertEqual(published, [(1.0, 3), (4.0, 3), (7.0, 3)])
+
+class TimedWindowTest(unittest.TestCase):
+
+    # A cache as bsec-conduit makes it with aggregate_by = time: the last 30 seconds of sensor time, published every 9.
+    def setUp(self):
+        self.cache = WindowAggregator(['temperature'], 30, 9, by_time=True)
+        self.readings = []
+
+    # Adds a sample taken at <sensor_time>. Returns (count, mean) if it published the window, else None.
+    def add(self, sensor_time):
+        temperature = 20.0 + sensor_time / 100
+        self.readings.append((sensor_time, temperature))
+        if self.cache.add(make_sample(len(self.readings), temperature=temperature, sensor_time=sensor_time)):
+            return self.cache.last_count, self.cache['temperature'].mean
+        return None
+
+    # Returns the temperatures the window should hold at <now>: those of the last 30 seconds.
+    def expected(self, now):
+        return [temperature for sensor_time, temperature in self.readings if now - 30 < sensor_time <= now]
+
+    def test_published_on_schedule(self):
+        published = {}
+        for sensor_time in range(0, 61, 3):
+            result = self.add(sensor_time)
+            if result is not None:
+                published[sensor_time] = result
+        # The first sample starts the schedule; every 9 seconds after it the window is published.
+        self.assertEqual(sorted(published), [9, 18, 27, 36, 45, 54])
+        for sensor_time, (count, mean) in published.items():
+            self.assertEqual(mean, statistics.mean(self.expected(sensor_time)))
+        # Every publish after the first covers the 3 samples added since the last one.
+        self.assertEqual([published[t][0] for t in sorted(published)], [4, 3, 3, 3, 3, 3])
+        # Once full, the window holds 30 seconds of samples, not a fixed number of them.
+        self.assertEqual(self.cache['temperature'].count, len(self.expected(60)))
+
+    def test_late_samples_dont_stretch_the_window(self):
+        published = []
+        for sensor_time in (0, 3.4, 5.9, 9.2, 13.0, 14.5, 18.1):
+            if self.add(sensor_time) is not None:
+                published.append(sensor_time)
+        # Published at the first sample on or after 9 and 18, however many samples that took.
+        self.assertEqual(published, [9.2, 18.1])
+        self.assertEqual(self.cache.last_count, 3)
+
+    def test_gap(self):
+        for sensor_time in range(0, 37, 3):
+            self.add(sensor_time)
+        # Nothing for 44 seconds: one publish when the sensor comes back, not one per interval missed,
+        # and the samples from before the gap have left the window.
+        self.assertEqual(self.add(80), (1, 20.8))
+        self.assertEqual(self.cache['temperature'].count, 1)
+        # The schedule carries on from where it was (45, 54, 63, 72, 81, ...).
+        self.assertIsNone(self.add(80.5))
+        self.assertEqual(self.add(81), (2, statistics.mean(self.expected(81))))
+        self.assertIsNone(self.add(89))
+        self.assertIsNotNone(self.add(90))
+
+    def test_falls_back_to_the_read_time(self):
+        cache = WindowAggregator(['temperature'], 30, 9, by_time=True)
+        samples = [Sample(t, n, 0, 3, 25.0, 21.0, 45.0, 1013.0, 100000.0) for n, t in enumerate((100.0, 104.0, 109.5))]
+        self.assertEqual([cache.add(sample) for sample in samples], [False, False, True])
+
+class RollupTest(unittest.TestCase):
+
+    # A rollup as bsec-conduit makes them: a tumbling window of <seconds> of sensor time, with the full statistics.
+    def rollup(self, seconds, fields=FIELDS):
+        return WindowAggregator(fields, seconds, seconds, tumbling=True, by_time=True, full=True)
+
+    # Feeds (sensor time, temperature) pairs to <rollup>. Returns the temperatures and summarize_stats() of each published bucket.
+    def feed(self, rollup, readings, **kwargs):
+        buckets = []
+        for n, (sensor_time, temperature) in enumerate(readings):
+            if rollup.add(make_sample(n, temperature=temperature, sensor_time=sensor_time)):
+                buckets.append((rollup.last_count, summarize_stats(rollup, **kwargs)))
+        return buckets
+
+    def test_bucket_boundaries(self):
+        rollup = self.rollup(60, ['temperature'])
+        # A sample every 3 seconds: each bucket covers [start, start + 60), so the sample at 60 starts the second one.
+        buckets = self.feed(rollup, [(t, float(t)) for t in range(0, 183, 3)])
+        self.assertEqual([count for count, values in buckets], [20, 20, 20])
+        self.assertEqual([(values['temperature']['min'], values['temperature']['max']) for count, values in buckets],
+                         [(0.0, 57.0), (60.0, 117.0), (120.0, 177.0)])
+        # The published bucket stays readable until the next sample, which joins the one that closed it.
+        self.assertEqual(rollup['temperature'].count, 20)
+        rollup.add(make_sample(0, temperature=183.0, sensor_time=183))
+        self.assertEqual((rollup['temperature'].count, rollup['temperature'].min), (2, 180.0))
+
+    def test_empty_buckets_are_skipped(self):
+        rollup = self.rollup(60, ['temperature'])
+        # Nothing between 70 and 250: one bucket for [60, 120), then the next starts with the sample at 250.
+        buckets = self.feed(rollup, [(0, 1.0), (30, 2.0), (65, 3.0), (70, 4.0), (250, 5.0), (260, 6.0), (300, 7.0)])
+        self.assertEqual([(count, values['temperature']['mean']) for count, values in buckets], [(2, 1.5), (2, 3.5), (2, 5.5)])
+
+    def test_rollup_statistics(self):
+        rollup = self.rollup(60)
+        readings = [20.25, 21.5, 19.75, 22.0, 21.0]
+        for n, temperature in enumerate(readings):
+            self.assertFalse(rollup.add(make_sample(n, iaq=100.0 + n, temperature=temperature, sensor_time=n * 10)))
+        self.assertTrue(rollup.add(make_sample(5, sensor_time=60)))
+        values = summarize_stats(rollup)
+        self.assertEqual(set(values), set(FIELDS))
+        self.assertEqual(set(values['temperature']), set(ROLLUP_STATS))
+        self.assertEqual(values['temperature'], {'mean': round(statistics.mean(readings), 2), 'min': 19.75, 'max': 22.0, 'last': 21.0})
+        self.assertEqual(values['iaq'], {'mean': 102.0, 'min': 100.0, 'max': 104.0, 'last': 104.0})
+
+    def test_rollup_statistics_in_published_units(self):
+        rollup = self.rollup(60)
+        for n, (iaq, temperature) in enumerate(((50.0, 20.0), (150.0, 25.0))):
+            rollup.add(make_sample(n, iaq=iaq, temperature=temperature, sensor_time=n))
+        rollup.add(make_sample(2, sensor_time=60))
+        values = summarize_stats(rollup, convert_to_f=True, iaq_as_percent=True)
+        self.assertEqual(values['temperature'], {'mean': 72.5, 'min': 68.0, 'max': 77.0, 'last': 77.0})
+        # The percentage goes down as the IAQ goes up, so the min and max swap over.
+        self.assertEqual(values['iaq'], {'mean': 80.0, 'min': 70.0, 'max': 90.0, 'last': 70.0})
+
+if __name__ == "__main__":
+    unittest.main()